@@ -0,0 +1,117 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_left
+
+# File layout, little-endian:
+#   header   magic, version, key width, entry count, master generation
+#   entries  count x (key padded with NULs to key width, description
+#            offset, description length), sorted by key bytes
+#   pool     the UTF-8 descriptions, back to back
+MAGIC = b'BIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIQ')
+POOL_REF = struct.Struct('<II')
+
+# Keys longer than this are left out of the index and looked up in the
+# database; one odd code must not widen every entry
+MAX_KEY_WIDTH = 64
+
+
+class _Keys:
+    """The index's sorted keys as a sequence, read straight from the mapping"""
+
+    def __init__(self, buffer, count, key_width, entry_size):
+        self.buffer = buffer
+        self.count = count
+        self.key_width = key_width
+        self.entry_size = entry_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = HEADER.size + index * self.entry_size
+        return self.buffer[start:start + self.key_width]
+
+
+class BarcodeIndex:
+    """Read-only barcode -> description index over a memory-mapped file.
+
+    Opening reads only the header; a lookup binary-searches the fixed-width
+    key table and slices one description out of the string pool, so only
+    the pages it touches are ever loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.key_width, self.count, self.generation = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a barcode index")
+            self.entry_size = self.key_width + POOL_REF.size
+            self._keys = _Keys(self._mmap, self.count, self.key_width, self.entry_size)
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def get(self, codigo):
+        """Description of codigo, or None if it is not in the index"""
+        key = codigo.encode('utf-8')
+        if not key or len(key) > self.key_width:
+            return None
+        key = key.ljust(self.key_width, b'\0')
+        index = bisect_left(self._keys, key)
+        if index == self.count or self._keys[index] != key:
+            return None
+        offset, length = POOL_REF.unpack_from(self._mmap, HEADER.size + index * self.entry_size + self.key_width)
+        return self._mmap[offset:offset + length].decode('utf-8')
+
+    def close(self):
+        self._mmap.close()
+
+
+def build_barcode_index(path, items, count, key_width, generation):
+    """Write an index of items to path, replacing any previous file atomically.
+
+    items yields (codigo, descripcion) sorted by the UTF-8 bytes of codigo
+    (SQLite's BINARY collation order) and must produce exactly count items
+    with keys of at most key_width bytes. The table and the pool are
+    streamed to disk, so memory use does not grow with the master.
+    """
+    if key_width > MAX_KEY_WIDTH:
+        raise ValueError(f"Keys wider than {MAX_KEY_WIDTH} bytes cannot be indexed")
+    key_width = max(key_width, 1)
+    entry_size = key_width + POOL_REF.size
+    pool_start = HEADER.size + count * entry_size
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as table, tempfile.TemporaryFile(dir=directory) as pool:
+            table.write(HEADER.pack(MAGIC, VERSION, key_width, count, generation))
+            offset = pool_start
+            written = 0
+            for codigo, descripcion in items:
+                description = descripcion.encode('utf-8')
+                table.write(codigo.encode('utf-8').ljust(key_width, b'\0'))
+                table.write(POOL_REF.pack(offset, len(description)))
+                pool.write(description)
+                offset += len(description)
+                written += 1
+            if written != count:
+                raise ValueError(f"Expected {count} items, got {written}")
+            pool.seek(0)
+            shutil.copyfileobj(pool, table)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,118 @@
+"""Per-operation latency of DatabaseManager against connect-per-call access.
+
+Usage: python benchmarks/bench_database.py [iterations]
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_manager import DatabaseManager
+
+
+class ConnectPerCallBaseline:
+    """Connection handling as it was before the connection manager"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Reuse the schema, then drop back to the default rollback journal
+        DatabaseManager(db_path).close()
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+
+    def add_record_with_sync(self, codigo_barras, descripcion, cantidad, auditor, locacion, created_by):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            INSERT INTO inventory
+            (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (codigo_barras, descripcion, cantidad, auditor, locacion, str(uuid.uuid4()), created_by))
+        conn.commit()
+        conn.close()
+
+    def get_pending_sync_count(self):
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute('SELECT COUNT(*) FROM inventory WHERE sync_status = 0').fetchone()[0]
+        conn.close()
+        return count
+
+    def get_last_records_with_sync_status(self, limit=50):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute('''
+            SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion, sync_status
+            FROM inventory ORDER BY timestamp DESC LIMIT ?
+        ''', (limit,)).fetchall()
+        conn.close()
+        return rows
+
+    def get_record_by_id(self, record_id):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute('''
+            SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion
+            FROM inventory WHERE id = ?
+        ''', (record_id,)).fetchone()
+        conn.close()
+        return row
+
+
+def time_operation(label, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - start
+    return label, elapsed / iterations * 1e6
+
+
+def run(manager, iterations):
+    results = [
+        time_operation('add_record_with_sync', lambda i: manager.add_record_with_sync(
+            f'750{i:010d}', f'Articulo {i}', 1, 'auditor', 'A-01', 'bench'), iterations),
+        time_operation('get_pending_sync_count', lambda i: manager.get_pending_sync_count(), iterations),
+        time_operation('get_last_records_with_sync_status',
+                       lambda i: manager.get_last_records_with_sync_status(50), iterations),
+        time_operation('get_record_by_id', lambda i: manager.get_record_by_id(i + 1), iterations),
+    ]
+    return results
+
+
+def run_burst(manager, records, batch_size):
+    """Insert a scan burst one row per commit, then group-committed"""
+    start = time.perf_counter()
+    for record in records:
+        manager.add_record_with_sync(**record)
+    single = (time.perf_counter() - start) / len(records) * 1e6
+
+    start = time.perf_counter()
+    for offset in range(0, len(records), batch_size):
+        manager.add_records_bulk(records[offset:offset + batch_size])
+    grouped = (time.perf_counter() - start) / len(records) * 1e6
+    return single, grouped
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = run(ConnectPerCallBaseline(os.path.join(tmp, 'before.db')), iterations)
+        manager = DatabaseManager(os.path.join(tmp, 'after.db'))
+        after = run(manager, iterations)
+        burst = [{'codigo_barras': f'780{i:010d}', 'descripcion': f'Articulo {i}', 'cantidad': 1,
+                  'auditor': 'auditor', 'locacion': 'A-01', 'created_by': 'bench'}
+                 for i in range(iterations)]
+        single, grouped = run_burst(manager, burst, 50)
+        manager.close()
+
+    print(f"{'operation':<36}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for (label, before_us), (_, after_us) in zip(before, after):
+        print(f"{label:<36}{before_us:>14.1f}{after_us:>14.1f}{before_us / after_us:>9.1f}x")
+    print(f"\nscan burst of {iterations}: {single:.1f} us/row one commit per row, "
+          f"{grouped:.1f} us/row group-committed in batches of 50")
+
+
+if __name__ == '__main__':
+    main()
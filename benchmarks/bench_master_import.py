@@ -0,0 +1,75 @@
+"""Master import time: Excel through openpyxl vs. CSV, sequential and across a process pool.
+
+Usage: python benchmarks/bench_master_import.py [rows] [--workers N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_manager import FileManager, CSV_WORKERS
+
+
+def write_files(directory, rows):
+    csv_path = os.path.join(directory, 'master.csv')
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        f.write('codigo;descripcion\r\n')
+        for i in range(rows):
+            f.write(f'{7500000000000 + i};Artículo de prueba {i}\r\n')
+
+    xlsx_path = None
+    try:
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(['codigo', 'descripcion'])
+        for i in range(rows):
+            sheet.append([str(7500000000000 + i), f'Artículo de prueba {i}'])
+        xlsx_path = os.path.join(directory, 'master.xlsx')
+        workbook.save(xlsx_path)
+    except ImportError:
+        print("openpyxl not installed, skipping the Excel path")
+    return csv_path, xlsx_path
+
+
+def timed(label, load, rows):
+    start = time.perf_counter()
+    success, data = load()
+    if success:
+        data = dict(data)
+    elapsed = time.perf_counter() - start
+    assert success and len(data) == rows, data if not success else len(data)
+    print(f"{label:<24}{elapsed:>10.2f}{rows / elapsed:>14,.0f}")
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int, nargs='?', default=1000000)
+    parser.add_argument('--workers', type=int, default=max(CSV_WORKERS, 2))
+    args = parser.parse_args()
+
+    file_manager = FileManager()
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"writing {args.rows} rows...")
+        csv_path, xlsx_path = write_files(tmp, args.rows)
+
+        print(f"{'path':<24}{'seconds':>10}{'rows/s':>14}")
+        if xlsx_path:
+            excel = timed('excel (openpyxl)', lambda: file_manager.load_excel_file(xlsx_path), args.rows)
+        sequential = timed('csv sequential', lambda: file_manager.load_csv_file(csv_path, workers=1), args.rows)
+        parallel = timed(f'csv {args.workers} workers',
+                         lambda: file_manager.load_csv_file(csv_path, workers=args.workers), args.rows)
+
+        # Every path must build the same mapping
+        assert sequential == parallel
+        if xlsx_path:
+            assert excel == sequential
+        print(f"{os.cpu_count()} CPUs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Sync throughput against a local fault-injecting Firebase emulator.
+
+Usage: python benchmarks/bench_sync.py [records] [--latency S] [--drop-rate R]
+                                       [--throttle-rate R] [--write-throttle-rate R]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_manager import DatabaseManager
+from firebase_emulator import FirebaseEmulator
+from firebase_manager import FirebaseManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('records', type=int, nargs='?', default=2000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--write-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-runs', type=int, default=20)
+    args = parser.parse_args()
+
+    emulator = FirebaseEmulator(latency=args.latency, seed=1).start()
+    firebase_manager = FirebaseManager(emulator.config())
+    firebase_manager.create_user('bench', 'bench-password')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DatabaseManager(os.path.join(tmp, 'sync.db'))
+        manager.add_records_bulk([
+            {'codigo_barras': f'750{i:010d}', 'descripcion': f'Articulo {i}', 'cantidad': 1,
+             'auditor': 'auditor', 'locacion': 'A-01', 'created_by': 'bench'}
+            for i in range(args.records)])
+
+        # Faults only apply to the sync itself, not to the setup
+        emulator.drop_rate = args.drop_rate
+        emulator.throttle_rate = args.throttle_rate
+        emulator.write_throttle_rate = args.write_throttle_rate
+
+        runs = 0
+        start = time.perf_counter()
+        while manager.get_pending_sync_count() and runs < args.max_runs:
+            manager.sync_pending_records(firebase_manager)
+            runs += 1
+        elapsed = time.perf_counter() - start
+        pending = manager.get_pending_sync_count()
+        manager.close()
+
+    firebase_manager.close()
+    emulator.stop()
+
+    synced = args.records - pending
+    print(f"synced {synced} of {args.records} records in {elapsed:.2f} s over {runs} runs "
+          f"({synced / elapsed:.0f} records/s)")
+    print(f"emulator: {emulator.stats}")
+    print(f"controller: {firebase_manager.sync_executor.controller.snapshot()}")
+    print(f"connections: {firebase_manager.get_connection_stats()}")
+
+
+if __name__ == '__main__':
+    main()
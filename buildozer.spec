@@ -16,7 +16,10 @@ source.dir = .
 source.include_exts = py,png,jpg,kv,atlas,json,txt,md
 
 # (list) List of directory to exclude (let empty to not exclude anything)
-source.exclude_dirs = tests, bin, .github, __pycache__, .git, .replit, .buildozer, buildozer_env
+source.exclude_dirs = tests, benchmarks, bin, .github, __pycache__, .git, .replit, .buildozer, buildozer_env
+
+# (list) List of exclusions using pattern matching
+source.exclude_patterns = firebase_emulator.py
 
 # (str) Application versioning (method 1)
 version = 1.0
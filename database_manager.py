@@ -1,235 +1,1126 @@
-
 import sqlite3
 import os
+import sys
+import argparse
 import logging
 import json
 import uuid
+import base64
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
 from android_utils import AndroidUtils
+from barcode_index import BarcodeIndex, build_barcode_index, MAX_KEY_WIDTH
+from metrics import REGISTRY
+
+# Seconds a connection waits on a locked database before raising
+BUSY_TIMEOUT = 10.0
+
+# Outbox entries sent per sync request (Firestore's batchWrite limit)
+SYNC_BATCH_SIZE = 500
+
+# Seconds a sync run holds its claim on outbox entries. Longer than a batch
+# request can take, so a live run never loses its entries, and short enough
+# that entries claimed by a run that crashed are retried soon.
+OUTBOX_LEASE_SECONDS = 120
+
+# Rows per page returned by get_records_page
+PAGE_SIZE = 50
+
+# Ids per IN (...) list in get_records_by_ids, under SQLite's variable limit
+ID_LOOKUP_CHUNK = 500
+
+# Rows per statement when staging an imported article master
+MASTER_INSERT_CHUNK = 10000
+
+# Articles added since the master index was built, each found only in
+# SQLite after an index miss, before the index is rebuilt to take them in
+MASTER_INDEX_MAX_UNINDEXED = 1000
+
+DB_OPERATION_SECONDS = REGISTRY.histogram('db_operation_seconds', 'Duration of database operations')
+SYNC_RUN_SECONDS = REGISTRY.histogram('sync_run_seconds', 'Duration of sync runs, by direction')
+PULLED_ROWS = REGISTRY.counter('sync_pulled_rows_total', 'Remote changes applied by pulls')
+OUTBOX_DEPTH = REGISTRY.gauge('sync_outbox_depth', 'Changes waiting in the sync outbox')
+OUTBOX_OLDEST_AGE = REGISTRY.gauge('sync_outbox_oldest_age_seconds', 'Age of the oldest change waiting in the sync outbox')
+
+# Pragmas applied to every connection. In WAL mode synchronous=NORMAL only
+# fsyncs at checkpoints, and readers never wait on the writer. The writer is
+# raised to FULL so a committed scan survives power loss; group commits in
+# WriteBehindQueue keep that to one fsync per batch. Temporary tables and
+# sorts spill to a file, so a large master import's staging is not held in
+# RAM on top of the page cache.
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA mmap_size = 67108864',
+    'PRAGMA temp_store = FILE',
+)
 
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, db_path=None):
         self.android_utils = AndroidUtils()
-        self.db_path = os.path.join(self.android_utils.get_data_directory(), 'inventory.db')
+        self.db_path = db_path or os.path.join(self.android_utils.get_data_directory(), 'inventory.db')
+
+        # One long-lived writer shared by all threads, one reader per thread
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        # Every thread's reader, so close() can reach them all
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self.has_fts = False
+
+        # Memory-mapped master lookups, valid while its generation matches
+        # the database's master_generation
+        self.master_index_path = os.path.join(os.path.dirname(os.path.abspath(self.db_path)), 'master_index.bin')
+        self._master_index = None
+        self._master_index_lock = threading.Lock()
+
         self.init_database()
+        OUTBOX_DEPTH.set_function(self.get_pending_sync_count)
+        OUTBOX_OLDEST_AGE.set_function(self.get_oldest_pending_age)
         logging.info(f"Database initialized at: {self.db_path}")
 
+    def _connect(self):
+        """Open a connection with the shared pragmas applied"""
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT,
+                               isolation_level=None, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _get_writer(self):
+        """Get the shared writer connection, opening it on first use"""
+        if self._writer is None:
+            conn = self._connect()
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = FULL')
+            self._writer = conn
+        return self._writer
+
+    def _reader(self):
+        """Get the read-only connection owned by the calling thread"""
+        conn = getattr(self._local, 'reader', None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute('PRAGMA query_only = ON')
+            self._local.reader = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block inside a write transaction on the writer connection"""
+        with self._write_lock:
+            conn = self._get_writer()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn.cursor()
+                conn.execute('COMMIT')
+            except BaseException:
+                # Also when COMMIT itself fails (e.g. SQLITE_BUSY), which
+                # leaves the transaction open on the persistent writer;
+                # some errors have rolled it back already
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        """Close the writer and every thread's reader, and stop serving metrics.
+
+        Threads still holding the manager reopen connections on next use,
+        so stop them first.
+        """
+        try:
+            OUTBOX_DEPTH.clear_function(self.get_pending_sync_count)
+            OUTBOX_OLDEST_AGE.clear_function(self.get_oldest_pending_age)
+            with self._write_lock:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            with self._readers_lock:
+                readers, self._readers = self._readers, []
+            for reader in readers:
+                reader.close()
+            # Other threads' locals are dropped with the threads themselves
+            self._local = threading.local()
+            self._drop_master_index()
+        except Exception as e:
+            logging.error(f"Error closing database: {e}")
+
     def init_database(self):
         """Initialize database and create tables"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self._transaction() as cursor:
+                # Create inventory table with sync support
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS inventory (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        codigo_barras TEXT NOT NULL,
+                        descripcion TEXT,
+                        cantidad INTEGER NOT NULL,
+                        auditor TEXT,
+                        locacion TEXT,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        local_id TEXT UNIQUE,
+                        firebase_id TEXT,
+                        sync_status INTEGER DEFAULT 0,
+                        created_by TEXT,
+                        last_modified DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
 
-            # Create inventory table with sync support
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS inventory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    codigo_barras TEXT NOT NULL,
-                    descripcion TEXT,
-                    cantidad INTEGER NOT NULL,
-                    auditor TEXT,
-                    locacion TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    local_id TEXT UNIQUE,
-                    firebase_id TEXT,
-                    sync_status INTEGER DEFAULT 0,
-                    created_by TEXT,
-                    last_modified DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                # Create index for better performance
+                # Only unsynced rows are ever looked up by sync status
+                cursor.execute('DROP INDEX IF EXISTS idx_sync_status')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_sync ON inventory(id) WHERE sync_status = 0')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_local_id ON inventory(local_id)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_firebase_id ON inventory(firebase_id)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON inventory(timestamp)')
 
-            # Create index for better performance
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_status ON inventory(sync_status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_local_id ON inventory(local_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_firebase_id ON inventory(firebase_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON inventory(timestamp)')
+                # Create users table for local authentication
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE NOT NULL,
+                        password_hash TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        last_login DATETIME
+                    )
+                ''')
 
-            # Create users table for local authentication
+                # Create audit log table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS audit_log (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        table_name TEXT NOT NULL,
+                        record_id TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        old_values TEXT,
+                        new_values TEXT,
+                        user_id TEXT,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # Key/value sync bookkeeping, such as the pull watermark
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS sync_state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # Article master: description of every known barcode. Keyed
+                # on the code itself, so a lookup or upsert is one B-tree probe
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS master_items (
+                        codigo TEXT PRIMARY KEY,
+                        descripcion TEXT NOT NULL,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    ) WITHOUT ROWID
+                ''')
+
+                self.has_fts = self._init_search_index(cursor)
+                self._init_statistics(cursor)
+                self._init_rollup(cursor)
+                self._init_outbox(cursor)
+
+            logging.info("Database tables created successfully")
+
+        except Exception as e:
+            logging.error(f"Error initializing database: {e}")
+            raise
+
+    def _init_search_index(self, cursor):
+        """Create the FTS5 trigram index over the searchable inventory columns"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inventory_fts'")
+        exists = cursor.fetchone() is not None
+
+        try:
+            # External content table: the text lives in inventory, the index
+            # only stores trigrams keyed by inventory.id
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_login DATETIME
+                CREATE VIRTUAL TABLE IF NOT EXISTS inventory_fts USING fts5(
+                    codigo_barras, descripcion, auditor, locacion,
+                    content='inventory', content_rowid='id', tokenize='trigram'
                 )
             ''')
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5 trigram index not available, search will scan: {e}")
+            return False
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_fts_insert AFTER INSERT ON inventory BEGIN
+                INSERT INTO inventory_fts(rowid, codigo_barras, descripcion, auditor, locacion)
+                VALUES (new.id, new.codigo_barras, new.descripcion, new.auditor, new.locacion);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_fts_delete AFTER DELETE ON inventory BEGIN
+                INSERT INTO inventory_fts(inventory_fts, rowid, codigo_barras, descripcion, auditor, locacion)
+                VALUES ('delete', old.id, old.codigo_barras, old.descripcion, old.auditor, old.locacion);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_fts_update
+            AFTER UPDATE OF codigo_barras, descripcion, auditor, locacion ON inventory BEGIN
+                INSERT INTO inventory_fts(inventory_fts, rowid, codigo_barras, descripcion, auditor, locacion)
+                VALUES ('delete', old.id, old.codigo_barras, old.descripcion, old.auditor, old.locacion);
+                INSERT INTO inventory_fts(rowid, codigo_barras, descripcion, auditor, locacion)
+                VALUES (new.id, new.codigo_barras, new.descripcion, new.auditor, new.locacion);
+            END
+        ''')
 
-            # Create audit log table
+        if not exists:
+            # Backfill databases created before the index existed
+            cursor.execute("INSERT INTO inventory_fts(inventory_fts) VALUES ('rebuild')")
+            logging.info("Search index built from existing inventory records")
+
+        return True
+
+    def rebuild_search_index(self):
+        """Rebuild the full-text search index from the inventory table"""
+        try:
+            if not self.has_fts:
+                return False
+
+            with self._transaction() as cursor:
+                cursor.execute("INSERT INTO inventory_fts(inventory_fts) VALUES ('rebuild')")
+
+            logging.info("Search index rebuilt")
+            return True
+
+        except Exception as e:
+            logging.error(f"Error rebuilding search index: {e}")
+            return False
+
+    def _init_statistics(self, cursor):
+        """Create the trigger-maintained statistics tables"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_records INTEGER NOT NULL DEFAULT 0,
+                total_quantity INTEGER NOT NULL DEFAULT 0,
+                unique_products INTEGER NOT NULL DEFAULT 0,
+                last_record_date DATETIME
+            )
+        ''')
+
+        # Records per barcode, so the distinct count moves only when a
+        # barcode appears for the first time or loses its last record
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_barcodes (
+                codigo_barras TEXT PRIMARY KEY,
+                record_count INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_stats_insert AFTER INSERT ON inventory BEGIN
+                INSERT INTO inventory_barcodes(codigo_barras, record_count) VALUES (new.codigo_barras, 1)
+                    ON CONFLICT(codigo_barras) DO UPDATE SET record_count = record_count + 1;
+                UPDATE inventory_stats SET
+                    total_records = total_records + 1,
+                    total_quantity = total_quantity + new.cantidad,
+                    unique_products = unique_products + (
+                        SELECT record_count = 1 FROM inventory_barcodes WHERE codigo_barras = new.codigo_barras),
+                    last_record_date = CASE
+                        WHEN last_record_date IS NULL OR new.timestamp > last_record_date THEN new.timestamp
+                        ELSE last_record_date END
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_stats_delete AFTER DELETE ON inventory BEGIN
+                UPDATE inventory_barcodes SET record_count = record_count - 1
+                WHERE codigo_barras = old.codigo_barras;
+                UPDATE inventory_stats SET
+                    total_records = total_records - 1,
+                    total_quantity = total_quantity - old.cantidad,
+                    unique_products = unique_products - (
+                        SELECT COUNT(*) FROM inventory_barcodes
+                        WHERE codigo_barras = old.codigo_barras AND record_count <= 0),
+                    last_record_date = (SELECT MAX(timestamp) FROM inventory)
+                WHERE id = 1;
+                DELETE FROM inventory_barcodes WHERE codigo_barras = old.codigo_barras AND record_count <= 0;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_stats_update
+            AFTER UPDATE OF codigo_barras, cantidad, timestamp ON inventory BEGIN
+                UPDATE inventory_barcodes SET record_count = record_count - 1
+                WHERE codigo_barras = old.codigo_barras;
+                UPDATE inventory_stats SET unique_products = unique_products - (
+                    SELECT COUNT(*) FROM inventory_barcodes
+                    WHERE codigo_barras = old.codigo_barras AND record_count <= 0)
+                WHERE id = 1;
+                DELETE FROM inventory_barcodes WHERE codigo_barras = old.codigo_barras AND record_count <= 0;
+                INSERT INTO inventory_barcodes(codigo_barras, record_count) VALUES (new.codigo_barras, 1)
+                    ON CONFLICT(codigo_barras) DO UPDATE SET record_count = record_count + 1;
+                UPDATE inventory_stats SET
+                    total_quantity = total_quantity - old.cantidad + new.cantidad,
+                    unique_products = unique_products + (
+                        SELECT record_count = 1 FROM inventory_barcodes WHERE codigo_barras = new.codigo_barras),
+                    last_record_date = (SELECT MAX(timestamp) FROM inventory)
+                WHERE id = 1;
+            END
+        ''')
+
+        cursor.execute('SELECT 1 FROM inventory_stats WHERE id = 1')
+        if cursor.fetchone() is None:
+            # First run on this database: seed from the existing records
+            self._rebuild_statistics(cursor)
+            logging.info("Statistics tables built from existing inventory records")
+
+    def _init_rollup(self, cursor):
+        """Create the per-barcode, per-location count rollup"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inventory_rollup'")
+        exists = cursor.fetchone() is not None
+
+        # Locations are stored as '' when missing so they can be part of the key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_rollup (
+                codigo_barras TEXT NOT NULL,
+                locacion TEXT NOT NULL,
+                total_quantity INTEGER NOT NULL,
+                record_count INTEGER NOT NULL,
+                PRIMARY KEY (codigo_barras, locacion)
+            ) WITHOUT ROWID
+        ''')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_rollup_insert AFTER INSERT ON inventory BEGIN
+                INSERT INTO inventory_rollup(codigo_barras, locacion, total_quantity, record_count)
+                VALUES (new.codigo_barras, COALESCE(new.locacion, ''), new.cantidad, 1)
+                    ON CONFLICT(codigo_barras, locacion) DO UPDATE SET
+                        total_quantity = total_quantity + excluded.total_quantity,
+                        record_count = record_count + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_rollup_delete AFTER DELETE ON inventory BEGIN
+                UPDATE inventory_rollup SET
+                    total_quantity = total_quantity - old.cantidad,
+                    record_count = record_count - 1
+                WHERE codigo_barras = old.codigo_barras AND locacion = COALESCE(old.locacion, '');
+                DELETE FROM inventory_rollup
+                WHERE codigo_barras = old.codigo_barras AND locacion = COALESCE(old.locacion, '')
+                  AND record_count <= 0;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS inventory_rollup_update
+            AFTER UPDATE OF codigo_barras, cantidad, locacion ON inventory BEGIN
+                UPDATE inventory_rollup SET
+                    total_quantity = total_quantity - old.cantidad,
+                    record_count = record_count - 1
+                WHERE codigo_barras = old.codigo_barras AND locacion = COALESCE(old.locacion, '');
+                DELETE FROM inventory_rollup
+                WHERE codigo_barras = old.codigo_barras AND locacion = COALESCE(old.locacion, '')
+                  AND record_count <= 0;
+                INSERT INTO inventory_rollup(codigo_barras, locacion, total_quantity, record_count)
+                VALUES (new.codigo_barras, COALESCE(new.locacion, ''), new.cantidad, 1)
+                    ON CONFLICT(codigo_barras, locacion) DO UPDATE SET
+                        total_quantity = total_quantity + excluded.total_quantity,
+                        record_count = record_count + 1;
+            END
+        ''')
+
+        if not exists:
+            # Backfill databases created before the rollup existed
+            self._rebuild_rollup(cursor)
+            logging.info("Count rollup built from existing inventory records")
+
+    def _rebuild_rollup(self, cursor):
+        """Rewrite the count rollup from a full aggregate"""
+        cursor.execute('DELETE FROM inventory_rollup')
+        cursor.execute('''
+            INSERT INTO inventory_rollup(codigo_barras, locacion, total_quantity, record_count)
+            SELECT codigo_barras, COALESCE(locacion, ''), SUM(cantidad), COUNT(*)
+            FROM inventory GROUP BY codigo_barras, COALESCE(locacion, '')
+        ''')
+
+    def _init_outbox(self, cursor):
+        """Create the change outbox drained by the sync engine"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_outbox'")
+        exists = cursor.fetchone() is not None
+
+        # One entry per record with unsynced changes. Every change replaces
+        # the record's previous entry with a new sequence number, so a sync
+        # that uploaded an older state can tell it is no longer current.
+        # created_at is carried over from the entry replaced: it is when the
+        # record first started waiting, not when it last changed.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL CHECK (op IN ('insert', 'update', 'delete')),
+                local_id TEXT NOT NULL,
+                firebase_id TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                lease_owner TEXT,
+                lease_expires REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_local_id ON sync_outbox(local_id)')
+
+        # Outboxes created before leasing existed
+        cursor.execute('PRAGMA table_info(sync_outbox)')
+        columns = {row[1] for row in cursor.fetchall()}
+        if 'lease_owner' not in columns:
+            cursor.execute('ALTER TABLE sync_outbox ADD COLUMN lease_owner TEXT')
+        if 'lease_expires' not in columns:
+            cursor.execute('ALTER TABLE sync_outbox ADD COLUMN lease_expires REAL')
+
+        # Rows arriving already synced (sync_status = 1) are not queued, and
+        # marking a row as synced does not queue it again
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS sync_outbox_insert AFTER INSERT ON inventory
+            WHEN new.sync_status = 0 AND new.local_id IS NOT NULL BEGIN
+                INSERT INTO sync_outbox(op, local_id) VALUES ('insert', new.local_id);
+            END
+        ''')
+        # Recreated so databases from before created_at was carried over
+        # get the current definitions
+        cursor.execute('DROP TRIGGER IF EXISTS sync_outbox_update')
+        cursor.execute('DROP TRIGGER IF EXISTS sync_outbox_delete')
+        cursor.execute('''
+            CREATE TRIGGER sync_outbox_update AFTER UPDATE ON inventory
+            WHEN new.sync_status = 0 AND new.local_id IS NOT NULL BEGIN
+                INSERT INTO sync_outbox(op, local_id, created_at) VALUES (
+                    CASE WHEN EXISTS (SELECT 1 FROM sync_outbox WHERE local_id = new.local_id AND op = 'insert')
+                         THEN 'insert' ELSE 'update' END,
+                    new.local_id,
+                    COALESCE((SELECT MIN(created_at) FROM sync_outbox WHERE local_id = new.local_id),
+                             CURRENT_TIMESTAMP));
+                DELETE FROM sync_outbox WHERE local_id = new.local_id AND seq < last_insert_rowid();
+            END
+        ''')
+        # A record whose only entry is an insert no run holds was never
+        # uploaded: its entry is dropped and no delete is queued. Anything
+        # else may exist remotely and is deleted there. Whether a delete was
+        # queued, the newest entry is kept and the ones before it dropped;
+        # then a leftover insert is the never-uploaded case.
+        cursor.execute('''
+            CREATE TRIGGER sync_outbox_delete AFTER DELETE ON inventory
+            WHEN old.local_id IS NOT NULL BEGIN
+                INSERT INTO sync_outbox(op, local_id, firebase_id, created_at)
+                SELECT 'delete', old.local_id, old.firebase_id,
+                       COALESCE((SELECT MIN(created_at) FROM sync_outbox WHERE local_id = old.local_id),
+                                CURRENT_TIMESTAMP)
+                WHERE old.firebase_id IS NOT NULL OR NOT EXISTS (
+                    SELECT 1 FROM sync_outbox
+                    WHERE local_id = old.local_id AND op = 'insert' AND lease_owner IS NULL);
+                DELETE FROM sync_outbox WHERE local_id = old.local_id
+                  AND seq < (SELECT MAX(seq) FROM sync_outbox WHERE local_id = old.local_id);
+                DELETE FROM sync_outbox WHERE local_id = old.local_id AND op != 'delete';
+            END
+        ''')
+
+        if not exists:
+            # Queue whatever was pending before the outbox existed
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS audit_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    table_name TEXT NOT NULL,
-                    record_id TEXT NOT NULL,
-                    action TEXT NOT NULL,
-                    old_values TEXT,
-                    new_values TEXT,
-                    user_id TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
+                INSERT INTO sync_outbox(op, local_id)
+                SELECT 'insert', local_id FROM inventory
+                WHERE sync_status = 0 AND local_id IS NOT NULL
+                ORDER BY id
             ''')
+            logging.info(f"Sync outbox seeded with {cursor.rowcount} pending records")
 
-            conn.commit()
-            conn.close()
-            logging.info("Database tables created successfully")
+    def _compute_statistics(self, cursor):
+        """Aggregate the statistics directly from the inventory table"""
+        cursor.execute('''
+            SELECT COUNT(*), COALESCE(SUM(cantidad), 0), COUNT(DISTINCT codigo_barras), MAX(timestamp)
+            FROM inventory
+        ''')
+        total_records, total_quantity, unique_products, last_record_date = cursor.fetchone()
+        return {
+            'total_records': total_records,
+            'total_quantity': total_quantity,
+            'unique_products': unique_products,
+            'last_record_date': last_record_date
+        }
+
+    def _rebuild_statistics(self, cursor):
+        """Rewrite the statistics tables from a full aggregate"""
+        stats = self._compute_statistics(cursor)
+
+        cursor.execute('DELETE FROM inventory_barcodes')
+        cursor.execute('''
+            INSERT INTO inventory_barcodes(codigo_barras, record_count)
+            SELECT codigo_barras, COUNT(*) FROM inventory GROUP BY codigo_barras
+        ''')
+        cursor.execute('''
+            INSERT OR REPLACE INTO inventory_stats
+            (id, total_records, total_quantity, unique_products, last_record_date)
+            VALUES (1, ?, ?, ?, ?)
+        ''', (stats['total_records'], stats['total_quantity'],
+              stats['unique_products'], stats['last_record_date']))
+        return stats
+
+    def rebuild_statistics(self, repair=True):
+        """Verify the materialized statistics against the inventory table.
+
+        Returns a dict of the fields that drifted as {name: (stored, actual)};
+        with repair=True the statistics tables are rebuilt when anything drifted.
+        """
+        try:
+            with self._transaction() as cursor:
+                stored = self._read_statistics(cursor)
+                actual = self._compute_statistics(cursor)
+                drift = {key: (stored.get(key), value) for key, value in actual.items()
+                         if stored.get(key) != value}
+
+                cursor.execute('''
+                    SELECT COUNT(*) FROM (
+                        SELECT codigo_barras, COUNT(*) AS record_count FROM inventory GROUP BY codigo_barras
+                        EXCEPT
+                        SELECT codigo_barras, record_count FROM inventory_barcodes
+                    )
+                ''')
+                stale_barcodes = cursor.fetchone()[0]
+                if stale_barcodes:
+                    drift['barcode_counts'] = (stale_barcodes, 0)
+
+                cursor.execute('''
+                    SELECT COUNT(*) FROM (
+                        SELECT codigo_barras, COALESCE(locacion, ''), SUM(cantidad), COUNT(*)
+                        FROM inventory GROUP BY codigo_barras, COALESCE(locacion, '')
+                        EXCEPT
+                        SELECT codigo_barras, locacion, total_quantity, record_count FROM inventory_rollup
+                    )
+                ''')
+                stale_rollup = cursor.fetchone()[0]
+                if stale_rollup:
+                    drift['location_counts'] = (stale_rollup, 0)
+
+                if drift and repair:
+                    self._rebuild_statistics(cursor)
+                    self._rebuild_rollup(cursor)
+
+            if drift:
+                logging.warning(f"Statistics drift detected: {drift}")
+            return drift
 
         except Exception as e:
-            logging.error(f"Error initializing database: {e}")
-            raise
+            logging.error(f"Error rebuilding statistics: {e}")
+            return None
+
+    def _read_statistics(self, cursor):
+        """Read the materialized statistics row"""
+        cursor.execute('''
+            SELECT total_records, total_quantity, unique_products, last_record_date
+            FROM inventory_stats WHERE id = 1
+        ''')
+        row = cursor.fetchone() or (0, 0, 0, None)
+        return {
+            'total_records': row[0],
+            'total_quantity': row[1],
+            'unique_products': row[2],
+            'last_record_date': row[3]
+        }
 
+    @DB_OPERATION_SECONDS.time(operation='add_record')
     def add_record_with_sync(self, codigo_barras, descripcion, cantidad, auditor, locacion, created_by):
         """Add inventory record with sync support"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             local_id = str(uuid.uuid4())
-            
-            cursor.execute('''
-                INSERT INTO inventory 
-                (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by))
-            
-            conn.commit()
-            conn.close()
-            
+
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO inventory
+                    (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by))
+
             logging.info(f"Record added with local_id: {local_id}")
             return True
-            
+
         except Exception as e:
             logging.error(f"Error adding record: {e}")
             return False
 
+    @DB_OPERATION_SECONDS.time(operation='add_records_bulk')
+    def add_records_bulk(self, records):
+        """Add several inventory records in a single transaction"""
+        try:
+            rows = [
+                (record['codigo_barras'], record.get('descripcion'), record['cantidad'],
+                 record.get('auditor'), record.get('locacion'), str(uuid.uuid4()),
+                 record.get('created_by'))
+                for record in records
+            ]
+            if not rows:
+                return 0
+
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT INTO inventory
+                    (codigo_barras, descripcion, cantidad, auditor, locacion, local_id, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+
+            logging.info(f"Bulk added {len(rows)} records")
+            return len(rows)
+
+        except Exception as e:
+            logging.error(f"Error adding records in bulk: {e}")
+            return 0
+
     def get_last_records_with_sync_status(self, limit=50):
         """Get last records with sync status"""
+        records, _ = self.get_records_page(page_size=limit)
+        return records
+
+    @staticmethod
+    def _encode_page_cursor(timestamp, record_id):
+        """Pack a (timestamp, id) position into an opaque cursor string"""
+        raw = json.dumps([timestamp, record_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def _decode_page_cursor(cursor):
+        """Unpack a cursor produced by _encode_page_cursor"""
+        timestamp, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return timestamp, record_id
+
+    def _select_records(self, conditions, params, search_text, limit):
+        """Rows matching conditions and search_text, newest first, with their timestamp last"""
+        db_cursor = self._reader().cursor()
+        source = 'inventory i'
+
+        search_text = (search_text or '').strip()
+        if search_text:
+            # Trigrams need at least three characters; shorter terms scan
+            if self.has_fts and len(search_text) >= 3:
+                # Quoted as a single phrase so the text matches as a substring
+                source = 'inventory_fts JOIN inventory i ON i.id = inventory_fts.rowid'
+                conditions = conditions + ['inventory_fts MATCH ?']
+                params = params + ['"' + search_text.replace('"', '""') + '"']
+            else:
+                conditions = conditions + ['(i.codigo_barras LIKE ? OR i.descripcion LIKE ? '
+                                           'OR i.auditor LIKE ? OR i.locacion LIKE ?)']
+                params = params + [f'%{search_text}%'] * 4
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        db_cursor.execute(f'''
+            SELECT i.id, i.codigo_barras, i.descripcion, i.cantidad, i.auditor, i.locacion,
+                   i.sync_status, i.timestamp
+            FROM {source}
+            {where}
+            ORDER BY i.timestamp DESC, i.id DESC
+            LIMIT ?
+        ''', params + [limit])
+        return db_cursor.fetchall()
+
+    @DB_OPERATION_SECONDS.time(operation='get_records_page')
+    def get_records_page(self, cursor=None, page_size=PAGE_SIZE, search_text=None):
+        """Get one page of records, newest first, and the cursor for the next page.
+
+        Pages are keyed on (timestamp, id) rather than an offset, so every page
+        is an index range scan no matter how deep into the history it is.
+        Returns (records, next_cursor); next_cursor is None on the last page.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion, sync_status
-                FROM inventory 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (limit,))
-            
-            records = cursor.fetchall()
-            conn.close()
-            
+            conditions = []
+            params = []
+            if cursor:
+                conditions.append('(i.timestamp, i.id) < (?, ?)')
+                params.extend(self._decode_page_cursor(cursor))
+
+            # One extra row tells us whether another page exists
+            rows = self._select_records(conditions, params, search_text, page_size + 1)
+            next_cursor = None
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_cursor = self._encode_page_cursor(rows[-1][7], rows[-1][0])
+
+            return [row[:7] for row in rows], next_cursor
+
+        except Exception as e:
+            logging.error(f"Error getting records page: {e}")
+            return [], None
+
+    @DB_OPERATION_SECONDS.time(operation='get_newer_records')
+    def get_newer_records(self, record_id, search_text=None, limit=PAGE_SIZE):
+        """Get the records that sort above record_id, newest first, as get_records_page does.
+
+        Lets a table that is already showing record_id at its top add what
+        arrived since without reloading its pages. Returns None when there
+        are more than limit such records or record_id no longer exists, and
+        the table is better reloaded.
+        """
+        try:
+            cursor = self._reader().cursor()
+            cursor.execute('SELECT timestamp, id FROM inventory WHERE id = ?', (record_id,))
+            anchor = cursor.fetchone()
+            if anchor is None:
+                return None
+
+            rows = self._select_records(['(i.timestamp, i.id) > (?, ?)'], list(anchor), search_text, limit + 1)
+            if len(rows) > limit:
+                return None
+            return [row[:7] for row in rows]
+
+        except Exception as e:
+            logging.error(f"Error getting newer records: {e}")
+            return None
+
+    def get_records_by_ids(self, record_ids):
+        """Get the records with the given ids, in table-row form, keyed by id"""
+        try:
+            cursor = self._reader().cursor()
+            record_ids = list(record_ids)
+            records = {}
+            for start in range(0, len(record_ids), ID_LOOKUP_CHUNK):
+                chunk = record_ids[start:start + ID_LOOKUP_CHUNK]
+                cursor.execute(f'''
+                    SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion, sync_status
+                    FROM inventory WHERE id IN ({', '.join('?' * len(chunk))})
+                ''', chunk)
+                records.update((row[0], row) for row in cursor.fetchall())
             return records
-            
+
         except Exception as e:
-            logging.error(f"Error getting records: {e}")
-            return []
+            logging.error(f"Error getting records by id: {e}")
+            return {}
 
     def get_pending_sync_count(self):
         """Get count of pending sync records"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT COUNT(*) FROM inventory WHERE sync_status = 0')
-            count = cursor.fetchone()[0]
-            
-            conn.close()
-            return count
-            
+            cursor = self._reader().cursor()
+
+            cursor.execute('SELECT COUNT(*) FROM sync_outbox')
+            return cursor.fetchone()[0]
+
         except Exception as e:
             logging.error(f"Error getting pending sync count: {e}")
             return 0
 
+    def get_oldest_pending_age(self):
+        """Seconds the longest-waiting record has been in the outbox, 0 when it is empty.
+
+        Counted from the record's first unsynced change; later edits
+        replace its entry but keep that time.
+        """
+        try:
+            cursor = self._reader().cursor()
+
+            cursor.execute("SELECT strftime('%s', 'now') - strftime('%s', MIN(created_at)) FROM sync_outbox")
+            return cursor.fetchone()[0] or 0
+
+        except Exception as e:
+            logging.error(f"Error getting oldest pending age: {e}")
+            return 0
+
+    def write_metrics_snapshot(self):
+        """Write the metrics registry next to the database for fleet tooling to collect"""
+        return REGISTRY.write_snapshot(os.path.dirname(os.path.abspath(self.db_path)))
+
+    @SYNC_RUN_SECONDS.time(direction='push')
     def sync_pending_records(self, firebase_manager):
-        """Sync pending records with Firebase"""
+        """Sync pending records with Firebase, draining the outbox in sequence order.
+
+        Batches are sized and sent concurrently by the firebase manager's
+        SyncExecutor; each is uploaded outside of any transaction so the
+        writer is never held for the duration of a network call. Entries are
+        leased to this run while they are in flight, so an overlapping run
+        skips them and a run that dies leaves them to be retried once the
+        lease expires.
+        """
+        if not firebase_manager:
+            return 0
+
+        lease_owner = uuid.uuid4().hex
         try:
-            if not firebase_manager:
-                return 0
-                
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Get pending records
-            cursor.execute('''
-                SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion, 
-                       timestamp, local_id, created_by
-                FROM inventory 
-                WHERE sync_status = 0
-                LIMIT 10
-            ''')
-            
-            pending_records = cursor.fetchall()
-            success_count = 0
-            
-            for record in pending_records:
-                record_data = {
-                    'codigo_barras': record[1],
-                    'descripcion': record[2],
-                    'cantidad': record[3],
-                    'auditor': record[4],
-                    'locacion': record[5],
-                    'timestamp': record[6],
-                    'local_id': record[7],
-                    'created_by': record[8]
-                }
-                
-                success, message = firebase_manager.sync_record(record_data)
-                
-                if success:
-                    # Mark as synced
-                    cursor.execute('''
-                        UPDATE inventory 
-                        SET sync_status = 1, last_modified = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (record[0],))
-                    success_count += 1
-            
-            conn.commit()
-            conn.close()
-            
-            return success_count
-            
+            last_seq = 0
+
+            def next_batch(size):
+                nonlocal last_seq
+                while True:
+                    batch, stale, last_seq, more = self._read_outbox_batch(
+                        last_seq, min(size, SYNC_BATCH_SIZE), lease_owner)
+                    if stale:
+                        self._complete_outbox_entries(stale)
+                    if batch or not more:
+                        return batch
+
+            def send_batch(batch):
+                return firebase_manager.sync_changes_batch([change for _, change in batch])
+
+            def on_result(batch, results):
+                completed = []
+                failed = []
+                for (entry, change), (success, message) in zip(batch, results):
+                    seq, local_id = entry
+                    if success:
+                        completed.append((seq, local_id, change['document_id']))
+                    else:
+                        failed.append(seq)
+                        logging.warning(f"Failed to sync {change['op']} of {local_id}: {message}")
+                if completed:
+                    self._complete_outbox_entries(completed)
+                if failed:
+                    self._release_outbox_leases(lease_owner, failed)
+                return len(completed)
+
+            return firebase_manager.sync_executor.run(next_batch, send_batch, on_result)
+
         except Exception as e:
             logging.error(f"Error syncing pending records: {e}")
             return 0
 
+        finally:
+            # Hand back whatever this run claimed but did not finish
+            try:
+                self._release_outbox_leases(lease_owner)
+            except Exception as e:
+                logging.error(f"Error releasing outbox leases: {e}")
+
+    def get_sync_state(self, key, default=None):
+        """Get a JSON value stored in sync_state"""
+        try:
+            cursor = self._reader().cursor()
+            cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            return json.loads(row[0]) if row else default
+        except Exception as e:
+            logging.error(f"Error reading sync state {key}: {e}")
+            return default
+
+    def _set_sync_state(self, cursor, key, value):
+        """Store a JSON value in sync_state within the caller's transaction"""
+        cursor.execute('''
+            INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        ''', (key, json.dumps(value)))
+
+    def _upsert_remote_records(self, cursor, records):
+        """Insert or update pulled records by local_id within the caller's transaction.
+
+        Rows are marked as synced, so they are not queued for upload.
+        Records with local changes still in the outbox, including local
+        deletes, are left alone, and unchanged rows are not rewritten.
+        """
+        rows = [
+            (record['codigo_barras'], record.get('descripcion'), record.get('cantidad', 0),
+             record.get('auditor'), record.get('locacion'), record.get('timestamp'),
+             record['local_id'], record.get('firebase_id'),
+             record.get('created_by') or record.get('user_id'), record['local_id'])
+            for record in records
+        ]
+        cursor.executemany('''
+            INSERT INTO inventory
+            (codigo_barras, descripcion, cantidad, auditor, locacion, timestamp,
+             local_id, firebase_id, sync_status, created_by)
+            SELECT ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, 1, ?
+            WHERE NOT EXISTS (SELECT 1 FROM sync_outbox WHERE local_id = ?)
+            ON CONFLICT(local_id) DO UPDATE SET
+                codigo_barras = excluded.codigo_barras,
+                descripcion = excluded.descripcion,
+                cantidad = excluded.cantidad,
+                auditor = excluded.auditor,
+                locacion = excluded.locacion,
+                timestamp = excluded.timestamp,
+                firebase_id = excluded.firebase_id,
+                last_modified = CURRENT_TIMESTAMP
+            WHERE inventory.sync_status = 1 AND (
+                inventory.codigo_barras IS NOT excluded.codigo_barras
+                OR inventory.descripcion IS NOT excluded.descripcion
+                OR inventory.cantidad IS NOT excluded.cantidad
+                OR inventory.auditor IS NOT excluded.auditor
+                OR inventory.locacion IS NOT excluded.locacion
+                OR inventory.timestamp IS NOT excluded.timestamp
+                OR inventory.firebase_id IS NOT excluded.firebase_id)
+        ''', rows)
+        return cursor.rowcount
+
+    @SYNC_RUN_SECONDS.time(direction='pull')
+    def pull_remote_updates(self, firebase_manager):
+        """Pull documents uploaded or deleted since the stored watermarks, page by page.
+
+        Uploads are followed by their server-set updated_at, so edits and
+        scans uploaded late by an offline device are pulled too; deletes
+        arrive as tombstones with a watermark of their own. Each page is
+        applied and its watermark saved in one transaction before the next
+        page is requested, so memory stays bounded by the page size and an
+        interrupted pull resumes where it stopped. Returns the number of
+        rows inserted, changed or deleted.
+        """
+        if not firebase_manager:
+            return 0
+
+        applied = 0
+        try:
+            watermark = self.get_sync_state('pull_updated_watermark')
+            for updates, watermark in firebase_manager.fetch_updates(watermark):
+                with self._transaction() as cursor:
+                    applied += self._upsert_remote_records(cursor, updates)
+                    self._set_sync_state(cursor, 'pull_updated_watermark', list(watermark))
+
+            watermark = self.get_sync_state('pull_delete_watermark')
+            for deletes, watermark in firebase_manager.fetch_deletes(watermark):
+                with self._transaction() as cursor:
+                    applied += self._apply_remote_deletes(cursor, deletes)
+                    self._set_sync_state(cursor, 'pull_delete_watermark', list(watermark))
+            if applied:
+                PULLED_ROWS.inc(applied)
+                logging.info(f"Applied {applied} remote updates")
+        except Exception as e:
+            logging.error(f"Error pulling remote updates: {e}")
+        return applied
+
+    def _apply_remote_deletes(self, cursor, deletes):
+        """Delete the rows of pulled tombstones, given as (local_id, firebase_id) pairs.
+
+        Rows with local changes still in the outbox are left alone. The
+        delete trigger queues an upload of each delete; those entries are
+        dropped again, as the delete came from Firebase. Returns the number
+        of rows deleted.
+        """
+        deleted = 0
+        for local_id, firebase_id in deletes:
+            cursor.execute('''
+                SELECT local_id FROM inventory
+                WHERE (local_id = ? OR firebase_id = ?)
+                  AND NOT EXISTS (SELECT 1 FROM sync_outbox o WHERE o.local_id = inventory.local_id)
+            ''', (local_id, firebase_id))
+            for (row_local_id,) in cursor.fetchall():
+                cursor.execute('DELETE FROM inventory WHERE local_id = ?', (row_local_id,))
+                cursor.execute('DELETE FROM sync_outbox WHERE local_id = ?', (row_local_id,))
+                deleted += 1
+        return deleted
+
+    @DB_OPERATION_SECONDS.time(operation='outbox_read')
+    def _read_outbox_batch(self, after_seq, limit, lease_owner):
+        """Lease the next outbox entries after after_seq and read them as sync changes.
+
+        Entries leased by another run are skipped until their lease expires.
+        Returns (batch, stale, last_seq, more): batch is a list of
+        ((seq, local_id), change), stale lists entries whose record is gone
+        without a delete entry, and more tells whether the read hit limit.
+        """
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.execute('''
+                UPDATE sync_outbox SET lease_owner = ?, lease_expires = ?
+                WHERE seq IN (
+                    SELECT seq FROM sync_outbox
+                    WHERE seq > ? AND (lease_expires IS NULL OR lease_expires < ?)
+                    ORDER BY seq
+                    LIMIT ?
+                )
+            ''', (lease_owner, now + OUTBOX_LEASE_SECONDS, after_seq, now, limit))
+
+            # The leased changes with the current state of their records
+            cursor.execute('''
+                SELECT o.seq, o.op, o.local_id, o.firebase_id,
+                       i.codigo_barras, i.descripcion, i.cantidad, i.auditor, i.locacion,
+                       i.timestamp, i.created_by
+                FROM sync_outbox o
+                LEFT JOIN inventory i ON i.local_id = o.local_id
+                WHERE o.seq > ? AND o.lease_owner = ?
+                ORDER BY o.seq
+            ''', (after_seq, lease_owner))
+            rows = cursor.fetchall()
+
+        batch = []
+        stale = []
+        for row in rows:
+            seq, op, local_id, firebase_id = row[:4]
+
+            if op == 'delete':
+                # Documents are named after local_id unless an older upload
+                # recorded a different id
+                change = {'op': op, 'document_id': firebase_id or local_id, 'local_id': local_id}
+            elif row[4] is None:
+                stale.append((seq, local_id, None))
+                continue
+            else:
+                change = {'op': op, 'document_id': local_id, 'record': {
+                    'codigo_barras': row[4],
+                    'descripcion': row[5],
+                    'cantidad': row[6],
+                    'auditor': row[7],
+                    'locacion': row[8],
+                    'timestamp': row[9],
+                    'local_id': local_id,
+                    'created_by': row[10]
+                }}
+            batch.append(((seq, local_id), change))
+
+        last_seq = rows[-1][0] if rows else after_seq
+        return batch, stale, last_seq, len(rows) == limit
+
+    @DB_OPERATION_SECONDS.time(operation='outbox_release')
+    def _release_outbox_leases(self, lease_owner, seqs=None):
+        """Give up a run's lease on the given outbox entries, or on all of them"""
+        with self._transaction() as cursor:
+            if seqs is None:
+                cursor.execute('''
+                    UPDATE sync_outbox SET lease_owner = NULL, lease_expires = NULL
+                    WHERE lease_owner = ?
+                ''', (lease_owner,))
+            else:
+                cursor.executemany('''
+                    UPDATE sync_outbox SET lease_owner = NULL, lease_expires = NULL
+                    WHERE seq = ? AND lease_owner = ?
+                ''', [(seq, lease_owner) for seq in seqs])
+
+    @DB_OPERATION_SECONDS.time(operation='outbox_complete')
+    def _complete_outbox_entries(self, completed):
+        """Remove synced outbox entries and mark their records as synced.
+
+        completed is a list of (seq, local_id, firebase_id). A record is only
+        marked as synced, and its Firestore document id stored, when no newer
+        change for it was queued while it was uploading.
+        """
+        with self._transaction() as cursor:
+            cursor.executemany('DELETE FROM sync_outbox WHERE seq = ?',
+                               [(seq,) for seq, _, _ in completed])
+            cursor.executemany('''
+                UPDATE inventory
+                SET sync_status = 1, firebase_id = COALESCE(?, firebase_id),
+                    last_modified = CURRENT_TIMESTAMP
+                WHERE local_id = ? AND sync_status = 0
+                  AND NOT EXISTS (SELECT 1 FROM sync_outbox WHERE local_id = ?)
+            ''', [(firebase_id, local_id, local_id) for _, local_id, firebase_id in completed])
+
+    @DB_OPERATION_SECONDS.time(operation='update_record')
     def update_record(self, record_id, codigo_barras, descripcion, cantidad, auditor, locacion):
         """Update inventory record"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE inventory 
-                SET codigo_barras = ?, descripcion = ?, cantidad = ?, 
-                    auditor = ?, locacion = ?, last_modified = CURRENT_TIMESTAMP,
-                    sync_status = 0
-                WHERE id = ?
-            ''', (codigo_barras, descripcion, cantidad, auditor, locacion, record_id))
-            
-            conn.commit()
-            conn.close()
-            
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    UPDATE inventory
+                    SET codigo_barras = ?, descripcion = ?, cantidad = ?,
+                        auditor = ?, locacion = ?, last_modified = CURRENT_TIMESTAMP,
+                        sync_status = 0
+                    WHERE id = ?
+                ''', (codigo_barras, descripcion, cantidad, auditor, locacion, record_id))
+
             logging.info(f"Record updated: {record_id}")
             return True
-            
+
         except Exception as e:
             logging.error(f"Error updating record: {e}")
             return False
 
+    @DB_OPERATION_SECONDS.time(operation='delete_record')
     def delete_record(self, record_id):
         """Delete inventory record"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM inventory WHERE id = ?', (record_id,))
-            
-            conn.commit()
-            conn.close()
-            
+            with self._transaction() as cursor:
+                cursor.execute('DELETE FROM inventory WHERE id = ?', (record_id,))
+
             logging.info(f"Record deleted: {record_id}")
             return True
-            
+
         except Exception as e:
             logging.error(f"Error deleting record: {e}")
             return False
@@ -237,129 +1128,574 @@ class DatabaseManager:
     def get_record_by_id(self, record_id):
         """Get record by ID"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
+            cursor = self._reader().cursor()
+
             cursor.execute('''
                 SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion
                 FROM inventory WHERE id = ?
             ''', (record_id,))
-            
-            record = cursor.fetchone()
-            conn.close()
-            
-            return record
-            
+
+            return cursor.fetchone()
+
         except Exception as e:
             logging.error(f"Error getting record by ID: {e}")
             return None
 
     def search_records(self, search_text):
         """Search records by text"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            search_pattern = f'%{search_text}%'
-            
-            cursor.execute('''
-                SELECT id, codigo_barras, descripcion, cantidad, auditor, locacion, sync_status
-                FROM inventory 
-                WHERE codigo_barras LIKE ? OR descripcion LIKE ? 
-                   OR auditor LIKE ? OR locacion LIKE ?
-                ORDER BY timestamp DESC
-                LIMIT 100
-            ''', (search_pattern, search_pattern, search_pattern, search_pattern))
-            
-            records = cursor.fetchall()
-            conn.close()
-            
-            return records
-            
-        except Exception as e:
-            logging.error(f"Error searching records: {e}")
-            return []
+        records, _ = self.get_records_page(page_size=100, search_text=search_text)
+        return records
 
     def get_last_values(self):
         """Get last used values for UI"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
+            cursor = self._reader().cursor()
+
             cursor.execute('''
                 SELECT auditor, locacion
-                FROM inventory 
-                ORDER BY timestamp DESC 
+                FROM inventory
+                ORDER BY timestamp DESC
                 LIMIT 1
             ''')
-            
+
             result = cursor.fetchone()
-            conn.close()
-            
+
             if result:
                 return {
                     'auditor': result[0],
                     'locacion': result[1]
                 }
             return {}
-            
+
         except Exception as e:
             logging.error(f"Error getting last values: {e}")
             return {}
 
+    @DB_OPERATION_SECONDS.time(operation='get_statistics')
     def get_statistics(self):
         """Get database statistics"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Total records
-            cursor.execute('SELECT COUNT(*) FROM inventory')
-            total_records = cursor.fetchone()[0]
-            
-            # Total quantity
-            cursor.execute('SELECT SUM(cantidad) FROM inventory')
-            total_quantity = cursor.fetchone()[0] or 0
-            
-            # Unique products
-            cursor.execute('SELECT COUNT(DISTINCT codigo_barras) FROM inventory')
-            unique_products = cursor.fetchone()[0]
-            
-            # Last record date
-            cursor.execute('SELECT MAX(timestamp) FROM inventory')
-            last_record_date = cursor.fetchone()[0]
-            
-            conn.close()
-            
+            return self._read_statistics(self._reader().cursor())
+
+        except Exception as e:
+            logging.error(f"Error getting statistics: {e}")
+            return {}
+
+    def get_sku_counts(self, codigo_barras, locacion=None):
+        """Get how much of a barcode has been counted at a location and overall"""
+        try:
+            cursor = self._reader().cursor()
+
+            # A primary key prefix scan over the barcode's locations
+            cursor.execute('''
+                SELECT COALESCE(SUM(total_quantity), 0), COALESCE(SUM(record_count), 0),
+                       COALESCE(SUM(CASE WHEN locacion = ? THEN total_quantity END), 0),
+                       COALESCE(SUM(CASE WHEN locacion = ? THEN record_count END), 0)
+                FROM inventory_rollup
+                WHERE codigo_barras = ?
+            ''', (locacion or '', locacion or '', codigo_barras))
+
+            total_quantity, total_records, location_quantity, location_records = cursor.fetchone()
             return {
-                'total_records': total_records,
                 'total_quantity': total_quantity,
-                'unique_products': unique_products,
-                'last_record_date': last_record_date
+                'total_records': total_records,
+                'location_quantity': location_quantity,
+                'location_records': location_records
             }
-            
+
         except Exception as e:
-            logging.error(f"Error getting statistics: {e}")
+            logging.error(f"Error getting SKU counts: {e}")
             return {}
 
     def get_last_records(self, limit=10):
         """Get last records for CLI display"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
+            cursor = self._reader().cursor()
+
             cursor.execute('''
                 SELECT codigo_barras, descripcion, cantidad, auditor, locacion, timestamp, sync_status
-                FROM inventory 
-                ORDER BY timestamp DESC 
+                FROM inventory
+                ORDER BY timestamp DESC
                 LIMIT ?
             ''', (limit,))
-            
-            records = cursor.fetchall()
-            conn.close()
-            
-            return records
-            
+
+            return cursor.fetchall()
+
         except Exception as e:
             logging.error(f"Error getting last records: {e}")
             return []
+
+    def get_master_description(self, codigo):
+        """Get the master description of a barcode, or None if it is unknown"""
+        try:
+            # Items added since the index was built are only in the table
+            index = self._master_index
+            if index is not None:
+                description = index.get(codigo)
+                if description is not None:
+                    return description
+
+            cursor = self._reader().cursor()
+
+            cursor.execute('SELECT descripcion FROM master_items WHERE codigo = ?', (codigo,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+        except Exception as e:
+            logging.error(f"Error getting master description: {e}")
+            return None
+
+    @DB_OPERATION_SECONDS.time(operation='master_upsert')
+    def upsert_master_item(self, codigo, descripcion):
+        """Add an article to the master or change its description"""
+        try:
+            with self._transaction() as cursor:
+                # Changing an article the index holds makes the index stale;
+                # new articles are found in the table when the index misses
+                # until enough of them pile up
+                cursor.execute('SELECT descripcion FROM master_items WHERE codigo = ?', (codigo,))
+                row = cursor.fetchone()
+                if row is None:
+                    stale = self._note_master_additions(cursor, 1)
+                    self._adjust_master_count(cursor, 1)
+                else:
+                    stale = row[0] != descripcion
+                    if stale:
+                        self._bump_master_generation(cursor)
+                cursor.execute('''
+                    INSERT INTO master_items (codigo, descripcion) VALUES (?, ?)
+                    ON CONFLICT(codigo) DO UPDATE SET
+                        descripcion = excluded.descripcion,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (codigo, descripcion))
+            if stale:
+                self._drop_master_index()
+            return True
+
+        except Exception as e:
+            logging.error(f"Error saving master item: {e}")
+            return False
+
+    def _stage_master_items(self, pairs):
+        """Write pairs to a scratch database of their own and return its path.
+
+        The pairs may be a lazy stream still parsing the master file, so
+        they are staged on a separate connection: neither the write lock
+        nor a transaction on the inventory database is held meanwhile, and
+        scans, outbox leases and pulls carry on. The scratch file is
+        removed if the stream raises.
+        """
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        fd, path = tempfile.mkstemp(prefix='master_import-', suffix='.db', dir=directory)
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(path, isolation_level=None)
+            try:
+                # Throwaway data: no journal, no fsyncs, nothing held in RAM
+                conn.execute('PRAGMA journal_mode = OFF')
+                conn.execute('PRAGMA synchronous = OFF')
+                conn.execute('PRAGMA temp_store = FILE')
+                conn.execute('''
+                    CREATE TABLE master_import (
+                        codigo TEXT PRIMARY KEY,
+                        descripcion TEXT NOT NULL
+                    ) WITHOUT ROWID
+                ''')
+                conn.execute('BEGIN')
+                while True:
+                    chunk = list(islice(pairs, MASTER_INSERT_CHUNK))
+                    if not chunk:
+                        break
+                    # Later rows of the same code win, as in a dict
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO master_import (codigo, descripcion) VALUES (?, ?)
+                    ''', chunk)
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+            return path
+        except BaseException:
+            os.remove(path)
+            raise
+
+    @contextmanager
+    def _attached(self, path, name):
+        """Attach the database at path to the writer as name for the duration of the block"""
+        with self._write_lock:
+            writer = self._get_writer()
+            writer.execute('ATTACH DATABASE ? AS ' + name, (path,))
+            # Read through the page cache rather than mapped whole into memory
+            writer.execute(f'PRAGMA {name}.mmap_size = 0')
+        try:
+            yield
+        finally:
+            with self._write_lock:
+                if self._writer is not None:
+                    self._writer.execute('DETACH DATABASE ' + name)
+
+    @DB_OPERATION_SECONDS.time(operation='master_delta')
+    def apply_master_delta(self, items, file_hash=None):
+        """Bring the article master in line with items, writing only what differs.
+
+        items is a dict or (codigo, descripcion) pairs, later pairs winning.
+        They are first staged in a scratch database, outside of any write
+        transaction, so items may be a lazy stream such as
+        FileManager.load_master_file's that parses the file as it is
+        consumed; if it raises part way, e.g. on cancellation, the master
+        is left untouched. The staged rows are then diffed against
+        master_items in SQL in one short transaction: codes missing from
+        the master are added, codes whose description differs are changed,
+        and codes the file no longer has are removed. file_hash, if given,
+        is stored with the result so an identical file can be skipped next
+        time. Returns {'added', 'changed', 'removed', 'total'}, or None on
+        error.
+        """
+        try:
+            pairs = iter(items.items() if isinstance(items, dict) else items)
+            staging_path = self._stage_master_items(pairs)
+            try:
+                with self._attached(staging_path, 'staging'), self._transaction() as cursor:
+                    cursor.execute('''
+                        SELECT COALESCE(SUM(m.codigo IS NULL), 0),
+                               COALESCE(SUM(m.descripcion IS NOT i.descripcion AND m.codigo IS NOT NULL), 0),
+                               COUNT(*)
+                        FROM staging.master_import i
+                        LEFT JOIN master_items m ON m.codigo = i.codigo
+                    ''')
+                    added, changed, total = cursor.fetchone()
+
+                    cursor.execute('''
+                        DELETE FROM master_items
+                        WHERE NOT EXISTS (SELECT 1 FROM staging.master_import i
+                                          WHERE i.codigo = master_items.codigo)
+                    ''')
+                    removed = cursor.rowcount
+
+                    if added or changed:
+                        # WHERE true keeps the upsert clause from parsing as a join
+                        cursor.execute('''
+                            INSERT INTO master_items (codigo, descripcion)
+                            SELECT codigo, descripcion FROM staging.master_import WHERE true
+                            ON CONFLICT(codigo) DO UPDATE SET
+                                descripcion = excluded.descripcion,
+                                updated_at = CURRENT_TIMESTAMP
+                            WHERE master_items.descripcion IS NOT excluded.descripcion
+                        ''')
+
+                    # Changes and removals make the index stale; additions are
+                    # found in the table when the index misses, until enough
+                    # of them pile up
+                    stale = bool(changed or removed)
+                    if stale:
+                        self._bump_master_generation(cursor)
+                    elif added:
+                        stale = self._note_master_additions(cursor, added)
+                    self._set_sync_state(cursor, 'master_count', total)
+                    if file_hash:
+                        self._set_sync_state(cursor, 'master_file_hash', file_hash)
+            finally:
+                os.remove(staging_path)
+
+            if stale:
+                self._drop_master_index()
+            summary = {'added': added, 'changed': changed, 'removed': removed, 'total': total}
+            logging.info(f"Master delta applied: {summary}")
+            return summary
+
+        except Exception as e:
+            logging.error(f"Error applying master delta: {e}")
+            return None
+
+    def get_master_count(self):
+        """Get the number of articles in the master.
+
+        Read from the count kept with every master change, so startup does
+        not scan the table; databases from before it was kept are counted.
+        """
+        try:
+            count = self.get_sync_state('master_count')
+            if count is not None:
+                return count
+
+            cursor = self._reader().cursor()
+            cursor.execute('SELECT COUNT(*) FROM master_items')
+            return cursor.fetchone()[0]
+
+        except Exception as e:
+            logging.error(f"Error getting master count: {e}")
+            return 0
+
+    def get_master_items(self, search_text=None, limit=100):
+        """Get up to limit (codigo, descripcion) master items, optionally matching search_text"""
+        try:
+            cursor = self._reader().cursor()
+
+            search_text = (search_text or '').strip()
+            if search_text:
+                cursor.execute('''
+                    SELECT codigo, descripcion FROM master_items
+                    WHERE codigo LIKE ? OR descripcion LIKE ?
+                    ORDER BY codigo
+                    LIMIT ?
+                ''', (f'%{search_text}%', f'%{search_text}%', limit))
+            else:
+                cursor.execute('SELECT codigo, descripcion FROM master_items ORDER BY codigo LIMIT ?', (limit,))
+            return cursor.fetchall()
+
+        except Exception as e:
+            logging.error(f"Error getting master items: {e}")
+            return []
+
+    def migrate_master_json(self, json_path):
+        """Move the article master from a legacy master_items.json into master_items.
+
+        Items already in the table are kept where the file has no entry for
+        them. The file is renamed to .migrated afterwards so this happens
+        once. Returns the number of items migrated.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                master_dict = json.load(f)
+
+            pairs = [(str(codigo), str(descripcion)) for codigo, descripcion in master_dict.items()]
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO master_items (codigo, descripcion) VALUES (?, ?)
+                ''', pairs)
+                cursor.execute('SELECT COUNT(*) FROM master_items')
+                self._set_sync_state(cursor, 'master_count', cursor.fetchone()[0])
+                self._bump_master_generation(cursor)
+            self._drop_master_index()
+
+            os.replace(json_path, json_path + '.migrated')
+            logging.info(f"Migrated {len(pairs)} master items from {json_path}")
+            return len(pairs)
+
+        except Exception as e:
+            logging.error(f"Error migrating master JSON: {e}")
+            return 0
+
+    def _bump_master_generation(self, cursor):
+        """Invalidate master indexes built so far, within the caller's transaction"""
+        cursor.execute("SELECT value FROM sync_state WHERE key = 'master_generation'")
+        row = cursor.fetchone()
+        self._set_sync_state(cursor, 'master_generation', (json.loads(row[0]) if row else 0) + 1)
+        # The next index is built from the whole table
+        self._set_sync_state(cursor, 'master_unindexed', 0)
+
+    def _note_master_additions(self, cursor, added):
+        """Count articles added since the index was built, within the caller's transaction.
+
+        Once MASTER_INDEX_MAX_UNINDEXED have piled up the index is marked
+        stale, so the next open_master_index rebuilds it with them. Returns
+        True if it was.
+        """
+        cursor.execute("SELECT value FROM sync_state WHERE key = 'master_unindexed'")
+        row = cursor.fetchone()
+        unindexed = (json.loads(row[0]) if row else 0) + added
+        if unindexed >= MASTER_INDEX_MAX_UNINDEXED:
+            self._bump_master_generation(cursor)
+            return True
+        self._set_sync_state(cursor, 'master_unindexed', unindexed)
+        return False
+
+    def _adjust_master_count(self, cursor, delta):
+        """Move the stored master count by delta, if one is stored yet"""
+        cursor.execute("SELECT value FROM sync_state WHERE key = 'master_count'")
+        row = cursor.fetchone()
+        if row is not None:
+            self._set_sync_state(cursor, 'master_count', json.loads(row[0]) + delta)
+
+    def _drop_master_index(self):
+        """Stop serving lookups from the master index.
+
+        The map is not closed here: a lookup in flight may still hold it,
+        and it is unmapped once the last reference goes away.
+        """
+        with self._master_index_lock:
+            self._master_index = None
+
+    def open_master_index(self, rebuild=True):
+        """Start serving master lookups from the memory-mapped index.
+
+        The index on disk is used if it was built from the current master;
+        otherwise it is rebuilt first when rebuild is set. Returns True if
+        lookups now go through the index.
+        """
+        try:
+            generation = self.get_sync_state('master_generation', 0)
+            index = None
+            if os.path.exists(self.master_index_path):
+                try:
+                    index = BarcodeIndex(self.master_index_path)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Ignoring unreadable master index: {e}")
+                if index is not None and index.generation != generation:
+                    index.close()
+                    index = None
+
+            if index is None:
+                if not rebuild:
+                    return False
+                index = self.rebuild_master_index()
+                if index is None:
+                    return False
+
+            with self._master_index_lock:
+                self._master_index = index
+            logging.info(f"Master index open with {len(index)} items")
+            return True
+
+        except Exception as e:
+            logging.error(f"Error opening master index: {e}")
+            return False
+
+    @DB_OPERATION_SECONDS.time(operation='master_index_build')
+    def rebuild_master_index(self):
+        """Write master_index.bin from master_items and return it opened, or None"""
+        conn = self._reader()
+        try:
+            # One read transaction, so the count, the rows and the
+            # generation all come from the same snapshot
+            conn.execute('BEGIN')
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT value FROM sync_state WHERE key = 'master_generation'")
+                row = cursor.fetchone()
+                generation = json.loads(row[0]) if row else 0
+
+                cursor.execute('''
+                    SELECT COUNT(*), COALESCE(MAX(LENGTH(CAST(codigo AS BLOB))), 0)
+                    FROM master_items WHERE LENGTH(CAST(codigo AS BLOB)) <= ?
+                ''', (MAX_KEY_WIDTH,))
+                count, key_width = cursor.fetchone()
+                if not count:
+                    return None
+
+                # BINARY collation orders keys by their UTF-8 bytes, as the index does
+                cursor.execute('''
+                    SELECT codigo, descripcion FROM master_items
+                    WHERE LENGTH(CAST(codigo AS BLOB)) <= ?
+                    ORDER BY codigo
+                ''', (MAX_KEY_WIDTH,))
+                build_barcode_index(self.master_index_path, cursor, count, key_width, generation)
+            finally:
+                conn.execute('COMMIT')
+
+            logging.info(f"Master index rebuilt with {count} items")
+            return BarcodeIndex(self.master_index_path)
+
+        except Exception as e:
+            logging.error(f"Error rebuilding master index: {e}")
+            return None
+
+
+class WriteBehindQueue:
+    """Group-commit queue for scans.
+
+    Submitted records are written by a single background thread, either
+    flush_interval seconds after the first record of a batch arrives or as
+    soon as max_batch records are waiting. Each record's callback is called
+    with True/False only after its transaction has committed or failed, so
+    the UI never confirms a scan that is not on disk.
+    """
+
+    def __init__(self, db_manager, flush_interval=0.05, max_batch=100):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self._pending = []
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, record, callback=None):
+        """Queue a record for the next group commit"""
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Write queue is stopped")
+            self._pending.append((record, callback))
+            self._condition.notify()
+
+    def stop(self, timeout=5.0):
+        """Flush whatever is queued and stop the writer thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        """Wait for a full batch or for the flush window to close"""
+        with self._condition:
+            while self._running and not self._pending:
+                self._condition.wait()
+
+            deadline = time.monotonic() + self.flush_interval
+            while self._running and len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if not self._running:
+                    return
+                continue
+
+            inserted = self.db_manager.add_records_bulk([record for record, _ in batch])
+            success = inserted == len(batch)
+
+            for _, callback in batch:
+                if callback is None:
+                    continue
+                try:
+                    callback(success)
+                except Exception as e:
+                    logging.error(f"Error in write queue callback: {e}")
+
+
+def run_maintenance(argv=None):
+    """Command line entry point for database maintenance tasks"""
+    parser = argparse.ArgumentParser(description='Inventory database maintenance')
+    parser.add_argument('command', choices=['verify-stats', 'rebuild-stats', 'rebuild-search'])
+    parser.add_argument('--db', help='Path to inventory.db (defaults to the app data directory)')
+    args = parser.parse_args(argv)
+
+    db_manager = DatabaseManager(args.db)
+    try:
+        if args.command in ('verify-stats', 'rebuild-stats'):
+            drift = db_manager.rebuild_statistics(repair=args.command == 'rebuild-stats')
+            if drift is None:
+                print("Error checking statistics, see the log for details")
+                return 1
+            if not drift:
+                print("Statistics are consistent")
+            for field, (stored, actual) in drift.items():
+                print(f"{field}: stored={stored} actual={actual}")
+            if drift and args.command == 'rebuild-stats':
+                print("Statistics rebuilt")
+            return 0
+
+        if args.command == 'rebuild-search':
+            if not db_manager.rebuild_search_index():
+                print("Search index not available or rebuild failed")
+                return 1
+            print("Search index rebuilt")
+            return 0
+    finally:
+        db_manager.close()
+
+
+if __name__ == '__main__':
+    sys.exit(run_maintenance())
@@ -1,9 +1,81 @@
 
 import os
+import csv
+import hashlib
+import io
 import json
 import logging
+import time
+from collections import deque
 from android_utils import AndroidUtils
 
+# Rows per chunk read from a spreadsheet before progress is reported
+EXCEL_CHUNK_SIZE = 5000
+
+# Bytes of a CSV file parsed per chunk, and bytes sampled to detect its format
+CSV_CHUNK_BYTES = 4 * 1024 * 1024
+CSV_SAMPLE_BYTES = 64 * 1024
+
+# Worker processes parsing CSV chunks
+CSV_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Encodings tried, in order, on files without a byte order mark. ERP
+# exports that are not UTF-8 are usually Windows-1252; latin-1 decodes
+# anything, so it always matches last.
+CSV_ENCODINGS = ('utf-8', 'cp1252', 'latin-1')
+
+CSV_EXTENSIONS = ('.csv', '.tsv', '.txt')
+
+# Joins the parsed fields a worker sends back (ASCII unit separator)
+CSV_FIELD_SEPARATOR = '\x1f'
+
+
+class CsvSplitError(Exception):
+    """A CSV file could not be parsed in parallel chunks"""
+
+
+class MasterLoadCancelled(Exception):
+    """A master file stream was stopped through its cancel_event"""
+
+
+def _parse_csv_rows(text, delimiter):
+    """(codigo, descripcion) pairs of CSV text, cleaned like spreadsheet rows.
+
+    The text is read as the sequential path reads the file (newline=''),
+    so only \r and \n end rows and both paths agree on every row.
+    """
+    pairs = []
+    for row in csv.reader(io.StringIO(text, newline=''), delimiter=delimiter):
+        if len(row) < 2:
+            continue
+        codigo = row[0].strip()
+        descripcion = row[1].strip()
+        if codigo and descripcion:
+            pairs.append((codigo, descripcion))
+    return pairs
+
+
+def _parse_csv_range(file_path, start, end, encoding, delimiter):
+    """Parse the lines in bytes [start, end) of a CSV file.
+
+    Runs in a worker process. Returns (codes, descriptions, balanced): the
+    pairs' two sides, each joined with CSV_FIELD_SEPARATOR because two
+    strings cross the process boundary far faster than a list of tuples.
+    balanced is False when the range holds an odd number of quotes, meaning
+    a quoted field runs across the range boundary and the split cannot be
+    trusted.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = data.decode(encoding)
+    if text.count('"') % 2 or CSV_FIELD_SEPARATOR in text:
+        return '', '', False
+    pairs = _parse_csv_rows(text, delimiter)
+    return (CSV_FIELD_SEPARATOR.join(codigo for codigo, _ in pairs),
+            CSV_FIELD_SEPARATOR.join(descripcion for _, descripcion in pairs), True)
+
+
 class FileManager:
     def __init__(self):
         self.android_utils = AndroidUtils()
@@ -13,8 +85,277 @@ class FileManager:
         data_dir = self.android_utils.get_data_directory()
         return os.path.join(data_dir, 'master_items.json')
     
-    def load_excel_file(self, file_path):
-        """Load Excel file and return dictionary"""
+    def iter_excel_rows(self, file_path, chunk_size=EXCEL_CHUNK_SIZE):
+        """Yield (codigo, descripcion) pairs of the active sheet in lists of chunk_size.
+
+        The workbook is opened read-only, so cells are parsed as the rows are
+        iterated instead of being loaded up front, and memory stays bounded
+        by the chunk size whatever the size of the sheet.
+        """
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            sheet = workbook.active
+            chunk = []
+            # Columns A=codigo, B=descripcion; the first row is the header
+            for row in sheet.iter_rows(min_row=2, max_col=2, values_only=True):
+                if len(row) < 2 or row[0] is None or row[1] is None:
+                    continue
+                codigo = str(row[0]).strip()
+                descripcion = str(row[1]).strip()
+                if codigo and descripcion:
+                    chunk.append((codigo, descripcion))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            # Read-only workbooks keep the file open until closed
+            workbook.close()
+
+    def count_excel_rows(self, file_path):
+        """Data rows of the active sheet as recorded in the file, or None if unknown"""
+        try:
+            import openpyxl
+
+            workbook = openpyxl.load_workbook(file_path, read_only=True)
+            try:
+                max_row = workbook.active.max_row
+            finally:
+                workbook.close()
+            return max(max_row - 1, 0) if max_row else None
+        except Exception as e:
+            logging.warning(f"Could not read Excel dimensions: {e}")
+            return None
+
+    def hash_file(self, file_path, block_size=1024 * 1024):
+        """SHA-256 hex digest of a file's content, read in blocks"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load_master_file(self, file_path, progress_callback=None, cancel_event=None):
+        """Open a master file, CSV/TSV or Excel by its extension, as a stream of pairs.
+
+        See load_excel_file for what is returned.
+        """
+        if os.path.splitext(file_path)[1].lower() in CSV_EXTENSIONS:
+            return self.load_csv_file(file_path, progress_callback, cancel_event)
+        return self.load_excel_file(file_path, progress_callback, cancel_event)
+
+    def detect_csv_format(self, file_path):
+        """Detect the (encoding, delimiter) of a CSV/TSV file from its first bytes"""
+        with open(file_path, 'rb') as f:
+            sample = f.read(CSV_SAMPLE_BYTES)
+
+        if sample.startswith(b'\xef\xbb\xbf'):
+            encoding = 'utf-8-sig'
+        elif sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+            encoding = 'utf-16'
+        else:
+            encoding = 'latin-1'
+            for candidate in CSV_ENCODINGS:
+                try:
+                    # The sample may end inside a multi-byte character
+                    sample.decode(candidate)
+                except UnicodeDecodeError as e:
+                    if e.start < len(sample) - 3:
+                        continue
+                encoding = candidate
+                break
+
+        text = sample.decode(encoding, errors='ignore')
+        # Only whole lines, so the sniffer does not see a truncated row
+        if len(sample) == CSV_SAMPLE_BYTES and '\n' in text:
+            text = text[:text.rindex('\n')]
+        try:
+            delimiter = csv.Sniffer().sniff(text, delimiters=',;\t|').delimiter
+        except csv.Error:
+            delimiter = '\t' if file_path.lower().endswith('.tsv') else ','
+        return encoding, delimiter
+
+    def _csv_chunk_ranges(self, file_path, header_end):
+        """Byte ranges of about CSV_CHUNK_BYTES after the header, split at line ends"""
+        size = os.path.getsize(file_path)
+        ranges = []
+        with open(file_path, 'rb') as f:
+            start = header_end
+            while start < size:
+                f.seek(min(start + CSV_CHUNK_BYTES, size))
+                f.readline()
+                end = min(f.tell(), size)
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    def load_csv_file(self, file_path, progress_callback=None, cancel_event=None, workers=CSV_WORKERS):
+        """Open a CSV/TSV master file (A=codigo, B=descripcion) as a stream of pairs.
+
+        Large files are split at line ends and the chunks parsed across a
+        process pool, then streamed in file order so later rows win as in
+        the Excel path. Files that cannot be split safely (UTF-16, or quoted
+        fields spanning lines) and platforms without working process pools
+        are parsed in this process. Returns as load_excel_file does.
+        """
+        try:
+            if not os.path.exists(file_path):
+                return False, "Archivo no encontrado"
+
+            encoding, delimiter = self.detect_csv_format(file_path)
+            logging.info(f"CSV format: encoding={encoding}, delimiter={delimiter!r}")
+
+            chunks = self._iter_csv_chunks(file_path, encoding, delimiter, workers)
+            return True, self._stream_pairs(chunks, 'CSV', progress_callback, cancel_event)
+
+        except Exception as e:
+            logging.error(f"Error loading CSV file: {e}")
+            return False, str(e)
+
+    def _iter_csv_chunks(self, file_path, encoding, delimiter, workers):
+        """Yield the (codigo, descripcion) pairs of a CSV file in chunks, in file order.
+
+        When the parallel parse fails in any way (a range that cannot be
+        split safely, a pool that cannot start, a worker that dies), the
+        file is parsed again sequentially from the start. When a byte past
+        the sample detect_csv_format looked at does not decode, the file is
+        parsed again with the next of CSV_ENCODINGS. Pairs already yielded
+        are then yielded again in the same order, which leaves a
+        later-rows-win consumer with the same result.
+        """
+        with open(file_path, 'rb') as f:
+            f.readline()  # Skip header
+            header_end = f.tell()
+        ranges = self._csv_chunk_ranges(file_path, header_end)
+
+        if encoding in CSV_ENCODINGS:
+            fallbacks = CSV_ENCODINGS[CSV_ENCODINGS.index(encoding) + 1:]
+        elif encoding == 'utf-8-sig':
+            # A UTF-8 byte order mark does not make the rest of the file UTF-8
+            fallbacks = CSV_ENCODINGS[1:]
+        else:
+            fallbacks = ()
+
+        for next_encoding in fallbacks + (None,):
+            try:
+                yield from self._iter_csv_chunks_as(file_path, ranges, encoding, delimiter, workers)
+                return
+            except UnicodeDecodeError as e:
+                if next_encoding is None:
+                    raise
+                logging.warning(f"CSV is not {encoding} past the sampled bytes ({e.reason}); "
+                                f"parsing it again as {next_encoding}")
+                encoding = next_encoding
+
+    def _iter_csv_chunks_as(self, file_path, ranges, encoding, delimiter, workers):
+        """Yield the chunks of a CSV file read as encoding, in parallel where possible"""
+        if workers > 1 and len(ranges) > 1 and encoding != 'utf-16':
+            try:
+                yield from self._parse_csv_parallel(file_path, ranges, encoding, delimiter, workers)
+                return
+            except CsvSplitError as e:
+                logging.warning(f"{e}; parsing CSV sequentially")
+            except UnicodeDecodeError:
+                # Every path would fail alike; the caller changes encoding
+                raise
+            except Exception as e:
+                # e.g. BrokenProcessPool, or a submit failing
+                logging.warning(f"Parallel CSV parse failed: {e!r}; parsing CSV sequentially")
+
+        yield from self._parse_csv_sequential(file_path, encoding, delimiter)
+
+    def _parse_csv_sequential(self, file_path, encoding, delimiter):
+        """Yield the (codigo, descripcion) pairs of a CSV file in chunks, in this process"""
+        with open(file_path, 'r', encoding=encoding, newline='') as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            next(reader, None)  # Skip header
+            chunk = []
+            for row in reader:
+                if len(row) < 2:
+                    continue
+                codigo = row[0].strip()
+                descripcion = row[1].strip()
+                if codigo and descripcion:
+                    chunk.append((codigo, descripcion))
+                    if len(chunk) >= EXCEL_CHUNK_SIZE:
+                        yield chunk
+                        chunk = []
+            if chunk:
+                yield chunk
+
+    def _parse_csv_parallel(self, file_path, ranges, encoding, delimiter, workers):
+        """Yield the chunks of the byte ranges, parsed across a process pool, in file order.
+
+        Raises CsvSplitError when the file cannot be split safely; errors
+        of the pool itself propagate as they are.
+        """
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=min(workers, len(ranges)))
+        except (ImportError, NotImplementedError, OSError) as e:
+            # Android's Python has no working multiprocessing semaphores
+            raise CsvSplitError(f"Process pool unavailable: {e}")
+
+        try:
+            # A few ranges ahead of the consumer, so parsed chunks do not
+            # pile up in memory while it writes them out
+            pending = deque()
+            next_range = iter(ranges)
+            while True:
+                for start, end in next_range:
+                    pending.append(pool.submit(_parse_csv_range, file_path, start, end, encoding, delimiter))
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                codes, descriptions, balanced = pending.popleft().result()
+                if not balanced:
+                    raise CsvSplitError("Quoted fields span lines")
+                if codes:
+                    yield list(zip(codes.split(CSV_FIELD_SEPARATOR),
+                                   descriptions.split(CSV_FIELD_SEPARATOR)))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _stream_pairs(self, chunks, kind, progress_callback, cancel_event, total=None):
+        """Yield the pairs of chunks one by one as the consumer asks for them.
+
+        Reports progress after every chunk and raises MasterLoadCancelled
+        at the next chunk once cancel_event is set, so a consumer writing
+        the pairs in a transaction rolls it back instead of taking a
+        truncated file for the whole master.
+        """
+        start = time.monotonic()
+        rows = 0
+        try:
+            for chunk in chunks:
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info(f"{kind} load cancelled after {rows} rows")
+                    raise MasterLoadCancelled("Carga cancelada")
+                yield from chunk
+                rows += len(chunk)
+                if progress_callback:
+                    elapsed = time.monotonic() - start
+                    progress_callback(rows, total, rows / elapsed if elapsed > 0 else 0.0)
+        finally:
+            chunks.close()
+
+        logging.info(f"Read {rows} rows from {kind} file")
+
+    def load_excel_file(self, file_path, progress_callback=None, cancel_event=None):
+        """Open an Excel master file as a stream of (codigo, descripcion) pairs.
+
+        Returns (True, pairs) or (False, message). pairs is an iterator that
+        reads the sheet in chunks as it is consumed, e.g. by
+        DatabaseManager.apply_master_delta, so the master is never held in
+        memory as a whole. progress_callback(rows, total, rows_per_second),
+        if given, is called after every chunk; total is None when the file
+        does not record its size. Once cancel_event is set, consuming the
+        next chunk raises MasterLoadCancelled.
+        """
         try:
             # Check if openpyxl is available
             try:
@@ -25,22 +366,9 @@ class FileManager:
             if not os.path.exists(file_path):
                 return False, "Archivo no encontrado"
             
-            # Load Excel file
-            workbook = openpyxl.load_workbook(file_path, data_only=True)
-            sheet = workbook.active
-            
-            master_dict = {}
-            
-            # Read data from sheet (assuming columns A=codigo, B=descripcion)
-            for row in sheet.iter_rows(min_row=2, values_only=True):  # Skip header
-                if row[0] is not None and row[1] is not None:
-                    codigo = str(row[0]).strip()
-                    descripcion = str(row[1]).strip()
-                    if codigo and descripcion:
-                        master_dict[codigo] = descripcion
-            
-            logging.info(f"Loaded {len(master_dict)} items from Excel file")
-            return True, master_dict
+            total = self.count_excel_rows(file_path) if progress_callback else None
+            return True, self._stream_pairs(self.iter_excel_rows(file_path), 'Excel', progress_callback,
+                                            cancel_event, total)
             
         except Exception as e:
             logging.error(f"Error loading Excel file: {e}")
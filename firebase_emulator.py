@@ -0,0 +1,485 @@
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# google.rpc.Code values used in batchWrite statuses
+RESOURCE_EXHAUSTED = 8
+
+DOCUMENTS_MARKER = '/databases/(default)/documents'
+
+
+def _value_key(value):
+    """Sortable key for a Firestore value, so timestamps compare as instants"""
+    if not value:
+        return (0, 0)
+    if 'nullValue' in value:
+        return (0, 0)
+    if 'booleanValue' in value:
+        return (1, bool(value['booleanValue']))
+    if 'integerValue' in value:
+        return (2, float(value['integerValue']))
+    if 'doubleValue' in value:
+        return (2, float(value['doubleValue']))
+    if 'timestampValue' in value:
+        return (3, datetime.fromisoformat(_trim_nanos(value['timestampValue'].replace('Z', '+00:00'))))
+    if 'stringValue' in value:
+        return (4, value['stringValue'])
+    if 'referenceValue' in value:
+        return (5, value['referenceValue'])
+    return (6, json.dumps(value, sort_keys=True))
+
+
+def _trim_nanos(value):
+    """Cut fractional seconds to microseconds for datetime.fromisoformat"""
+    if '.' not in value:
+        return value
+    whole, rest = value.split('.', 1)
+    digits = len(rest) - len(rest.lstrip('0123456789'))
+    return f"{whole}.{rest[:min(digits, 6)]}{rest[digits:]}"
+
+
+def _now_rfc3339():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FirebaseEmulator:
+    """Local stand-in for the Identity Toolkit, Secure Token and Firestore REST APIs.
+
+    Implements the subset FirebaseManager uses, with injectable faults:
+    latency (seconds added to every request), drop_rate (share of requests
+    whose connection is closed without a response), throttle_rate (share
+    answered 429), write_throttle_rate (share of batchWrite writes rejected
+    with RESOURCE_EXHAUSTED) and token_ttl (seconds an ID token is valid,
+    after which Firestore answers 401). Faults can be changed while running.
+    Point FirebaseManager at it with config().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, drop_rate=0.0, throttle_rate=0.0,
+                 write_throttle_rate=0.0, token_ttl=3600, seed=None):
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.throttle_rate = throttle_rate
+        self.write_throttle_rate = write_throttle_rate
+        self.token_ttl = token_ttl
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self.users = {}
+        self.documents = {}
+        self.tokens = {}
+        self.refresh_tokens = {}
+        self.stats = {'requests': 0, 'dropped': 0, 'throttled': 0, 'unauthorized': 0, 'writes': 0}
+
+        emulator = self
+
+        class Handler(EmulatorRequestHandler):
+            pass
+        Handler.emulator = emulator
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def config(self, project_id='demo-inventory'):
+        """FirebaseManager configuration that talks to this emulator"""
+        return {
+            'projectId': project_id,
+            'apiKey': 'emulator-key',
+            'authDomain': f'{project_id}.firebaseapp.com',
+            'databaseURL': '',
+            'storageBucket': '',
+            'identityToolkitURL': f"{self.base_url}/identitytoolkit/v1",
+            'secureTokenURL': f"{self.base_url}/securetoken/v1",
+            'firestoreURL': f"{self.base_url}/firestore/v1"
+        }
+
+    def start(self):
+        """Serve on a background thread"""
+        self._thread = Thread(target=self.server.serve_forever, name='firebase-emulator', daemon=True)
+        self._thread.start()
+        logging.info(f"Firebase emulator listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_tokens(self):
+        """Make every ID token issued so far expire now"""
+        with self._lock:
+            for token in self.tokens:
+                self.tokens[token] = (self.tokens[token][0], 0.0)
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def chance(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def issue_tokens(self, user_id, refresh_token=None):
+        """Create an ID token (and a refresh token unless one is given)"""
+        with self._lock:
+            id_token = uuid.uuid4().hex
+            self.tokens[id_token] = (user_id, time.time() + self.token_ttl)
+            if refresh_token is None:
+                refresh_token = uuid.uuid4().hex
+                self.refresh_tokens[refresh_token] = user_id
+            return id_token, refresh_token
+
+    def token_user(self, id_token):
+        """User id of a valid ID token, or None if unknown or expired"""
+        with self._lock:
+            user_id, expires_at = self.tokens.get(id_token, (None, 0.0))
+            return user_id if expires_at > time.time() else None
+
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    """Routes emulator requests; see FirebaseEmulator for the fault knobs"""
+
+    emulator = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(f"Emulator: {format % args}")
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        emulator = self.emulator
+        emulator.count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if emulator.latency:
+            time.sleep(emulator.latency)
+        if emulator.chance(emulator.drop_rate):
+            # Like a lost packet: the client sees the connection die
+            emulator.count('dropped')
+            self.close_connection = True
+            return
+        if emulator.chance(emulator.throttle_rate):
+            emulator.count('throttled')
+            return self._error(429, 'RESOURCE_EXHAUSTED', 'Quota exceeded')
+
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        query = parse_qs(parts.query)
+
+        try:
+            if path.startswith('/identitytoolkit/v1/accounts:'):
+                return self._identity(method, path.rsplit(':', 1)[1], body)
+            if path == '/securetoken/v1/token' and method == 'POST':
+                return self._secure_token(body)
+            if path.startswith('/firestore/v1/') and DOCUMENTS_MARKER in path:
+                return self._firestore(method, path, query, body)
+            self._error(404, 'NOT_FOUND', f'No route for {method} {path}')
+        except Exception as e:
+            logging.error(f"Emulator error handling {method} {path}: {e}")
+            self._error(500, 'INTERNAL', str(e))
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, code, message):
+        self._send(status, {'error': {'code': status, 'status': code, 'message': message}})
+
+    def _identity(self, method, action, body):
+        if method != 'POST':
+            return self._error(400, 'INVALID_ARGUMENT', 'Expected POST')
+        payload = json.loads(body or b'{}')
+        email, password = payload.get('email'), payload.get('password')
+        emulator = self.emulator
+
+        with emulator._lock:
+            user = emulator.users.get(email)
+            if action == 'signUp':
+                if user:
+                    error = 'EMAIL_EXISTS'
+                else:
+                    user = {'localId': uuid.uuid4().hex[:28], 'password': password}
+                    emulator.users[email] = user
+                    error = None
+            elif action == 'signInWithPassword':
+                if not user:
+                    error = 'EMAIL_NOT_FOUND'
+                elif user['password'] != password:
+                    error = 'INVALID_PASSWORD'
+                else:
+                    error = None
+            else:
+                error = 'UNSUPPORTED'
+        if error:
+            return self._error(400, 'INVALID_ARGUMENT', error)
+
+        id_token, refresh_token = emulator.issue_tokens(user['localId'])
+        self._send(200, {'idToken': id_token, 'refreshToken': refresh_token,
+                         'expiresIn': str(emulator.token_ttl), 'localId': user['localId'], 'email': email})
+
+    def _secure_token(self, body):
+        form = parse_qs(body.decode('utf-8'))
+        refresh_token = form.get('refresh_token', [None])[0]
+        emulator = self.emulator
+        with emulator._lock:
+            user_id = emulator.refresh_tokens.get(refresh_token)
+        if form.get('grant_type', [None])[0] != 'refresh_token' or not user_id:
+            return self._error(400, 'INVALID_ARGUMENT', 'INVALID_REFRESH_TOKEN')
+
+        id_token, _ = emulator.issue_tokens(user_id, refresh_token)
+        self._send(200, {'id_token': id_token, 'refresh_token': refresh_token,
+                         'expires_in': str(emulator.token_ttl), 'user_id': user_id})
+
+    def _firestore(self, method, path, query, body):
+        emulator = self.emulator
+        token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not emulator.token_user(token):
+            emulator.count('unauthorized')
+            return self._error(401, 'UNAUTHENTICATED', 'Missing or expired token')
+
+        prefix, rest = path.split(DOCUMENTS_MARKER, 1)
+        root = prefix[len('/firestore/v1/'):] + DOCUMENTS_MARKER
+        payload = json.loads(body or b'{}') if body else {}
+
+        if rest == ':batchWrite' and method == 'POST':
+            return self._batch_write(payload)
+        if rest == ':runQuery' and method == 'POST':
+            return self._run_query(root, payload)
+        if rest == ':runAggregationQuery' and method == 'POST':
+            return self._run_aggregation_query(root, payload)
+
+        segments = rest.strip('/').split('/')
+        if len(segments) == 1 and method == 'GET':
+            return self._list(root, segments[0], query)
+        if len(segments) == 2:
+            name = f"{root}/{segments[0]}/{segments[1]}"
+            if method == 'PATCH':
+                return self._send(200, self._write(name, payload.get('fields', {}),
+                                                   query.get('updateMask.fieldPaths')))
+            if method == 'DELETE':
+                # Firestore deletes succeed whether or not the document exists
+                with emulator._lock:
+                    emulator.documents.pop(name, None)
+                return self._send(200, {})
+            if method == 'GET':
+                with emulator._lock:
+                    document = emulator.documents.get(name)
+                return self._send(200, document) if document else self._error(404, 'NOT_FOUND', name)
+        self._error(404, 'NOT_FOUND', f'No route for {method} {path}')
+
+    def _write(self, name, fields, mask, transforms=()):
+        """Create or update a document, limited to mask's fields if given.
+
+        transforms are batchWrite updateTransforms; only setToServerValue
+        REQUEST_TIME is supported.
+        """
+        emulator = self.emulator
+        with emulator._lock:
+            now = _now_rfc3339()
+            document = emulator.documents.get(name) or {'name': name, 'fields': {}, 'createTime': now}
+            if mask:
+                for field in mask:
+                    if field in fields:
+                        document['fields'][field] = fields[field]
+                    else:
+                        document['fields'].pop(field, None)
+            else:
+                document['fields'] = dict(fields)
+            for transform in transforms:
+                if transform.get('setToServerValue') == 'REQUEST_TIME':
+                    document['fields'][transform['fieldPath']] = {'timestampValue': now}
+            document['updateTime'] = now
+            emulator.documents[name] = document
+            emulator.stats['writes'] += 1
+            return json.loads(json.dumps(document))
+
+    def _batch_write(self, payload):
+        emulator = self.emulator
+        statuses = []
+        results = []
+        for write in payload.get('writes', []):
+            if emulator.chance(emulator.write_throttle_rate):
+                statuses.append({'code': RESOURCE_EXHAUSTED, 'message': 'Write throttled'})
+                results.append({})
+                continue
+            if 'delete' in write:
+                with emulator._lock:
+                    emulator.documents.pop(write['delete'], None)
+            else:
+                update = write['update']
+                mask = write.get('updateMask', {}).get('fieldPaths')
+                self._write(update['name'], update.get('fields', {}), mask, write.get('updateTransforms', ()))
+            statuses.append({})
+            results.append({'updateTime': _now_rfc3339()})
+        self._send(200, {'writeResults': results, 'status': statuses})
+
+    def _list(self, root, collection, query):
+        page_size = int(query.get('pageSize', ['100'])[0])
+        prefix = f"{root}/{collection}/"
+        with self.emulator._lock:
+            documents = [doc for name, doc in sorted(self.emulator.documents.items())
+                         if name.startswith(prefix)]
+        self._send(200, {'documents': documents[:page_size]})
+
+    def _run_query(self, root, payload):
+        documents = self._query_documents(root, payload.get('structuredQuery', {}))
+        read_time = _now_rfc3339()
+        if not documents:
+            return self._send(200, [{'readTime': read_time}])
+        self._send(200, [{'document': doc, 'readTime': read_time} for doc in documents])
+
+    def _run_aggregation_query(self, root, payload):
+        """count, sum and avg over the documents of a structuredQuery"""
+        aggregation = payload.get('structuredAggregationQuery', {})
+        documents = self._query_documents(root, aggregation.get('structuredQuery', {}))
+
+        fields = {}
+        for spec in aggregation.get('aggregations', []):
+            alias = spec.get('alias', f'field_{len(fields) + 1}')
+            if 'count' in spec:
+                fields[alias] = {'integerValue': str(len(documents))}
+                continue
+            operator = 'sum' if 'sum' in spec else 'avg'
+            path = spec[operator]['field']['fieldPath']
+            values = [doc['fields'][path] for doc in documents if path in doc['fields']]
+            numbers = [float(v.get('integerValue', v.get('doubleValue', 0))) for v in values
+                       if 'integerValue' in v or 'doubleValue' in v]
+            all_integers = all('integerValue' in v for v in values)
+            if operator == 'sum':
+                total = sum(numbers)
+                fields[alias] = ({'integerValue': str(int(total))} if all_integers
+                                 else {'doubleValue': total})
+            else:
+                fields[alias] = ({'doubleValue': sum(numbers) / len(numbers)} if numbers
+                                 else {'nullValue': None})
+
+        self._send(200, [{'result': {'aggregateFields': fields}, 'readTime': _now_rfc3339()}])
+
+    def _query_documents(self, root, query):
+        """Evaluate the structuredQuery subset used by FirebaseManager"""
+        collection = query.get('from', [{}])[0].get('collectionId')
+        prefix = f"{root}/{collection}/"
+        with self.emulator._lock:
+            documents = [json.loads(json.dumps(doc)) for name, doc in self.emulator.documents.items()
+                         if name.startswith(prefix) and '/' not in name[len(prefix):]]
+
+        documents = [doc for doc in documents if self._matches(doc, query.get('where'))]
+
+        order = [(o['field']['fieldPath'], o.get('direction', 'ASCENDING')) for o in query.get('orderBy', [])]
+        # Ordering by a field leaves out documents that lack it
+        documents = [doc for doc in documents
+                     if all(path == '__name__' or path in doc['fields'] for path, _ in order)]
+
+        def order_key(doc):
+            return [self._field_key(doc, path) for path, _ in order]
+
+        for index in reversed(range(len(order))):
+            path, direction = order[index]
+            documents.sort(key=lambda doc: self._field_key(doc, path), reverse=direction == 'DESCENDING')
+
+        start_at = query.get('startAt')
+        if start_at and order:
+            cursor = [_value_key(value) for value in start_at['values']]
+            width = len(cursor)
+
+            def after_cursor(doc):
+                key = order_key(doc)[:width]
+                for (k, c), (_, direction) in zip(zip(key, cursor), order):
+                    if k != c:
+                        return (k > c) if direction == 'ASCENDING' else (k < c)
+                return start_at.get('before', False)
+
+            documents = [doc for doc in documents if after_cursor(doc)]
+
+        limit = query.get('limit')
+        if limit:
+            documents = documents[:int(limit)]
+        return documents
+
+    @staticmethod
+    def _field_key(doc, path):
+        if path == '__name__':
+            return _value_key({'referenceValue': doc['name']})
+        return _value_key(doc['fields'].get(path))
+
+    def _matches(self, doc, where):
+        if not where:
+            return True
+        if 'compositeFilter' in where:
+            return all(self._matches(doc, f) for f in where['compositeFilter'].get('filters', []))
+        field_filter = where.get('fieldFilter')
+        if not field_filter:
+            return True
+        path = field_filter['field']['fieldPath']
+        if path != '__name__' and path not in doc['fields']:
+            return False
+        left = self._field_key(doc, path)
+        right = _value_key(field_filter['value'])
+        op = field_filter['op']
+        return {
+            'EQUAL': left == right,
+            'NOT_EQUAL': left != right,
+            'LESS_THAN': left < right,
+            'LESS_THAN_OR_EQUAL': left <= right,
+            'GREATER_THAN': left > right,
+            'GREATER_THAN_OR_EQUAL': left >= right,
+        }.get(op, False)
+
+
+def run_emulator(argv=None):
+    """Command line entry point: serve until interrupted"""
+    parser = argparse.ArgumentParser(description='Local Firebase stand-in for sync testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9099)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Share of requests dropped')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered 429')
+    parser.add_argument('--write-throttle-rate', type=float, default=0.0,
+                        help='Share of batchWrite writes rejected as RESOURCE_EXHAUSTED')
+    parser.add_argument('--token-ttl', type=float, default=3600, help='Seconds an ID token is valid')
+    parser.add_argument('--project', default='demo-inventory')
+    args = parser.parse_args(argv)
+
+    emulator = FirebaseEmulator(args.host, args.port, args.latency, args.drop_rate, args.throttle_rate,
+                                args.write_throttle_rate, args.token_ttl)
+    print("Use this as firebase_config.json:")
+    print(json.dumps(emulator.config(args.project), indent=2))
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_emulator())
@@ -3,8 +3,170 @@ import json
 import logging
 import requests
 import time
-from datetime import datetime
-from threading import Lock
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from firestore_codec import INVENTORY_CODEC, decode_value, encode_inventory_fields, encode_value, to_rfc3339
+from metrics import REGISTRY
+from sync_executor import SyncExecutor, SYNC_RETRIES
+
+# Firestore accepts at most 500 writes per batchWrite request
+MAX_BATCH_WRITES = 500
+
+# Fields written for an inventory document. Uploads set only these, so
+# fields added to a document server-side survive a re-upload.
+INVENTORY_FIELDS = INVENTORY_CODEC.field_names
+
+# Connections kept open per host
+POOL_SIZE = 8
+
+# Upper bound of concurrent sync requests; the adaptive controller decides
+# how many of them are used
+SYNC_WORKERS = 4
+
+# Per-write status codes that signal overload (RESOURCE_EXHAUSTED, UNAVAILABLE)
+# and the HTTP status each one is reported as
+THROTTLE_WRITE_CODES = {8: 429, 14: 503}
+
+# REST endpoints; firebase_config.json may point them elsewhere, such as
+# at a firebase_emulator instance
+IDENTITY_TOOLKIT_URL = 'https://identitytoolkit.googleapis.com/v1'
+SECURE_TOKEN_URL = 'https://securetoken.googleapis.com/v1'
+FIRESTORE_URL = 'https://firestore.googleapis.com/v1'
+
+# Documents per runQuery page when pulling updates
+PULL_PAGE_SIZE = 300
+
+# Server-set time of a document's last upload. Pulls follow it rather than
+# the scan's own timestamp, which the device sets and edits never change.
+UPDATED_AT_FIELD = 'updated_at'
+
+# Every upload stamps UPDATED_AT_FIELD with the commit time of the request
+UPDATED_AT_TRANSFORM = {"fieldPath": UPDATED_AT_FIELD, "setToServerValue": "REQUEST_TIME"}
+
+# Deleting a scan leaves a tombstone here, so other devices can pull the delete
+TOMBSTONE_COLLECTION = 'inventory_tombstones'
+
+# Seconds a pull reaches back before its watermark. Request times are
+# assigned before commit, so a write can become visible with a time just
+# behind a watermark another pull already passed; re-reading the overlap
+# catches it, and applying a document twice changes nothing.
+PULL_OVERLAP_SECONDS = 60
+
+# Seconds aggregation results are served from the local cache
+AGGREGATION_CACHE_TTL = 300
+
+# Documents returned by get_audit_trail unless a limit is given
+AUDIT_TRAIL_LIMIT = 500
+
+# Seconds before an ID token expires at which it is refreshed (at most half
+# its lifetime), between attempts when a refresh fails, and at least
+# between two refreshes
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_INTERVAL = 30
+TOKEN_MIN_REFRESH_DELAY = 5
+
+# (connect, read) timeouts in seconds per kind of endpoint
+TIMEOUTS = {
+    'probe': (3.05, 5),
+    'auth': (5, 10),
+    'document': (5, 15),
+    'batch': (5, 30),
+    'query': (5, 30),
+}
+
+# Only failures to connect are retried here: the request never reached the
+# server, so even a POST is safe to resend
+CONNECT_RETRY = Retry(total=3, connect=3, read=0, status=0, other=0,
+                      backoff_factor=0.5, raise_on_status=False)
+
+FIREBASE_REQUEST_SECONDS = REGISTRY.histogram('firebase_request_seconds', 'Latency of Firestore requests')
+FIREBASE_RESPONSES = REGISTRY.counter('firebase_responses_total', 'Firestore responses by status')
+
+
+class ConnectionStats:
+    """Thread-safe counters of pooled connection checkouts and opens"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.opened = 0
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+
+    def record_open(self):
+        with self._lock:
+            self.opened += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.checkouts,
+                'connections_opened': self.opened,
+                'connections_reused': max(self.checkouts - self.opened, 0)
+            }
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report to a ConnectionStats"""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._counting_pool(HTTPConnectionPool),
+            'https': self._counting_pool(HTTPSConnectionPool),
+        }
+
+    def _counting_pool(self, base):
+        stats = self.stats
+
+        class CountingPool(base):
+            def _get_conn(self, timeout=None):
+                stats.record_checkout()
+                return super()._get_conn(timeout=timeout)
+
+            def _new_conn(self):
+                stats.record_open()
+                return super()._new_conn()
+
+        return CountingPool
+
+
+class TTLCache:
+    """Thread-safe key/value cache whose entries expire after ttl seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 class FirebaseManager:
     def __init__(self, config):
@@ -15,18 +177,61 @@ class FirebaseManager:
         self.auth_domain = config.get('authDomain')
         self.database_url = config.get('databaseURL')
         self.storage_bucket = config.get('storageBucket')
+        self.identity_url = config.get('identityToolkitURL') or IDENTITY_TOOLKIT_URL
+        self.secure_token_url = config.get('secureTokenURL') or SECURE_TOKEN_URL
+        self.firestore_url = config.get('firestoreURL') or FIRESTORE_URL
         
         self.auth_token = None
+        self.refresh_token = None
+        self.token_expires_at = 0.0
+        self.token_lifetime = 3600.0
         self.user_id = None
         self.last_sync = None
-        self._sync_lock = Lock()
+
+        # Token state is read by every sync thread and replaced by refreshes
+        self._token_lock = Lock()
+        self._refresh_lock = Lock()
+        self._stop_event = Event()
+        self._token_changed = Event()
+        self._token_refresher = None
+        self.sync_executor = SyncExecutor(max_workers=SYNC_WORKERS)
+        self.aggregation_cache = TTLCache(AGGREGATION_CACHE_TTL)
+
+        # One keep-alive session shared by every call, so requests reuse
+        # pooled TCP/TLS connections instead of handshaking each time
+        self.connection_stats = ConnectionStats()
+        self.session = requests.Session()
+        adapter = CountingHTTPAdapter(self.connection_stats, pool_connections=4,
+                                      pool_maxsize=POOL_SIZE, max_retries=CONNECT_RETRY)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Connectivity probes must answer fast: one attempt, no retries
+        self.probe_session = requests.Session()
+        probe_adapter = CountingHTTPAdapter(self.connection_stats, pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.probe_session.mount('https://', probe_adapter)
+        self.probe_session.mount('http://', probe_adapter)
         
         logging.info(f"Firebase manager initialized for project: {self.project_id}")
 
+    def get_connection_stats(self):
+        """Get counters of requests and pooled connections opened vs. reused"""
+        return self.connection_stats.snapshot()
+
+    def close(self):
+        """Close the pooled HTTP connections, the sync workers and the token refresher"""
+        try:
+            self._stop_event.set()
+            self._token_changed.set()
+            self.sync_executor.shutdown()
+            self.session.close()
+            self.probe_session.close()
+        except Exception as e:
+            logging.error(f"Error closing Firebase session: {e}")
+
     def is_online(self):
         """Check if Firebase is accessible"""
         try:
-            response = requests.get(f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.api_key}", timeout=5)
+            response = self.probe_session.get(f"{self.identity_url}/accounts:signInWithPassword?key={self.api_key}", timeout=TIMEOUTS['probe'])
             return response.status_code in [400, 200]  # 400 is expected for GET without data
         except:
             return False
@@ -34,7 +239,7 @@ class FirebaseManager:
     def authenticate_user(self, username, password):
         """Authenticate user with Firebase Auth"""
         try:
-            url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.api_key}"
+            url = f"{self.identity_url}/accounts:signInWithPassword?key={self.api_key}"
             
             # For simplicity, we'll use email format for username
             email = username if '@' in username else f"{username}@inventario.app"
@@ -45,12 +250,12 @@ class FirebaseManager:
                 "returnSecureToken": True
             }
             
-            response = requests.post(url, json=payload, timeout=10)
+            response = self.session.post(url, json=payload, timeout=TIMEOUTS['auth'])
             
             if response.status_code == 200:
                 data = response.json()
-                self.auth_token = data.get('idToken')
                 self.user_id = data.get('localId')
+                self._store_tokens(data.get('idToken'), data.get('refreshToken'), data.get('expiresIn'))
                 logging.info(f"User authenticated successfully: {username}")
                 return True, "Authentication successful"
             else:
@@ -69,7 +274,7 @@ class FirebaseManager:
     def create_user(self, username, password):
         """Create new user in Firebase Auth"""
         try:
-            url = f"https://identitytoolkit.googleapis.com/v1/accounts:signUp?key={self.api_key}"
+            url = f"{self.identity_url}/accounts:signUp?key={self.api_key}"
             
             email = username if '@' in username else f"{username}@inventario.app"
             
@@ -79,12 +284,12 @@ class FirebaseManager:
                 "returnSecureToken": True
             }
             
-            response = requests.post(url, json=payload, timeout=10)
+            response = self.session.post(url, json=payload, timeout=TIMEOUTS['auth'])
             
             if response.status_code == 200:
                 data = response.json()
-                self.auth_token = data.get('idToken')
                 self.user_id = data.get('localId')
+                self._store_tokens(data.get('idToken'), data.get('refreshToken'), data.get('expiresIn'))
                 logging.info(f"User created successfully: {username}")
                 return True, "User created successfully"
             else:
@@ -100,52 +305,218 @@ class FirebaseManager:
             logging.error(f"Error during user creation: {e}")
             return False, str(e)
 
+    def _store_tokens(self, id_token, refresh_token, expires_in):
+        """Replace the token state and make sure the background refresher runs"""
+        with self._token_lock:
+            self.auth_token = id_token
+            if refresh_token:
+                self.refresh_token = refresh_token
+            self.token_lifetime = float(expires_in or 3600)
+            self.token_expires_at = time.time() + self.token_lifetime
+        self._token_changed.set()
+
+        if self.refresh_token and (self._token_refresher is None or not self._token_refresher.is_alive()):
+            self._token_refresher = Thread(target=self._refresh_loop, name='token-refresh', daemon=True)
+            self._token_refresher.start()
+
+    def _refresh_margin(self):
+        """Seconds before expiry to refresh at; call with _token_lock held.
+
+        Short-lived tokens are refreshed at half their lifetime, so a
+        fresh token is never already due.
+        """
+        return min(TOKEN_REFRESH_MARGIN, self.token_lifetime / 2)
+
+    def _refresh_loop(self):
+        """Refresh the ID token shortly before it expires"""
+        while not self._stop_event.is_set():
+            self._token_changed.clear()
+            with self._token_lock:
+                due_in = self.token_expires_at - self._refresh_margin() - time.time()
+            if due_in > 0:
+                delay = due_in
+            elif self.refresh_auth_token(force=True):
+                delay = TOKEN_MIN_REFRESH_DELAY
+                # Wait out the delay even though the refresh set _token_changed
+                self._token_changed.clear()
+            else:
+                delay = TOKEN_RETRY_INTERVAL
+            # A new token (e.g. after a login or a 401 refresh) reschedules
+            self._token_changed.wait(max(delay, TOKEN_MIN_REFRESH_DELAY))
+
+    def _authorized_request(self, method, url, **kwargs):
+        """Send a Firestore request with the current ID token.
+
+        A 401 means the token expired before the background refresh got to
+        it; the token is refreshed and the request replayed once.
+        """
+        with self._token_lock:
+            token = self.auth_token
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        response = self._timed_request(method, url, headers, kwargs)
+
+        if response.status_code == 401 and self.refresh_auth_token(failed_token=token):
+            with self._token_lock:
+                headers["Authorization"] = f"Bearer {self.auth_token}"
+            logging.info(f"Replaying {method} after token refresh")
+            SYNC_RETRIES.inc(reason='auth')
+            response = self._timed_request(method, url, headers, kwargs)
+        return response
+
+    def _timed_request(self, method, url, headers, kwargs):
+        """Send a request, recording its latency and status in the metrics"""
+        # Label by operation (e.g. 'batchWrite'), never by document, so the
+        # number of series stays small
+        last_segment = url.rsplit('/', 1)[-1]
+        operation = last_segment.rsplit(':', 1)[1] if ':' in last_segment else method.lower()
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException:
+            FIREBASE_RESPONSES.inc(operation=operation, status='error')
+            raise
+        FIREBASE_REQUEST_SECONDS.observe(time.perf_counter() - start, operation=operation)
+        FIREBASE_RESPONSES.inc(operation=operation, status=str(response.status_code))
+        return response
+
+    def _documents_url(self):
+        """Base URL of the project's Firestore documents"""
+        return f"{self.firestore_url}/projects/{self.project_id}/databases/(default)/documents"
+
+    def _document_name(self, document_id, collection='inventory'):
+        """Full resource name of an inventory (or tombstone) document"""
+        return f"projects/{self.project_id}/databases/(default)/documents/{collection}/{document_id}"
+
+    def _record_to_fields(self, record_data):
+        """Convert a local record to Firestore document fields"""
+        return encode_inventory_fields(record_data, self.user_id)
+
     def sync_record(self, record_data):
-        """Sync individual record to Firestore"""
+        """Sync individual record to Firestore.
+
+        The document is written to inventory/{local_id} as a create-or-update,
+        so retrying after a lost response never creates a duplicate. Returns
+        (True, document_id) on success and (False, error message) otherwise.
+        """
+        document_id = record_data.get('local_id')
+        if not document_id:
+            return False, "Record has no local_id"
+
+        # A single-change batch, so the upload is stamped with updated_at
+        _, results = self.sync_changes_batch([{'op': 'update', 'document_id': document_id,
+                                               'record': record_data}])
+        success, message = results[0]
+        if success:
+            logging.info(f"Record synced successfully: {record_data.get('codigo_barras')}")
+            return True, document_id
+        return False, message
+
+    def delete_record(self, firebase_id, local_id=None):
+        """Delete a synced record's document from Firestore, leaving a tombstone"""
+        _, results = self.sync_changes_batch([{'op': 'delete', 'document_id': firebase_id,
+                                               'local_id': local_id or firebase_id}])
+        success, message = results[0]
+        if success:
+            logging.info(f"Record deleted from Firebase: {firebase_id}")
+            return True, "Record deleted successfully"
+        return False, message
+
+    def _change_writes(self, change):
+        """The batchWrite writes that apply one change"""
+        document_id = change['document_id']
+        if change['op'] == 'delete':
+            # The tombstone is written first: a delete that only half
+            # succeeded is retried, and a tombstone alone deletes nothing
+            # that the retry will not delete anyway
+            tombstone = {
+                "local_id": {"stringValue": str(change.get('local_id') or document_id)},
+                "user_id": {"stringValue": str(self.user_id)}
+            }
+            return [
+                {"update": {"name": self._document_name(document_id, TOMBSTONE_COLLECTION), "fields": tombstone},
+                 "updateTransforms": [UPDATED_AT_TRANSFORM]},
+                {"delete": self._document_name(document_id)}
+            ]
+        return [{
+            "update": {"name": self._document_name(document_id), "fields": self._record_to_fields(change['record'])},
+            "updateMask": {"fieldPaths": list(INVENTORY_FIELDS)},
+            "updateTransforms": [UPDATED_AT_TRANSFORM]
+        }]
+
+    def sync_changes_batch(self, changes):
+        """Send up to MAX_BATCH_WRITES changes in one Firestore batchWrite.
+
+        Each change is a dict with 'op' ('insert', 'update' or 'delete'),
+        'document_id' and, except for deletes, 'record'. Records are written
+        to inventory/{document_id} as a create-or-update limited to
+        INVENTORY_FIELDS, so resending a change is idempotent, and stamped
+        with the server's updated_at. A delete removes the document and
+        writes a tombstone to TOMBSTONE_COLLECTION (deletes may carry the
+        record's 'local_id' for it); as that takes two writes, the writes
+        are sent in as many requests as MAX_BATCH_WRITES requires.
+        batchWrite applies every write on its own, so the result is
+        (status_code, results) with one (success, message) per change in
+        the same order; a change succeeds when all of its writes did.
+        status_code is the HTTP status, 429/503 when individual writes were
+        rejected for overload, or None when the request did not complete.
+        """
+        if not changes:
+            return 200, []
         try:
+            if len(changes) > MAX_BATCH_WRITES:
+                raise ValueError(f"At most {MAX_BATCH_WRITES} changes per batch")
             if not self.auth_token:
-                return False, "Not authenticated"
+                return None, [(False, "Not authenticated")] * len(changes)
 
-            with self._sync_lock:
-                # Prepare Firestore document
-                firestore_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents/inventory"
-                
-                headers = {
-                    "Authorization": f"Bearer {self.auth_token}",
-                    "Content-Type": "application/json"
-                }
-                
-                # Convert record to Firestore format
-                document = {
-                    "fields": {
-                        "codigo_barras": {"stringValue": str(record_data.get('codigo_barras', ''))},
-                        "descripcion": {"stringValue": str(record_data.get('descripcion', ''))},
-                        "cantidad": {"integerValue": str(record_data.get('cantidad', 0))},
-                        "auditor": {"stringValue": str(record_data.get('auditor', ''))},
-                        "locacion": {"stringValue": str(record_data.get('locacion', ''))},
-                        "timestamp": {"timestampValue": record_data.get('timestamp', datetime.now().isoformat() + 'Z')},
-                        "user_id": {"stringValue": str(self.user_id)},
-                        "local_id": {"stringValue": str(record_data.get('local_id', ''))},
-                        "sync_status": {"booleanValue": True}
-                    }
-                }
-                
-                response = requests.post(firestore_url, json=document, headers=headers, timeout=15)
-                
-                if response.status_code in [200, 201]:
-                    logging.info(f"Record synced successfully: {record_data.get('codigo_barras')}")
-                    return True, "Record synced successfully"
-                else:
-                    error_msg = f"Sync failed with status {response.status_code}"
+            writes = []
+            owners = []
+            for index, change in enumerate(changes):
+                for write in self._change_writes(change):
+                    writes.append(write)
+                    owners.append(index)
+
+            errors = [None] * len(changes)
+            status_code = 200
+            for start in range(0, len(writes), MAX_BATCH_WRITES):
+                chunk = writes[start:start + MAX_BATCH_WRITES]
+                chunk_owners = owners[start:start + MAX_BATCH_WRITES]
+
+                # A batch rejected for an expired token is sent once more after a refresh
+                response = self._authorized_request('POST', f"{self._documents_url()}:batchWrite",
+                                                    json={"writes": chunk}, timeout=TIMEOUTS['batch'])
+
+                if response.status_code != 200:
+                    error_msg = f"Batch sync failed with status {response.status_code}"
                     logging.warning(error_msg)
-                    return False, error_msg
-                    
+                    status_code = response.status_code
+                    for index in chunk_owners:
+                        errors[index] = errors[index] or error_msg
+                    continue
+
+                # One google.rpc.Status per write; code 0 (or an empty status) is OK
+                statuses = response.json().get('status', [])
+                for offset, index in enumerate(chunk_owners):
+                    status = statuses[offset] if offset < len(statuses) else {}
+                    code = status.get('code', 0)
+                    if code != 0:
+                        errors[index] = errors[index] or status.get('message', f"Write failed with code {code}")
+                        status_code = THROTTLE_WRITE_CODES.get(code, status_code)
+
+            results = [(True, "Record synced successfully") if error is None else (False, error)
+                       for error in errors]
+            success_count = sum(1 for success, _ in results if success)
+            logging.info(f"Batch synced {success_count} of {len(changes)} changes")
+            return status_code, results
+
         except requests.RequestException as e:
-            logging.error(f"Network error during sync: {e}")
-            return False, "Network error"
+            logging.error(f"Network error during batch sync: {e}")
+            return None, [(False, "Network error")] * len(changes)
         except Exception as e:
-            logging.error(f"Error syncing record: {e}")
-            return False, str(e)
+            logging.error(f"Error in batch sync: {e}")
+            return None, [(False, str(e))] * len(changes)
 
     def sync_multiple_records(self, records):
         """Sync multiple records to Firebase"""
@@ -153,17 +524,28 @@ class FirebaseManager:
             if not self.auth_token:
                 return 0
 
-            success_count = 0
-            
-            for record in records:
-                success, message = self.sync_record(record)
-                if success:
-                    success_count += 1
-                else:
-                    logging.warning(f"Failed to sync record {record.get('local_id')}: {message}")
-                
-                # Small delay to avoid rate limiting
-                time.sleep(0.1)
+            changes = [{'op': 'update', 'document_id': record.get('local_id'), 'record': record}
+                       for record in records if record.get('local_id')]
+            position = 0
+
+            def next_batch(size):
+                nonlocal position
+                batch = changes[position:position + min(size, MAX_BATCH_WRITES)]
+                position += len(batch)
+                return batch
+
+            def on_result(batch, results):
+                success_count = 0
+                for change, (success, message) in zip(batch, results):
+                    if success:
+                        success_count += 1
+                    else:
+                        logging.warning(f"Failed to sync record {change['document_id']}: {message}")
+                return success_count
+
+            # Batches run concurrently; pacing comes from the adaptive
+            # controller instead of a fixed delay between records
+            success_count = self.sync_executor.run(next_batch, self.sync_changes_batch, on_result)
             
             logging.info(f"Synced {success_count} of {len(records)} records")
             return success_count
@@ -172,107 +554,159 @@ class FirebaseManager:
             logging.error(f"Error syncing multiple records: {e}")
             return 0
 
-    def fetch_updates(self, last_sync_timestamp=None):
-        """Fetch updates from Firebase since last sync"""
-        try:
-            if not self.auth_token:
-                return []
+    def _fetch_changed_documents(self, collection, watermark, page_size):
+        """Stream documents of a collection by updated_at, one page at a time.
 
-            firestore_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents/inventory"
-            
-            headers = {
-                "Authorization": f"Bearer {self.auth_token}",
-                "Content-Type": "application/json"
+        watermark is the (updated_at timestampValue, document name) of the
+        last document applied, or None to start from the beginning. The
+        first page reaches PULL_OVERLAP_SECONDS behind it; later pages
+        resume right after the last document of the previous one, with
+        documents sharing an updated_at told apart by name. Documents
+        without updated_at (uploaded before it existed) are not returned.
+        Yields (documents, watermark) per page. Stops early, after logging,
+        on any error.
+        """
+        if not self.auth_token:
+            return
+
+        query_url = f"{self._documents_url()}:runQuery"
+        cursor = None
+        if watermark:
+            since = decode_value({"timestampValue": watermark[0]}) - timedelta(seconds=PULL_OVERLAP_SECONDS)
+            cursor = [encode_value(since)]
+        while True:
+            query = {
+                "from": [{"collectionId": collection}],
+                "orderBy": [
+                    {"field": {"fieldPath": UPDATED_AT_FIELD}, "direction": "ASCENDING"},
+                    {"field": {"fieldPath": "__name__"}, "direction": "ASCENDING"}
+                ],
+                "limit": page_size
             }
-            
-            # Add timestamp filter if provided
-            params = {}
-            if last_sync_timestamp:
-                params['orderBy'] = 'timestamp'
-                params['where'] = f'timestamp > {last_sync_timestamp}'
-            
-            response = requests.get(firestore_url, headers=headers, params=params, timeout=15)
-            
-            if response.status_code == 200:
-                data = response.json()
-                documents = data.get('documents', [])
-                
-                updates = []
-                for doc in documents:
-                    fields = doc.get('fields', {})
-                    update = {
-                        'firebase_id': doc.get('name', '').split('/')[-1],
-                        'codigo_barras': fields.get('codigo_barras', {}).get('stringValue', ''),
-                        'descripcion': fields.get('descripcion', {}).get('stringValue', ''),
-                        'cantidad': int(fields.get('cantidad', {}).get('integerValue', 0)),
-                        'auditor': fields.get('auditor', {}).get('stringValue', ''),
-                        'locacion': fields.get('locacion', {}).get('stringValue', ''),
-                        'timestamp': fields.get('timestamp', {}).get('timestampValue', ''),
-                        'user_id': fields.get('user_id', {}).get('stringValue', ''),
-                        'local_id': fields.get('local_id', {}).get('stringValue', '')
-                    }
-                    updates.append(update)
-                
-                logging.info(f"Fetched {len(updates)} updates from Firebase")
-                return updates
-            else:
-                logging.warning(f"Failed to fetch updates: {response.status_code}")
-                return []
-                
-        except requests.RequestException as e:
-            logging.error(f"Network error fetching updates: {e}")
-            return []
-        except Exception as e:
-            logging.error(f"Error fetching updates: {e}")
-            return []
+            if cursor:
+                # A bare time starts at it; a (time, name) pair starts after that document
+                query["startAt"] = {"values": cursor, "before": len(cursor) == 1}
+
+            try:
+                response = self._authorized_request('POST', query_url, json={"structuredQuery": query},
+                                                    timeout=TIMEOUTS['query'])
+                if response.status_code != 200:
+                    logging.warning(f"Failed to fetch {collection} changes: {response.status_code}")
+                    return
+
+                documents = [item['document'] for item in response.json() if item.get('document')]
+            except requests.RequestException as e:
+                logging.error(f"Network error fetching {collection} changes: {e}")
+                return
+            except Exception as e:
+                logging.error(f"Error fetching {collection} changes: {e}")
+                return
+
+            if not documents:
+                return
+            # The watermark keeps the server's exact time for the cursor
+            last = documents[-1]
+            watermark = (last['fields'][UPDATED_AT_FIELD]['timestampValue'], last['name'])
+            cursor = [{"timestampValue": watermark[0]}, {"referenceValue": watermark[1]}]
+            yield documents, watermark
+            if len(documents) < page_size:
+                return
+
+    def fetch_updates(self, watermark=None, page_size=PULL_PAGE_SIZE):
+        """Stream inventory documents uploaded since a watermark, one page at a time.
+
+        Yields (updates, watermark) per page: the decoded records, with
+        firebase_id set, and the position to store once they are applied.
+        See _fetch_changed_documents for the watermark.
+        """
+        decode = INVENTORY_CODEC.decode
+        for documents, watermark in self._fetch_changed_documents('inventory', watermark, page_size):
+            updates = []
+            for doc in documents:
+                update = decode(doc.get('fields', {}))
+                update['firebase_id'] = document_id = doc['name'].rsplit('/', 1)[-1]
+                if not update['local_id']:
+                    update['local_id'] = document_id
+                updates.append(update)
+            logging.info(f"Fetched {len(updates)} updates from Firebase")
+            yield updates, watermark
+
+    def fetch_deletes(self, watermark=None, page_size=PULL_PAGE_SIZE):
+        """Stream the tombstones of deleted documents since a watermark, one page at a time.
+
+        Yields (deletes, watermark) per page, where deletes are
+        (local_id, firebase_id) pairs.
+        """
+        for documents, watermark in self._fetch_changed_documents(TOMBSTONE_COLLECTION, watermark, page_size):
+            deletes = []
+            for doc in documents:
+                document_id = doc['name'].rsplit('/', 1)[-1]
+                local_id = doc.get('fields', {}).get('local_id', {}).get('stringValue') or document_id
+                deletes.append((local_id, document_id))
+            logging.info(f"Fetched {len(deletes)} deletes from Firebase")
+            yield deletes, watermark
+
+    @staticmethod
+    def _timestamp_bound(value, end=False):
+        """Firestore timestamp filter value and operator for a date bound.
+
+        value may be a datetime, a SQLite timestamp or a 'YYYY-MM-DD' date.
+        A date as end bound covers that whole day.
+        """
+        if isinstance(value, datetime):
+            return encode_value(value), 'LESS_THAN_OR_EQUAL' if end else 'GREATER_THAN_OR_EQUAL'
+        value = str(value)
+        if len(value) == 10:
+            day = datetime.strptime(value, '%Y-%m-%d')
+            if end:
+                return encode_value(day + timedelta(days=1)), 'LESS_THAN'
+            return encode_value(day), 'GREATER_THAN_OR_EQUAL'
+        return {"timestampValue": to_rfc3339(value)}, 'LESS_THAN_OR_EQUAL' if end else 'GREATER_THAN_OR_EQUAL'
+
+    def _inventory_filter(self, user_id=None, auditor=None, start_date=None, end_date=None):
+        """Structured query filter over inventory documents, or None for no filter"""
+        filters = []
+        for field, value in (('user_id', user_id), ('auditor', auditor)):
+            if value:
+                filters.append({"fieldFilter": {
+                    "field": {"fieldPath": field}, "op": "EQUAL", "value": {"stringValue": str(value)}}})
+        for bound, is_end in ((start_date, False), (end_date, True)):
+            if bound:
+                value, op = self._timestamp_bound(bound, end=is_end)
+                filters.append({"fieldFilter": {"field": {"fieldPath": "timestamp"}, "op": op, "value": value}})
 
-    def get_audit_trail(self, user_id=None, start_date=None, end_date=None):
-        """Get audit trail of inventory operations"""
+        if not filters:
+            return None
+        if len(filters) == 1:
+            return filters[0]
+        return {"compositeFilter": {"op": "AND", "filters": filters}}
+
+    def get_audit_trail(self, user_id=None, start_date=None, end_date=None, limit=AUDIT_TRAIL_LIMIT):
+        """Get the newest inventory documents matching the filters, newest first"""
         try:
             if not self.auth_token:
                 return []
 
-            firestore_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents/inventory"
-            
-            headers = {
-                "Authorization": f"Bearer {self.auth_token}",
-                "Content-Type": "application/json"
+            query = {
+                "from": [{"collectionId": "inventory"}],
+                "orderBy": [{"field": {"fieldPath": "timestamp"}, "direction": "DESCENDING"}],
+                "limit": limit
             }
-            
-            # Build query parameters
-            params = {'orderBy': 'timestamp desc'}
-            
-            # Add filters if provided
-            filters = []
-            if user_id:
-                filters.append(f'user_id = "{user_id}"')
-            if start_date:
-                filters.append(f'timestamp >= "{start_date}"')
-            if end_date:
-                filters.append(f'timestamp <= "{end_date}"')
-            
-            if filters:
-                params['where'] = ' AND '.join(filters)
-            
-            response = requests.get(firestore_url, headers=headers, params=params, timeout=15)
+            where = self._inventory_filter(user_id=user_id, start_date=start_date, end_date=end_date)
+            if where:
+                query["where"] = where
+
+            response = self._authorized_request('POST', f"{self._documents_url()}:runQuery",
+                                                json={"structuredQuery": query}, timeout=TIMEOUTS['query'])
             
             if response.status_code == 200:
-                data = response.json()
-                documents = data.get('documents', [])
-                
                 audit_records = []
-                for doc in documents:
-                    fields = doc.get('fields', {})
-                    record = {
-                        'firebase_id': doc.get('name', '').split('/')[-1],
-                        'codigo_barras': fields.get('codigo_barras', {}).get('stringValue', ''),
-                        'descripcion': fields.get('descripcion', {}).get('stringValue', ''),
-                        'cantidad': int(fields.get('cantidad', {}).get('integerValue', 0)),
-                        'auditor': fields.get('auditor', {}).get('stringValue', ''),
-                        'locacion': fields.get('locacion', {}).get('stringValue', ''),
-                        'timestamp': fields.get('timestamp', {}).get('timestampValue', ''),
-                        'user_id': fields.get('user_id', {}).get('stringValue', '')
-                    }
+                for item in response.json():
+                    doc = item.get('document')
+                    if not doc:
+                        continue
+                    record = INVENTORY_CODEC.decode(doc.get('fields', {}))
+                    record['firebase_id'] = doc.get('name', '').rsplit('/', 1)[-1]
                     audit_records.append(record)
                 
                 logging.info(f"Retrieved {len(audit_records)} audit records")
@@ -288,13 +722,121 @@ class FirebaseManager:
             logging.error(f"Error getting audit trail: {e}")
             return []
 
-    def refresh_auth_token(self):
-        """Refresh authentication token if needed"""
+    def get_audit_totals(self, auditor=None, user_id=None, start_date=None, end_date=None):
+        """Count and summed quantity of the matching inventory documents.
+
+        Computed server-side with runAggregationQuery, so it costs one read
+        per 1000 matching index entries instead of one per document.
+        Filtering on auditor or user_id together with dates needs a
+        composite index on (field, timestamp). Results are cached for
+        AGGREGATION_CACHE_TTL seconds. Returns {'count', 'total_quantity'}
+        or None on error.
+        """
+        key = ('totals', auditor, user_id, str(start_date or ''), str(end_date or ''))
+        cached = self.aggregation_cache.get(key)
+        if cached is not None:
+            return cached
+
+        try:
+            if not self.auth_token:
+                return None
+
+            query = {"from": [{"collectionId": "inventory"}]}
+            where = self._inventory_filter(user_id=user_id, auditor=auditor,
+                                           start_date=start_date, end_date=end_date)
+            if where:
+                query["where"] = where
+
+            aggregation = {
+                "structuredQuery": query,
+                "aggregations": [
+                    {"alias": "count", "count": {}},
+                    {"alias": "total_quantity", "sum": {"field": {"fieldPath": "cantidad"}}}
+                ]
+            }
+            response = self._authorized_request('POST', f"{self._documents_url()}:runAggregationQuery",
+                                                json={"structuredAggregationQuery": aggregation},
+                                                timeout=TIMEOUTS['query'])
+
+            if response.status_code != 200:
+                logging.warning(f"Failed to aggregate audit totals: {response.status_code}")
+                return None
+
+            fields = {}
+            for item in response.json():
+                if 'result' in item:
+                    fields = item['result'].get('aggregateFields', {})
+            totals = {
+                'count': decode_value(fields.get('count', {'integerValue': '0'})) or 0,
+                'total_quantity': decode_value(fields.get('total_quantity', {'integerValue': '0'})) or 0
+            }
+            self.aggregation_cache.put(key, totals)
+            return totals
+
+        except requests.RequestException as e:
+            logging.error(f"Network error aggregating audit totals: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"Error aggregating audit totals: {e}")
+            return None
+
+    def get_totals_by_auditor(self, auditors, start_date=None, end_date=None):
+        """Audit totals per auditor, one aggregation each (Firestore has no GROUP BY)"""
+        return {auditor: self.get_audit_totals(auditor=auditor, start_date=start_date, end_date=end_date)
+                for auditor in auditors}
+
+    def get_daily_totals(self, start_date, end_date, auditor=None):
+        """Audit totals per day from start_date to end_date ('YYYY-MM-DD', inclusive).
+
+        Returns a list of (date, totals) with one aggregation per day.
+        """
+        day = datetime.strptime(str(start_date)[:10], '%Y-%m-%d').date()
+        last = datetime.strptime(str(end_date)[:10], '%Y-%m-%d').date()
+        totals = []
+        while day <= last:
+            date = day.isoformat()
+            totals.append((date, self.get_audit_totals(auditor=auditor, start_date=date, end_date=date)))
+            day += timedelta(days=1)
+        return totals
+
+    def refresh_auth_token(self, force=False, failed_token=None):
+        """Exchange the refresh token for a new ID token.
+
+        Without force, only refreshes when the token is within its refresh
+        margin of expiring. failed_token is the token a request
+        was rejected with; if another thread already replaced it, that
+        refresh is reused instead of starting a new one.
+        """
         try:
-            # This would typically use a refresh token
-            # For simplicity, we'll assume the token is valid for the session
-            logging.info("Auth token refresh not implemented - using session token")
-            return True
+            with self._refresh_lock:
+                with self._token_lock:
+                    refresh_token = self.refresh_token
+                    if failed_token is not None and self.auth_token != failed_token:
+                        return True
+                    fresh = self.token_expires_at - self._refresh_margin() > time.time()
+                if failed_token is None and not force and fresh:
+                    return True
+                if not refresh_token:
+                    logging.warning("Cannot refresh auth token: no refresh token")
+                    return False
+
+                response = self.session.post(
+                    f"{self.secure_token_url}/token?key={self.api_key}",
+                    data={"grant_type": "refresh_token", "refresh_token": refresh_token},
+                    timeout=TIMEOUTS['auth'])
+
+                if response.status_code == 200:
+                    data = response.json()
+                    self._store_tokens(data.get('id_token'), data.get('refresh_token'), data.get('expires_in'))
+                    logging.info("Auth token refreshed")
+                    return True
+                else:
+                    logging.warning(f"Auth token refresh failed: {response.status_code}")
+                    return False
+
+        except requests.RequestException as e:
+            logging.error(f"Network error refreshing auth token: {e}")
+            return False
         except Exception as e:
             logging.error(f"Error refreshing auth token: {e}")
             return False
@@ -315,16 +857,11 @@ class FirebaseManager:
                 return False, "Not authenticated"
             
             # Test connection with a simple query
-            firestore_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents/inventory"
-            
-            headers = {
-                "Authorization": f"Bearer {self.auth_token}",
-                "Content-Type": "application/json"
-            }
+            firestore_url = f"{self._documents_url()}/inventory"
             
             params = {'pageSize': 1}
             
-            response = requests.get(firestore_url, headers=headers, params=params, timeout=10)
+            response = self._authorized_request('GET', firestore_url, params=params, timeout=TIMEOUTS['probe'])
             
             if response.status_code == 200:
                 return True, "Connection validated"
@@ -0,0 +1,230 @@
+import base64
+from collections import namedtuple
+from datetime import datetime, timezone
+
+GeoPoint = namedtuple('GeoPoint', 'latitude longitude')
+
+
+class Reference(str):
+    """A Firestore document reference, kept apart from plain strings"""
+    __slots__ = ()
+
+
+def to_rfc3339(timestamp):
+    """Convert a SQLite 'YYYY-MM-DD HH:MM:SS' UTC timestamp to RFC 3339"""
+    timestamp = str(timestamp)
+    if 'T' in timestamp:
+        return timestamp
+    return timestamp.replace(' ', 'T') + 'Z'
+
+
+def _parse_rfc3339(timestamp):
+    """Parse an RFC 3339 timestamp, which may carry nanoseconds, to an aware datetime"""
+    value = timestamp.replace('Z', '+00:00')
+    # fromisoformat only takes up to microseconds
+    if '.' in value:
+        whole, rest = value.split('.', 1)
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        value = f"{whole}.{rest[:min(digits, 6)]}{rest[digits:]}"
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def from_rfc3339(timestamp):
+    """Convert an RFC 3339 timestamp to SQLite's 'YYYY-MM-DD HH:MM:SS' in UTC"""
+    if not timestamp:
+        return None
+    # The common case, whole seconds in UTC, needs no parsing
+    if len(timestamp) == 20 and timestamp[10] == 'T' and timestamp[19] == 'Z':
+        return f"{timestamp[:10]} {timestamp[11:19]}"
+    parsed = _parse_rfc3339(timestamp).astimezone(timezone.utc)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def encode_value(value):
+    """Encode any Python value as a Firestore Value"""
+    # bool before int: bool is a subclass of int
+    if value is None:
+        return {'nullValue': None}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'integerValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, Reference):
+        return {'referenceValue': str(value)}
+    if isinstance(value, str):
+        return {'stringValue': value}
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return {'timestampValue': value.isoformat() + 'Z'}
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytesValue': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, GeoPoint):
+        return {'geoPointValue': {'latitude': value.latitude, 'longitude': value.longitude}}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [encode_value(item) for item in value]}}
+    if isinstance(value, dict):
+        return {'mapValue': {'fields': {key: encode_value(item) for key, item in value.items()}}}
+    raise TypeError(f"Cannot encode {type(value).__name__} as a Firestore value")
+
+
+def decode_value(value):
+    """Decode any Firestore Value to a Python value"""
+    for tag, raw in value.items():
+        decoder = _VALUE_DECODERS.get(tag)
+        if decoder is not None:
+            return decoder(raw)
+    return None
+
+
+_VALUE_DECODERS = {
+    'nullValue': lambda raw: None,
+    'booleanValue': bool,
+    'integerValue': int,
+    'doubleValue': float,
+    'timestampValue': _parse_rfc3339,
+    'stringValue': str,
+    'bytesValue': base64.b64decode,
+    'referenceValue': Reference,
+    'geoPointValue': lambda raw: GeoPoint(raw.get('latitude', 0.0), raw.get('longitude', 0.0)),
+    'arrayValue': lambda raw: [decode_value(item) for item in raw.get('values', [])],
+    'mapValue': lambda raw: {key: decode_value(item) for key, item in raw.get('fields', {}).items()},
+}
+
+
+def _utc_sqlite(value):
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Field kinds of a DocumentCodec spec: the value tag and the Python
+# expression that decodes a raw tagged value {raw}. Values of any other tag
+# go through decode_value and are converted by the kind's entry in
+# FIELD_COERCIONS.
+FIELD_KINDS = {
+    'string': ('stringValue', '{raw}'),
+    'integer': ('integerValue', 'int({raw})'),
+    'double': ('doubleValue', 'float({raw})'),
+    'boolean': ('booleanValue', '{raw}'),
+    # Kept in SQLite's text format locally, a timestamp in Firestore
+    'timestamp': ('timestampValue', 'from_rfc3339({raw})'),
+    'bytes': ('bytesValue', 'b64decode({raw})'),
+    'reference': ('referenceValue', 'Reference({raw})'),
+}
+
+FIELD_COERCIONS = {
+    'string': str,
+    'integer': int,
+    'double': float,
+    'boolean': bool,
+    'timestamp': lambda value: _utc_sqlite(value) if isinstance(value, datetime) else from_rfc3339(str(value)),
+    'bytes': bytes,
+    'reference': Reference,
+}
+
+
+def _fallback_decoder(coerce, default):
+    def fallback(value):
+        # Unexpected type (e.g. null, or a double where an integer was expected)
+        raw = decode_value(value)
+        try:
+            return default if raw is None else coerce(raw)
+        except (TypeError, ValueError):
+            return default
+    return fallback
+
+
+class DocumentCodec:
+    """Decodes a document's fields from a fixed field spec.
+
+    spec is a sequence of (field, kind, default) with kind one of
+    FIELD_KINDS. decode is generated once per spec as a straight-line
+    function, so a document costs no per-field dispatch; a missing or null
+    field decodes to its default. Encoding is left to hand-written
+    functions such as encode_inventory_fields: generated encoders were no
+    faster than the dict literals they would replace.
+    """
+
+    def __init__(self, spec):
+        self.spec = tuple(spec)
+        self.field_names = tuple(field for field, _, _ in self.spec)
+
+        namespace = {
+            'from_rfc3339': from_rfc3339,
+            'b64decode': base64.b64decode,
+            'Reference': Reference,
+        }
+        decode_lines = ['def decode(fields):', '    get = fields.get']
+        for index, (field, kind, default) in enumerate(self.spec):
+            tag, decode_expr = FIELD_KINDS[kind]
+            value = f'v{index}'
+            namespace[f'default{index}'] = default
+            namespace[f'fallback{index}'] = _fallback_decoder(FIELD_COERCIONS[kind], default)
+
+            decode_lines += [
+                f'    {value} = get({field!r})',
+                f'    if {value} is None:',
+                f'        {value} = default{index}',
+                f'    elif {tag!r} in {value}:',
+                f'        {value} = {decode_expr.format(raw=f"{value}[{tag!r}]")}',
+                '    else:',
+                f'        {value} = fallback{index}({value})',
+            ]
+
+        fields = ', '.join(f'{field!r}: v{index}' for index, (field, _, _) in enumerate(self.spec))
+        decode_lines.append(f'    return {{{fields}}}')
+
+        exec('\n'.join(decode_lines), namespace)
+        self.decode = namespace['decode']
+        self.decode.__doc__ = "Record dict for a document's fields"
+
+
+
+# The inventory document as written by the sync engine. Fields that are
+# nullable columns locally decode a missing or null value as None, so a
+# pulled row compares equal to the local one it came from
+INVENTORY_CODEC = DocumentCodec((
+    ('codigo_barras', 'string', ''),
+    ('descripcion', 'string', None),
+    ('cantidad', 'integer', 0),
+    ('auditor', 'string', None),
+    ('locacion', 'string', None),
+    ('timestamp', 'timestamp', None),
+    ('user_id', 'string', None),
+    ('local_id', 'string', None),
+    ('sync_status', 'boolean', True),
+))
+
+
+def _string_field(value):
+    return {'nullValue': None} if value is None else {'stringValue': str(value)}
+
+
+def encode_inventory_fields(record, user_id):
+    """Firestore fields of an inventory document for a local record.
+
+    Written out by hand for the upload hot path: strings, the common case,
+    are wrapped without a call, and a missing or None column is written as
+    null, matching what INVENTORY_CODEC decodes back.
+    """
+    codigo_barras = record.get('codigo_barras')
+    descripcion = record.get('descripcion')
+    cantidad = record.get('cantidad')
+    auditor = record.get('auditor')
+    locacion = record.get('locacion')
+    timestamp = record.get('timestamp')
+    local_id = record.get('local_id')
+    return {
+        'codigo_barras': {'stringValue': codigo_barras} if codigo_barras.__class__ is str else _string_field(codigo_barras),
+        'descripcion': {'stringValue': descripcion} if descripcion.__class__ is str else _string_field(descripcion),
+        'cantidad': ({'nullValue': None} if cantidad is None
+                     else {'integerValue': str(cantidad) if cantidad.__class__ is int else str(int(cantidad))}),
+        'auditor': {'stringValue': auditor} if auditor.__class__ is str else _string_field(auditor),
+        'locacion': {'stringValue': locacion} if locacion.__class__ is str else _string_field(locacion),
+        'timestamp': {'nullValue': None} if timestamp is None else {'timestampValue': to_rfc3339(timestamp)},
+        'user_id': {'stringValue': user_id} if user_id.__class__ is str else _string_field(user_id),
+        'local_id': {'stringValue': local_id} if local_id.__class__ is str else _string_field(local_id),
+        'sync_status': {'booleanValue': True},
+    }
@@ -1,6 +1,7 @@
 
 import json
 import os
+import sys
 import sqlite3
 import datetime
 import logging
@@ -8,7 +9,7 @@ import math
 from urllib.parse import quote
 import webbrowser
 from collections import Counter
-from threading import Thread
+from threading import Event, Thread
 import traceback
 import hashlib
 import time
@@ -27,9 +28,11 @@ except ImportError:
 # Import our custom modules
 from logging_config import setup_logging
 from android_utils import AndroidUtils
-from database_manager import DatabaseManager
+from database_manager import DatabaseManager, WriteBehindQueue, PAGE_SIZE
 from file_manager import FileManager
 from firebase_manager import FirebaseManager
+from sync_supervisor import SyncSupervisor, OPEN, HALF_OPEN
+from sync_scheduler import SyncScheduler
 
 # Setup logging first
 setup_logging()
@@ -53,6 +56,7 @@ try:
     from kivy.uix.label import Label
     from kivy.uix.button import Button
     from kivy.uix.popup import Popup
+    from kivy.uix.progressbar import ProgressBar
     from kivy.uix.filechooser import FileChooserListView
     from kivy.uix.spinner import Spinner
     from kivy.uix.widget import Widget
@@ -107,6 +111,9 @@ ERROR_COLOR = (0.86, 0.22, 0.2, 1)
 ORANGE_COLOR = (0.9, 0.5, 0, 1)
 BLUE_EXPORT_COLOR = (0.1, 0.5, 0.9, 1)
 
+# Master items shown for a search in the master screen
+MASTER_SEARCH_LIMIT = 200
+
 # Set window background color safely
 try:
     if Window is not None:
@@ -232,16 +239,23 @@ class FirebaseConfigScreen(BoxLayout):
                 self.status_label.color = ERROR_COLOR
                 return
 
-            config = {
+            config_file = os.path.join(android_utils.get_data_directory(), 'firebase_config.json')
+
+            # Keep settings not shown in the form, such as endpoint overrides
+            config = {}
+            if os.path.exists(config_file):
+                with open(config_file, 'r') as f:
+                    config = json.load(f)
+
+            config.update({
                 'projectId': self.project_id_input.text.strip(),
                 'apiKey': self.api_key_input.text.strip(),
                 'authDomain': self.auth_domain_input.text.strip(),
                 'databaseURL': self.database_url_input.text.strip(),
                 'storageBucket': self.storage_bucket_input.text.strip()
-            }
+            })
 
             # Save to file
-            config_file = os.path.join(android_utils.get_data_directory(), 'firebase_config.json')
             with open(config_file, 'w') as f:
                 json.dump(config, f)
 
@@ -327,18 +341,26 @@ class LoginScreen(BoxLayout):
             logging.error(f"Error building login UI: {e}")
 
     def update_connection_status(self):
-        """Update connection status"""
+        """Update connection status, probing Firebase off the UI thread"""
         if self.app_instance.firebase_enabled and self.app_instance.firebase_manager:
-            if self.app_instance.firebase_manager.is_online():
-                self.connection_status.text = '🟢 Conectado - Firebase Online'
-                self.connection_status.color = SUCCESS_COLOR
-            else:
-                self.connection_status.text = '🟡 Firebase configurado - Sin conexión'
-                self.connection_status.color = ORANGE_COLOR
+            self.connection_status.text = '🟡 Firebase configurado - Comprobando conexión...'
+            self.connection_status.color = ORANGE_COLOR
+            supervisor = self.app_instance.sync_supervisor
+            Thread(target=lambda: self._show_connection_status(supervisor.is_online()), daemon=True).start()
         else:
             self.connection_status.text = '🔴 Modo Offline - Firebase no configurado'
             self.connection_status.color = ERROR_COLOR
 
+    @mainthread
+    def _show_connection_status(self, online):
+        """Show the outcome of a connection probe"""
+        if online:
+            self.connection_status.text = '🟢 Conectado - Firebase Online'
+            self.connection_status.color = SUCCESS_COLOR
+        else:
+            self.connection_status.text = '🟡 Firebase configurado - Sin conexión'
+            self.connection_status.color = ORANGE_COLOR
+
     def login(self, instance):
         """Handle login"""
         try:
@@ -441,17 +463,29 @@ class InventoryScreen(BoxLayout):
         self.spacing = 10
         self.app_instance = app_instance
         self.db_manager = DatabaseManager()
+        self.write_queue = WriteBehindQueue(self.db_manager)
+        self.sync_scheduler = SyncScheduler(self._sync_with_firebase)
         self.sync_status = 'offline'
         self.pending_sync_count = 0
+        # Keyset paging state for the records table
+        self._page_cursor = None
+        self._page_loading = False
+        self._page_search_text = None
+        self._table_generation = 0
+        self._table_row_count = 0
+        # record id -> (labels, record) of the rows in the table, top row first
+        self._table_rows = {}
         self.build_ui()
         Clock.schedule_once(self._delayed_init, 0.1)
 
     def _delayed_init(self, dt):
         """Initialize data after UI is built"""
         Thread(target=self._load_data_thread, daemon=True).start()
-        # Start sync timer if Firebase is enabled
+        # Start the sync scheduler if Firebase is enabled
         if self.app_instance.firebase_enabled:
-            Clock.schedule_interval(self._sync_with_firebase, 30)  # Sync every 30 seconds
+            self.app_instance.sync_supervisor.on_connectivity_change = self.sync_scheduler.notify_network_change
+            self.sync_scheduler.start()
+            self.sync_scheduler.request_sync()
 
     def _load_data_thread(self):
         """Load data in background thread"""
@@ -508,6 +542,7 @@ class InventoryScreen(BoxLayout):
             self.locacion_spinner = Spinner(text='Selecciona Locación', values=[], 
                                           size_hint_y=None, height=dp(44), 
                                           color=WHITE_TEXT_COLOR, background_color=TAB_ACTIVE_COLOR)
+            self.locacion_spinner.bind(text=self._refresh_sku_counts)
             
             widgets = [
                 ('Código:', self.codigo_barras_input), 
@@ -523,6 +558,11 @@ class InventoryScreen(BoxLayout):
             
             input_card.add_widget(fields_layout)
             
+            # Running count of the scanned SKU
+            self.sku_counts_label = Label(text='', font_size='14sp', size_hint_y=None, height=dp(24),
+                                          color=TAB_ACTIVE_COLOR)
+            input_card.add_widget(self.sku_counts_label)
+            
             # Buttons
             buttons_layout = GridLayout(cols=3, size_hint_y=None, height=dp(44), spacing=10)
             self.add_button = Button(text='Agregar', color=WHITE_TEXT_COLOR, background_color=SUCCESS_COLOR)
@@ -570,6 +610,8 @@ class InventoryScreen(BoxLayout):
             self.table_layout = GridLayout(cols=6, size_hint_y=None, row_default_height=dp(40), spacing=1)  # Added sync status column
             self.table_layout.bind(minimum_height=self.table_layout.setter('height'))
             scroll_view.add_widget(self.table_layout)
+            scroll_view.bind(scroll_y=self._on_table_scroll)
+            self.table_scroll = scroll_view
             self.add_widget(scroll_view)
             
             logging.info("UI construida exitosamente")
@@ -581,40 +623,67 @@ class InventoryScreen(BoxLayout):
     def manual_sync(self, instance):
         """Manual synchronization trigger"""
         if self.app_instance.firebase_enabled:
-            Thread(target=self._sync_with_firebase, daemon=True).start()
+            self.sync_scheduler.request_sync(force=True)
         else:
             self.show_popup("Info", "Firebase no está configurado. Trabajando en modo offline.", is_error=False)
 
-    def _sync_with_firebase(self, dt=None):
-        """Sync with Firebase"""
+    def _sync_with_firebase(self, force=False):
+        """Sync with Firebase, unless the sync supervisor is backing off.
+
+        Runs on the sync scheduler's thread; ask sync_scheduler for a sync
+        instead of calling this. Returns the number of records pushed and
+        pulled, or None if no sync was attempted.
+        """
         try:
             if not self.app_instance.firebase_enabled or not self.app_instance.firebase_manager:
-                return
+                return None
+
+            supervisor = self.app_instance.sync_supervisor
+            if not force and not supervisor.allow_attempt():
+                self._update_sync_status('backoff')
+                return None
 
             # Update sync status
             Clock.schedule_once(lambda dt: self._update_sync_status('syncing'))
             
-            # Sync pending records
-            success_count = self.db_manager.sync_pending_records(self.app_instance.firebase_manager)
+            # Sync pending records; the check above already took the attempt
+            success_count = supervisor.run(
+                lambda: self.db_manager.sync_pending_records(self.app_instance.firebase_manager),
+                force=True)
+
+            # Pull what other devices uploaded, unless the push just failed
+            pulled_count = 0
+            if not supervisor.last_push_failed:
+                pulled_count = self.db_manager.pull_remote_updates(self.app_instance.firebase_manager)
             
+            # Probe here, on the scheduler's thread, if the UI will need it
+            online = None
+            if not success_count and not pulled_count and supervisor.status()['retry_in'] == 0:
+                online = supervisor.is_online()
+
             # Update UI
             def update_sync_ui(dt):
-                if success_count > 0:
+                if success_count > 0 or pulled_count > 0:
                     self._update_sync_status('online')
-                    self.status_label.text = f'Sincronizados {success_count} registros'
+                    self.status_label.text = f'Sincronizados {success_count} registros, recibidos {pulled_count}'
                     self.status_label.color = SUCCESS_COLOR
                     Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', ''), 3)
+                elif supervisor.status()['retry_in'] > 0:
+                    self._update_sync_status('backoff')
                 else:
-                    self._update_sync_status('offline' if not self.app_instance.firebase_manager.is_online() else 'online')
+                    self._update_sync_status('online' if online else 'offline')
                 
                 self._update_pending_sync_count()
-                self._display_last_records()
+                self._refresh_records()
             
             Clock.schedule_once(update_sync_ui)
+            self.db_manager.write_metrics_snapshot()
+            return success_count + pulled_count
             
         except Exception as e:
             logging.error(f"Error syncing with Firebase: {e}")
             Clock.schedule_once(lambda dt: self._update_sync_status('error'))
+            return None
 
     @mainthread
     def _update_sync_status(self, status):
@@ -628,10 +697,25 @@ class InventoryScreen(BoxLayout):
         elif status == 'error':
             self.sync_status_label.text = '🔴 Error'
             self.sync_status_label.color = ERROR_COLOR
+        elif status == 'backoff':
+            supervisor_status = self.app_instance.sync_supervisor.status()
+            retry_in = int(math.ceil(supervisor_status['retry_in']))
+            if supervisor_status['state'] in (OPEN, HALF_OPEN):
+                self.sync_status_label.text = f'🔴 Pausado ({retry_in}s)'
+                self.sync_status_label.color = ERROR_COLOR
+            else:
+                self.sync_status_label.text = f'🟡 Reintento en {retry_in}s'
+                self.sync_status_label.color = ORANGE_COLOR
         else:  # offline
             self.sync_status_label.text = '🔴 Offline'
             self.sync_status_label.color = ERROR_COLOR
 
+    def shutdown(self):
+        """Flush queued scans, stop scheduling syncs and close the database"""
+        self.sync_scheduler.stop()
+        self.write_queue.stop()
+        self.db_manager.close()
+
     def _update_pending_sync_count(self):
         """Update pending sync count"""
         try:
@@ -668,19 +752,32 @@ class InventoryScreen(BoxLayout):
             self.status_label.text = "Guardando..."
             self.status_label.color = ORANGE_COLOR
 
-            # Save record in background thread
+            if not self.editing_id:
+                # New scans are group-committed; the UI confirms once on disk
+                def on_committed(success):
+                    message = "Registro agregado correctamente" if success else "Error al guardar el registro"
+                    Clock.schedule_once(lambda dt: self._on_record_saved(success, message))
+                    self._update_pending_sync_count()
+
+                self.write_queue.submit({
+                    'codigo_barras': codigo_barras,
+                    'descripcion': descripcion,
+                    'cantidad': cantidad,
+                    'auditor': auditor,
+                    'locacion': locacion,
+                    'created_by': self.app_instance.current_user
+                }, on_committed)
+                return
+
+            # Save edit in background thread
             def save_record_async():
                 try:
-                    if self.editing_id:
-                        success = self.db_manager.update_record(self.editing_id, codigo_barras, descripcion, cantidad, auditor, locacion)
-                        message = "Registro actualizado correctamente" if success else "Error al actualizar el registro"
-                    else:
-                        success = self.db_manager.add_record_with_sync(codigo_barras, descripcion, cantidad, auditor, locacion, 
-                                                                     self.app_instance.current_user)
-                        message = "Registro agregado correctamente" if success else "Error al guardar el registro"
+                    record_id = self.editing_id
+                    success = self.db_manager.update_record(record_id, codigo_barras, descripcion, cantidad, auditor, locacion)
+                    message = "Registro actualizado correctamente" if success else "Error al actualizar el registro"
                     
                     # Update UI in main thread
-                    Clock.schedule_once(lambda dt: self._on_record_saved(success, message))
+                    Clock.schedule_once(lambda dt: self._on_record_saved(success, message, record_id))
                     
                     # Update pending count
                     self._update_pending_sync_count()
@@ -697,19 +794,19 @@ class InventoryScreen(BoxLayout):
             Clock.schedule_once(lambda dt: self.show_popup("Error", f"Error agregando registro: {e}", is_error=True))
 
     @mainthread
-    def _on_record_saved(self, success, message):
-        """Handle record save completion in main thread"""
+    def _on_record_saved(self, success, message, record_id=None):
+        """Handle record save completion in main thread; record_id is set for edits"""
         try:
             if success:
                 self.clear_fields()
-                self._display_last_records()
+                self._refresh_records((record_id,) if record_id else ())
                 self.status_label.text = message
                 self.status_label.color = SUCCESS_COLOR
                 Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', ''), 3)
                 
-                # Try immediate sync if online
+                # Sync once the scan burst settles
                 if self.app_instance.firebase_enabled:
-                    Thread(target=self._sync_with_firebase, daemon=True).start()
+                    self.sync_scheduler.notify_write()
             else:
                 self.status_label.text = ""
                 self.show_popup("Error", message, is_error=True)
@@ -721,49 +818,192 @@ class InventoryScreen(BoxLayout):
     @mainthread
     def _display_last_records(self):
         """Display last records in table with sync status"""
+        self._show_first_page(None)
+
+    def _show_first_page(self, search_text):
+        """Reset the table to the first page of records, optionally filtered"""
         try:
-            self.table_layout.clear_widgets()
-            
-            # Header
-            headers = ['Código', 'Descripción', 'Cantidad', 'Auditor', 'Locación', 'Sync']
-            for header in headers:
-                label = Label(text=header, bold=True, color=TEXT_COLOR, size_hint_y=None, height=dp(40))
-                with label.canvas.before:
-                    Color(*TAB_ACTIVE_COLOR)
-                    Rectangle(size=label.size, pos=label.pos)
-                label.bind(size=self._update_rect, pos=self._update_rect)
-                self.table_layout.add_widget(label)
-            
-            # Data rows
-            records = self.db_manager.get_last_records_with_sync_status(50)
-            for i, record in enumerate(records):
-                bg_color = ALT_ROW_COLOR if i % 2 == 0 else CARD_BG_COLOR
-                
-                for j, value in enumerate(record[1:7]):  # Skip ID, include sync status
-                    if j == 1:  # Description column
-                        display_text = truncate_text(value, 20)
-                    elif j == 5:  # Sync status column
-                        display_text = '✅' if value == 1 else '⏳'
-                    else:
-                        display_text = truncate_text(value, 15)
-                    
-                    label = Label(text=str(display_text), color=TEXT_COLOR, 
-                                size_hint_y=None, height=dp(40))
-                    
-                    with label.canvas.before:
-                        Color(*bg_color)
-                        Rectangle(size=label.size, pos=label.pos)
-                    label.bind(size=self._update_rect, pos=self._update_rect)
-                    
-                    # Make row clickable
-                    label.record_id = record[0]
-                    label.bind(on_touch_down=self._on_record_touch)
-                    
-                    self.table_layout.add_widget(label)
+            self._clear_table(search_text)
+            records, self._page_cursor = self.db_manager.get_records_page(search_text=search_text)
+            self._append_record_rows(records)
+            self.table_scroll.scroll_y = 1
                     
         except Exception as e:
             logging.error(f"Error displaying records: {e}")
 
+    @mainthread
+    def _refresh_records(self, changed_ids=()):
+        """Bring the table up to date in place, keeping the pages loaded and the scroll position.
+
+        At the top of an unscrolled first page this is _show_first_page.
+        Further down, only what can have changed is read: the records newer
+        than the top row, which are added above it, and the rows still
+        shown as pending or listed in changed_ids, whose cells are updated.
+        """
+        try:
+            search_text = self._page_search_text
+            if not self._table_rows or (self._table_row_count <= PAGE_SIZE and self.table_scroll.scroll_y >= 1):
+                self._show_first_page(search_text)
+                return
+
+            top_id = next(iter(self._table_rows))
+            newer = self.db_manager.get_newer_records(top_id, search_text=search_text)
+            if newer is None:
+                # Too much arrived, or the top row is gone
+                self._show_first_page(search_text)
+                return
+
+            stale_ids = set(changed_ids)
+            stale_ids.update(record_id for record_id, (_, record) in self._table_rows.items() if record[6] != 1)
+            stale_ids.intersection_update(self._table_rows)
+            if stale_ids:
+                for record_id, record in self.db_manager.get_records_by_ids(stale_ids).items():
+                    labels, old_record = self._table_rows[record_id]
+                    if record != old_record:
+                        self._set_row_values(labels, record)
+                        self._table_rows[record_id] = (labels, record)
+
+            if newer:
+                self._prepend_record_rows(newer)
+
+        except Exception as e:
+            logging.error(f"Error refreshing records: {e}")
+
+    def _clear_table(self, search_text):
+        """Empty the table down to its header and drop any page still loading"""
+        self._table_generation += 1
+        self._page_search_text = search_text
+        self._page_loading = False
+        self._table_row_count = 0
+        self._table_rows = {}
+        self.table_layout.clear_widgets()
+        
+        # Header
+        headers = ['Código', 'Descripción', 'Cantidad', 'Auditor', 'Locación', 'Sync']
+        for header in headers:
+            label = Label(text=header, bold=True, color=TEXT_COLOR, size_hint_y=None, height=dp(40))
+            with label.canvas.before:
+                Color(*TAB_ACTIVE_COLOR)
+                Rectangle(size=label.size, pos=label.pos)
+            label.bind(size=self._update_rect, pos=self._update_rect)
+            self.table_layout.add_widget(label)
+
+    def _make_record_labels(self, record, bg_color):
+        """The cells of a record row, clickable to edit the record"""
+        labels = []
+        for _ in range(6):
+            label = Label(color=TEXT_COLOR, size_hint_y=None, height=dp(40))
+            
+            with label.canvas.before:
+                Color(*bg_color)
+                Rectangle(size=label.size, pos=label.pos)
+            label.bind(size=self._update_rect, pos=self._update_rect)
+            
+            # Make row clickable
+            label.record_id = record[0]
+            label.bg_color = bg_color
+            label.bind(on_touch_down=self._on_record_touch)
+            labels.append(label)
+        self._set_row_values(labels, record)
+        return labels
+
+    def _set_row_values(self, labels, record):
+        """Write a record's values into its row's cells"""
+        for j, (label, value) in enumerate(zip(labels, record[1:7])):  # Skip ID, include sync status
+            if j == 1:  # Description column
+                display_text = truncate_text(value, 20)
+            elif j == 5:  # Sync status column
+                display_text = '✅' if value == 1 else '⏳'
+            else:
+                display_text = truncate_text(value, 15)
+            label.text = str(display_text)
+
+    def _append_record_rows(self, records):
+        """Append record rows below the ones already in the table"""
+        for record in records:
+            if record[0] in self._table_rows:
+                continue
+            bg_color = ALT_ROW_COLOR if self._table_row_count % 2 == 0 else CARD_BG_COLOR
+            self._table_row_count += 1
+            
+            labels = self._make_record_labels(record, bg_color)
+            for label in labels:
+                self.table_layout.add_widget(label)
+            self._table_rows[record[0]] = (labels, record)
+
+    def _prepend_record_rows(self, records):
+        """Add newer record rows right under the header, keeping the user's place"""
+        old_scrollable = self.table_layout.height - self.table_scroll.height
+        at_top = self.table_scroll.scroll_y >= 1
+        top_labels, _ = next(iter(self._table_rows.values()))
+        bg_color = top_labels[0].bg_color
+
+        added = {}
+        # Oldest first, each pushed in under the header
+        for record in reversed(records):
+            if record[0] in self._table_rows or record[0] in added:
+                continue
+            bg_color = CARD_BG_COLOR if bg_color == ALT_ROW_COLOR else ALT_ROW_COLOR
+            labels = self._make_record_labels(record, bg_color)
+            for column, label in enumerate(labels):
+                # Children are kept in reverse order; the header holds six cells
+                self.table_layout.add_widget(label, index=len(self.table_layout.children) - 6 - column)
+            added[record[0]] = (labels, record)
+        if not added:
+            return
+
+        self._table_row_count += len(added)
+        rows = dict(reversed(list(added.items())))
+        rows.update(self._table_rows)
+        self._table_rows = rows
+
+        self.table_layout.do_layout()
+        new_scrollable = self.table_layout.height - self.table_scroll.height
+        if at_top:
+            self.table_scroll.scroll_y = 1
+        elif old_scrollable > 0 and new_scrollable > 0:
+            # Same distance from the bottom, so the rows in view stay put
+            self.table_scroll.scroll_y = self.table_scroll.scroll_y * old_scrollable / new_scrollable
+
+    def _on_table_scroll(self, instance, scroll_y):
+        """Load the next page when the table is scrolled to the bottom"""
+        if scroll_y > 0.05 or not self._page_cursor or self._page_loading:
+            return
+        self._page_loading = True
+        Thread(target=self._load_next_page,
+               args=(self._table_generation, self._page_cursor, self._page_search_text),
+               daemon=True).start()
+
+    def _load_next_page(self, generation, cursor, search_text):
+        """Fetch the next page in a background thread"""
+        try:
+            records, next_cursor = self.db_manager.get_records_page(cursor, search_text=search_text)
+            self._on_next_page_loaded(generation, records, next_cursor)
+        except Exception as e:
+            logging.error(f"Error loading next page: {e}")
+            self._page_loading = False
+
+    @mainthread
+    def _on_next_page_loaded(self, generation, records, next_cursor):
+        """Append a fetched page unless the table was reset meanwhile"""
+        try:
+            if generation != self._table_generation:
+                return
+            
+            # Keep the rows the user was looking at in place
+            old_scrollable = self.table_layout.height - self.table_scroll.height
+            self._append_record_rows(records)
+            self.table_layout.do_layout()
+            new_scrollable = self.table_layout.height - self.table_scroll.height
+            if old_scrollable > 0 and new_scrollable > 0:
+                self.table_scroll.scroll_y = 1 - old_scrollable / new_scrollable
+            
+            self._page_cursor = next_cursor
+        except Exception as e:
+            logging.error(f"Error displaying next page: {e}")
+        finally:
+            self._page_loading = False
+
     def show_popup(self, title, message, is_error=False):
         """Show popup message"""
         try:
@@ -823,15 +1063,10 @@ class InventoryScreen(BoxLayout):
             if not barcode: 
                 return
                 
-            master_screen = self.app_instance.master_screen
-            
-            if not (master_screen and hasattr(master_screen, 'master_dict')):
-                self.show_popup("Error", "El maestro de artículos no está cargado.", is_error=True)
-                return
-                
-            description = master_screen.master_dict.get(barcode)
+            description = self.db_manager.get_master_description(barcode)
             if description is not None:
                 self.descripcion_input.text = description
+                self._refresh_sku_counts()
                 self.qty_input.focus = True
             else: 
                 self.open_new_item_popup(barcode)
@@ -893,19 +1128,43 @@ class InventoryScreen(BoxLayout):
     def _add_item_to_master_and_continue(self, barcode, description):
         """Add item to master and continue with inventory entry"""
         try:
-            master_screen = self.app_instance.master_screen
+            if not self.db_manager.upsert_master_item(barcode, description):
+                self.show_popup("Error", "No se pudo guardar el artículo en el maestro", is_error=True)
+                return
             
-            if master_screen and hasattr(master_screen, 'master_dict'):
-                master_screen.master_dict[barcode] = description
-                master_screen._save_master_to_file()
+            master_screen = self.app_instance.master_screen
+            if master_screen:
+                master_screen.on_item_added()
                 
             self.descripcion_input.text = description
+            self._refresh_sku_counts()
             self.qty_input.focus = True
             
         except Exception as e:
             logging.error(f"Error adding item to master: {e}")
             self.show_popup("Error", f"Error agregando al maestro: {e}", is_error=True)
 
+    def _refresh_sku_counts(self, *args):
+        """Show how much of the scanned SKU is already counted"""
+        try:
+            barcode = self.codigo_barras_input.text.strip()
+            if not barcode:
+                self.sku_counts_label.text = ''
+                return
+            
+            locacion = self.locacion_spinner.text if self.locacion_spinner.text != 'Selecciona Locación' else ''
+            counts = self.db_manager.get_sku_counts(barcode, locacion)
+            if not counts:
+                self.sku_counts_label.text = ''
+                return
+            
+            location_name = locacion or 'sin locación'
+            self.sku_counts_label.text = (f"Contado en {location_name}: {counts['location_quantity']} | "
+                                          f"Total: {counts['total_quantity']}")
+            
+        except Exception as e:
+            logging.error(f"Error refreshing SKU counts: {e}")
+
     def clear_fields(self, instance=None):
         """Clear all input fields"""
         try:
@@ -913,6 +1172,7 @@ class InventoryScreen(BoxLayout):
             self.descripcion_input.text = ''
             self.qty_input.text = ''
             self.locacion_spinner.text = 'Selecciona Locación'
+            self.sku_counts_label.text = ''
             self.editing_id = None
             
             # Reset buttons
@@ -933,6 +1193,8 @@ class InventoryScreen(BoxLayout):
             if self.editing_id:
                 success = self.db_manager.delete_record(self.editing_id)
                 if success:
+                    if self.app_instance.firebase_enabled:
+                        self.sync_scheduler.notify_write()
                     self.clear_fields()
                     self._display_last_records()
                     self.status_label.text = "Registro eliminado"
@@ -950,8 +1212,7 @@ class InventoryScreen(BoxLayout):
         try:
             search_text = self.search_input_counts.text.strip()
             if search_text:
-                records = self.db_manager.search_records(search_text)
-                self._display_filtered_records(records)
+                self._show_first_page(search_text)
             else:
                 self._display_last_records()
                 
@@ -967,52 +1228,6 @@ class InventoryScreen(BoxLayout):
         except Exception as e:
             logging.error(f"Error clearing search: {e}")
 
-    @mainthread
-    def _display_filtered_records(self, records):
-        """Display filtered records with sync status"""
-        try:
-            self.table_layout.clear_widgets()
-            
-            # Header
-            headers = ['Código', 'Descripción', 'Cantidad', 'Auditor', 'Locación', 'Sync']
-            for header in headers:
-                label = Label(text=header, bold=True, color=TEXT_COLOR, size_hint_y=None, height=dp(40))
-                with label.canvas.before:
-                    Color(*TAB_ACTIVE_COLOR)
-                    Rectangle(size=label.size, pos=label.pos)
-                label.bind(size=self._update_rect, pos=self._update_rect)
-                self.table_layout.add_widget(label)
-            
-            # Data rows
-            for i, record in enumerate(records):
-                bg_color = ALT_ROW_COLOR if i % 2 == 0 else CARD_BG_COLOR
-                
-                for j, value in enumerate(record[1:7]):  # Skip ID, include sync status
-                    if j == 1:  # Description column
-                        display_text = truncate_text(value, 20)
-                    elif j == 5:  # Sync status column
-                        display_text = '✅' if value == 1 else '⏳'
-                    else:
-                        display_text = truncate_text(value, 15)
-                    
-                    label = Label(text=str(display_text), color=TEXT_COLOR, 
-                                size_hint_y=None, height=dp(40))
-                    
-                    with label.canvas.before:
-                        Color(*bg_color)
-                        Rectangle(size=label.size, pos=label.pos)
-                    label.bind(size=self._update_rect, pos=self._update_rect)
-                    
-                    # Make row clickable
-                    if len(record) > 0:
-                        label.record_id = record[0]
-                        label.bind(on_touch_down=self._on_record_touch)
-                    
-                    self.table_layout.add_widget(label)
-                    
-        except Exception as e:
-            logging.error(f"Error displaying filtered records: {e}")
-
     def _on_record_touch(self, instance, touch):
         """Handle record touch for editing"""
         try:
@@ -1069,14 +1284,15 @@ class InventoryScreen(BoxLayout):
 
 # --- Enhanced Master Screen ---
 class MasterScreen(BoxLayout):
-    master_dict = DictProperty({})
+    master_count = NumericProperty(0)
 
-    def __init__(self, app_instance, **kwargs):
+    def __init__(self, app_instance, db_manager, **kwargs):
         super().__init__(**kwargs)
         self.orientation = 'vertical'
         self.padding = 10
         self.spacing = 10
         self.app_instance = app_instance
+        self.db_manager = db_manager
         self.build_ui()
 
     def build_ui(self):
@@ -1089,7 +1305,7 @@ class MasterScreen(BoxLayout):
             file_section.add_widget(Label(text='Cargar Archivo Master:', size_hint_y=None, height=dp(30), 
                                         bold=True, color=TEXT_COLOR))
             
-            load_btn = Button(text='Cargar Master desde Excel', size_hint_y=None, height=dp(44),
+            load_btn = Button(text='Cargar Master (Excel o CSV)', size_hint_y=None, height=dp(44),
                             color=WHITE_TEXT_COLOR, background_color=TAB_ACTIVE_COLOR)
             load_btn.bind(on_press=self.load_master_file)
             file_section.add_widget(load_btn)
@@ -1149,7 +1365,7 @@ class MasterScreen(BoxLayout):
                     self._process_master_file(file_path)
             
             filechooser.open_file(on_selection=on_file_selected, 
-                                filters=['*.xlsx', '*.xls'])
+                                filters=['*.xlsx', '*.xls', '*.csv', '*.tsv'])
                                 
         except Exception as e:
             logging.error(f"Error with plyer filechooser: {e}")
@@ -1160,7 +1376,7 @@ class MasterScreen(BoxLayout):
         try:
             content = BoxLayout(orientation='vertical', padding=10, spacing=10)
             
-            filechooser = FileChooserListView(filters=['*.xlsx', '*.xls'])
+            filechooser = FileChooserListView(filters=['*.xlsx', '*.xls', '*.csv', '*.tsv'])
             content.add_widget(filechooser)
             
             buttons = BoxLayout(size_hint_y=None, height=dp(44), spacing=10)
@@ -1191,21 +1407,52 @@ class MasterScreen(BoxLayout):
     def _process_master_file(self, file_path):
         """Process master file in background thread"""
         try:
-            loading_popup = LoadingPopup()
+            cancel_event = Event()
+            loading_popup = LoadingPopup(on_cancel=cancel_event.set)
             loading_popup.open()
             
+            def report_progress(rows, total, rows_per_second):
+                Clock.schedule_once(lambda dt: loading_popup.update_progress(rows, total, rows_per_second))
+            
             def process_in_background():
                 try:
-                    success, data_or_error = file_manager.load_excel_file(file_path)
+                    # A file identical to the last one imported changes nothing
+                    file_hash = file_manager.hash_file(file_path)
+                    if file_hash == self.db_manager.get_sync_state('master_file_hash'):
+                        logging.info("Master file unchanged, skipping import")
+                        Clock.schedule_once(lambda dt: (
+                            loading_popup.dismiss(),
+                            self.show_popup("Info", "El archivo no cambió desde la última carga", is_error=False)
+                        ))
+                        return
+                    
+                    success, data_or_error = file_manager.load_master_file(
+                        file_path, progress_callback=report_progress, cancel_event=cancel_event)
+                    
+                    # The rows stream from the file straight into the delta,
+                    # off the UI thread and in one transaction, so a failed
+                    # or cancelled import leaves the previous master in place
+                    summary = None
+                    if success:
+                        summary = self.db_manager.apply_master_delta(data_or_error, file_hash)
+                        if summary is None:
+                            success, data_or_error = False, "No se pudo guardar el maestro"
+                        else:
+                            # Reuses the index on disk unless the delta made it stale
+                            self.db_manager.open_master_index()
                     
                     def update_ui(dt):
                         loading_popup.dismiss()
-                        if success:
-                            self.master_dict = data_or_error
-                            self._save_master_to_file()
-                            self._display_master_data()
-                            self.master_status.text = f'Master cargado: {len(self.master_dict)} artículos'
-                            self.master_status.color = SUCCESS_COLOR
+                        if cancel_event.is_set():
+                            self.show_popup("Info", "Carga del master cancelada", is_error=False)
+                        elif success:
+                            self._show_master_count(summary['total'])
+                            if summary['added'] or summary['changed'] or summary['removed']:
+                                self._display_master_data()
+                            self.show_popup("Master actualizado",
+                                            f"Agregados: {summary['added']}\n"
+                                            f"Modificados: {summary['changed']}\n"
+                                            f"Eliminados: {summary['removed']}", is_error=False)
                         else:
                             self.show_popup("Error", f"Error cargando archivo: {data_or_error}", is_error=True)
                     
@@ -1224,34 +1471,42 @@ class MasterScreen(BoxLayout):
             logging.error(f"Error in _process_master_file: {e}")
             self.show_popup("Error", f"Error iniciando carga: {e}", is_error=True)
 
-    def _save_master_to_file(self):
-        """Save master dict to JSON file"""
-        try:
-            master_file = file_manager.get_master_file_path()
-            with open(master_file, 'w', encoding='utf-8') as f:
-                json.dump(self.master_dict, f, ensure_ascii=False, indent=2)
-            logging.info(f"Master guardado en: {master_file}")
-            
-        except Exception as e:
-            logging.error(f"Error saving master to file: {e}")
+    def _show_master_count(self, count):
+        """Show how many articles the master holds"""
+        self.master_count = count
+        if count:
+            self.master_status.text = f'Master cargado: {count} artículos'
+            self.master_status.color = SUCCESS_COLOR
+        else:
+            self.master_status.text = 'No hay master cargado'
+            self.master_status.color = ERROR_COLOR
 
-    def _load_master_from_file(self):
-        """Load master dict from JSON file"""
+    def on_item_added(self):
+        """Reflect an article added to the master from the inventory screen"""
         try:
-            master_file = file_manager.get_master_file_path()
-            if os.path.exists(master_file):
-                with open(master_file, 'r', encoding='utf-8') as f:
-                    self.master_dict = json.load(f)
-                self.master_status.text = f'Master cargado: {len(self.master_dict)} artículos'
-                self.master_status.color = SUCCESS_COLOR
+            self._show_master_count(self.master_count + 1)
+            if not self.search_master_input.text.strip():
                 self._display_master_data()
-                logging.info(f"Master cargado desde: {master_file}")
-                return True
-            return False
-            
         except Exception as e:
-            logging.error(f"Error loading master from file: {e}")
-            return False
+            logging.error(f"Error refreshing master after add: {e}")
+
+    def _load_master(self):
+        """Load the master from the database, migrating a legacy master_items.json first"""
+        def load_in_background():
+            try:
+                self.db_manager.migrate_master_json(file_manager.get_master_file_path())
+                # Scans look barcodes up in the memory-mapped index once it is open
+                self.db_manager.open_master_index()
+                # Kept with every master change, so startup does not scan the table
+                count = self.db_manager.get_master_count()
+                Clock.schedule_once(lambda dt: self._show_master_count(count))
+                if count:
+                    self._display_master_data()
+                logging.info(f"Master cargado desde la base de datos: {count} artículos")
+            except Exception as e:
+                logging.error(f"Error loading master: {e}")
+
+        Thread(target=load_in_background, daemon=True).start()
 
     @mainthread
     def _display_master_data(self):
@@ -1270,7 +1525,7 @@ class MasterScreen(BoxLayout):
                 self.master_table.add_widget(label)
             
             # Data rows (limit to first 100 for performance)
-            items = list(self.master_dict.items())[:100]
+            items = self.db_manager.get_master_items(limit=100)
             for i, (codigo, descripcion) in enumerate(items):
                 bg_color = ALT_ROW_COLOR if i % 2 == 0 else CARD_BG_COLOR
                 
@@ -1292,9 +1547,9 @@ class MasterScreen(BoxLayout):
                 desc_label.bind(size=self._update_rect, pos=self._update_rect)
                 self.master_table.add_widget(desc_label)
                 
-            if len(self.master_dict) > 100:
+            if self.master_count > 100:
                 # Add note about limited display
-                note_label = Label(text=f'Mostrando 100 de {len(self.master_dict)} artículos', 
+                note_label = Label(text=f'Mostrando 100 de {self.master_count} artículos', 
                                  color=ORANGE_COLOR, size_hint_y=None, height=dp(40))
                 self.master_table.add_widget(note_label)
                 self.master_table.add_widget(Label(text='', size_hint_y=None, height=dp(40)))
@@ -1307,8 +1562,7 @@ class MasterScreen(BoxLayout):
         try:
             search_text = self.search_master_input.text.strip().lower()
             if search_text:
-                filtered_items = {k: v for k, v in self.master_dict.items() 
-                                if search_text in k.lower() or search_text in v.lower()}
+                filtered_items = self.db_manager.get_master_items(search_text, limit=MASTER_SEARCH_LIMIT)
                 self._display_filtered_master(filtered_items)
             else:
                 self._display_master_data()
@@ -1342,7 +1596,7 @@ class MasterScreen(BoxLayout):
                 self.master_table.add_widget(label)
             
             # Data rows
-            for i, (codigo, descripcion) in enumerate(filtered_items.items()):
+            for i, (codigo, descripcion) in enumerate(filtered_items):
                 bg_color = ALT_ROW_COLOR if i % 2 == 0 else CARD_BG_COLOR
                 
                 # Código
@@ -1419,16 +1673,26 @@ class MasterScreen(BoxLayout):
 
 # --- Pop-up de carga (LoadingPopup) ---
 class LoadingPopup(Popup):
-    def __init__(self, **kwargs):
+    def __init__(self, on_cancel=None, **kwargs):
         super().__init__(**kwargs)
         self.title = 'Cargando...'
         self.content = BoxLayout(orientation='vertical', padding=dp(20), spacing=dp(10))
         
         # Simple loading indicator
-        loading_label = Label(text="Por favor, espere...", color=WHITE_TEXT_COLOR)
-        self.content.add_widget(loading_label)
+        self.loading_label = Label(text="Por favor, espere...", color=WHITE_TEXT_COLOR)
+        self.content.add_widget(self.loading_label)
+        
+        # Progress of long loads, shown once the first update arrives
+        self.progress_bar = ProgressBar(max=100, value=0, size_hint_y=None, height=dp(20), opacity=0)
+        self.content.add_widget(self.progress_bar)
         
-        self.size_hint = (0.7, 0.3)
+        if on_cancel:
+            cancel_btn = Button(text='Cancelar', size_hint_y=None, height=dp(44),
+                                color=WHITE_TEXT_COLOR, background_color=ERROR_COLOR)
+            cancel_btn.bind(on_press=lambda instance: on_cancel())
+            self.content.add_widget(cancel_btn)
+        
+        self.size_hint = (0.7, 0.4 if on_cancel else 0.3)
         self.auto_dismiss = False
         self.title_color = WHITE_TEXT_COLOR
         self.separator_color = TAB_ACTIVE_COLOR
@@ -1450,6 +1714,15 @@ class LoadingPopup(Popup):
         self.rect.size = instance.size
         self.rect.pos = instance.pos
 
+    def update_progress(self, rows, total=None, rows_per_second=0):
+        """Show how many rows were read; total, if known, fills the progress bar"""
+        if total:
+            self.progress_bar.opacity = 1
+            self.progress_bar.value = min(rows / total * 100, 100)
+            self.loading_label.text = f"{rows:,} de {total:,} filas ({rows_per_second:,.0f} filas/s)"
+        else:
+            self.loading_label.text = f"{rows:,} filas leídas ({rows_per_second:,.0f} filas/s)"
+
 
 # --- Enhanced Inventory App with Firebase Integration ---
 class InventoryApp(App):
@@ -1457,6 +1730,7 @@ class InventoryApp(App):
         super().__init__(**kwargs)
         self.firebase_enabled = False
         self.firebase_manager = None
+        self.sync_supervisor = None
         self.current_user = None
         self.current_screen = None
 
@@ -1509,6 +1783,7 @@ class InventoryApp(App):
                 
                 if HAS_FIREBASE:
                     self.firebase_manager = FirebaseManager(config)
+                    self.sync_supervisor = SyncSupervisor(self.firebase_manager)
                     self.firebase_enabled = True
                     logging.info("Firebase inicializado correctamente")
                 else:
@@ -1567,7 +1842,7 @@ class InventoryApp(App):
             
             # Create screens
             self.inventory_screen = InventoryScreen(self)
-            self.master_screen = MasterScreen(self)
+            self.master_screen = MasterScreen(self, self.inventory_screen.db_manager)
             
             # Show inventory screen initially
             self.screens_container.add_widget(self.inventory_screen)
@@ -1590,7 +1865,7 @@ class InventoryApp(App):
     def _delayed_master_load(self, dt):
         """Load master data after app is fully initialized"""
         try:
-            self.master_screen._load_master_from_file()
+            self.master_screen._load_master()
         except Exception as e:
             logging.error(f"Error loading master data: {e}")
 
@@ -1625,6 +1900,10 @@ class InventoryApp(App):
     def logout(self, instance=None):
         """Logout and return to login screen"""
         try:
+            inventory_screen = getattr(self, 'inventory_screen', None)
+            if inventory_screen is not None:
+                inventory_screen.shutdown()
+                self.inventory_screen = None
             self.current_user = None
             self.show_login_screen()
         except Exception as e:
@@ -1635,13 +1914,26 @@ class InventoryApp(App):
         logging.info("App paused")
         return True
 
+    def on_stop(self):
+        """Flush queued scans and stop syncing before the app exits"""
+        try:
+            inventory_screen = getattr(self, 'inventory_screen', None)
+            if inventory_screen is not None:
+                inventory_screen.shutdown()
+        except Exception as e:
+            logging.error(f"Error stopping inventory screen: {e}")
+
     def on_resume(self):
         """Handle app resume (Android lifecycle)"""
         logging.info("App resumed")
 
 
 def run_cli_mode():
-    """Run the app in CLI mode when GUI is not available"""
+    """Run the app in CLI mode when GUI is not available.
+
+    Returns the process exit code: 1 if the last background push failed,
+    0 otherwise.
+    """
     print("\n" + "="*50)
     print("INVENTARIO APP - CLI MODE CON FIREBASE")
     print("="*50)
@@ -1688,6 +1980,44 @@ def run_cli_mode():
     
     print(f"\n📁 Data directory: {android_utils.get_data_directory()}")
     print(f"📄 Database file: {db_manager.db_path}")
+
+    # Background sync, with credentials from INVENTARIO_USER / INVENTARIO_PASSWORD
+    sync_scheduler = None
+    push_failed = Event()
+    try:
+        config_file = os.path.join(android_utils.get_data_directory(), 'firebase_config.json')
+        username = os.environ.get('INVENTARIO_USER')
+        password = os.environ.get('INVENTARIO_PASSWORD')
+        if HAS_FIREBASE and os.path.exists(config_file) and username and password:
+            with open(config_file, 'r') as f:
+                firebase_manager = FirebaseManager(json.load(f))
+            success, message = firebase_manager.authenticate_user(username, password)
+            if success:
+                supervisor = SyncSupervisor(firebase_manager)
+
+                def headless_sync(force):
+                    pushed = supervisor.run(lambda: db_manager.sync_pending_records(firebase_manager), force=force)
+                    if pushed is None:
+                        return None
+                    # Pull what other devices uploaded, unless the push just failed
+                    pulled = 0
+                    if supervisor.last_push_failed:
+                        push_failed.set()
+                    else:
+                        push_failed.clear()
+                        pulled = db_manager.pull_remote_updates(firebase_manager)
+                    db_manager.write_metrics_snapshot()
+                    return pushed + pulled
+
+                sync_scheduler = SyncScheduler(headless_sync)
+                supervisor.on_connectivity_change = sync_scheduler.notify_network_change
+                sync_scheduler.start()
+                sync_scheduler.request_sync()
+                print("🔄 Background sync started")
+            else:
+                print(f"❌ Firebase login failed: {message}")
+    except Exception as e:
+        print(f"❌ Error starting background sync: {e}")
     
     print("\nCLI mode is running successfully!")
     print("The database and file operations are working with Firebase sync support.")
@@ -1701,8 +2031,16 @@ def run_cli_mode():
             time.sleep(10)
             logging.info("CLI mode running - database accessible with Firebase sync")
     except KeyboardInterrupt:
+        if sync_scheduler is not None:
+            sync_scheduler.stop()
         print("\n👋 Goodbye!")
         logging.info("CLI mode stopped by user")
+    db_manager.close()
+
+    if push_failed.is_set():
+        print("❌ Last sync failed; changes are still pending upload")
+        return 1
+    return 0
 
 if __name__ == '__main__':
     try:
@@ -1712,7 +2050,7 @@ if __name__ == '__main__':
         if 'window' in error_message or 'display' in error_message or 'glx' in error_message:
             logging.info("GUI mode failed, starting CLI mode...")
             print("GUI initialization failed. Starting CLI mode...")
-            run_cli_mode()
+            sys.exit(run_cli_mode())
         else:
             logging.error(f"Critical error starting app: {e}")
             logging.error(traceback.format_exc())
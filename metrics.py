@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import ContextDecorator
+from threading import Lock
+
+# Upper bounds in seconds of the default histogram buckets: from fast
+# SQLite statements up to slow batch uploads
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_FILE = 'metrics.prom'
+JSON_FILE = 'metrics.json'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of the metric types: a name, help text and values per label set"""
+
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = Lock()
+        self._values = {}
+
+    def samples(self):
+        """(suffix, label key, extra labels, value) tuples for export"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, set directly or read from a function at export"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def set_function(self, function):
+        """Compute the (unlabelled) value with function() whenever it is exported"""
+        with self._lock:
+            self._function = function
+
+    def clear_function(self, function):
+        """Stop computing the value with function, unless another has replaced it"""
+        with self._lock:
+            if self._function == function:
+                self._function = None
+
+    def _refresh(self):
+        with self._lock:
+            function = self._function
+        if function is None:
+            return
+        try:
+            value = function()
+        except Exception as e:
+            logging.error(f"Error computing gauge {self.name}: {e}")
+            return
+        if value is not None:
+            self.set(value)
+
+    def samples(self):
+        self._refresh()
+        return super().samples()
+
+    def snapshot(self):
+        self._refresh()
+        return super().snapshot()
+
+
+class _Timer(ContextDecorator):
+    """Observes the time spent in a with block or decorated call"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # A fresh timer per decorated call, so concurrent calls do not share a start
+        return _Timer(self.histogram, self.labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    """Distribution of observed values over cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Context manager and decorator timing a block in seconds"""
+        return _Timer(self, labels)
+
+    def _cumulative(self, counts):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            yield bound, total
+
+    def samples(self):
+        with self._lock:
+            states = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in states:
+            for bound, cumulative in self._cumulative(counts):
+                samples.append(('_bucket', key, (('le', _format_number(bound)),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+    def snapshot(self):
+        with self._lock:
+            states = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        return [{
+            'labels': dict(key),
+            'buckets': {_format_number(bound): cumulative for bound, cumulative in self._cumulative(counts)},
+            'sum': total,
+            'count': count
+        } for key, counts, total, count in states]
+
+
+class MetricsRegistry:
+    """Named metrics of the process, exportable as Prometheus text or JSON"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text=''):
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text=''):
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def _sorted_metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def to_prometheus(self):
+        """The metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self._sorted_metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(key, extra)} {_format_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """The metrics as a JSON-serializable snapshot"""
+        return {
+            'timestamp': time.time(),
+            'metrics': {metric.name: {'type': metric.kind, 'help': metric.help, 'values': metric.snapshot()}
+                        for metric in self._sorted_metrics()}
+        }
+
+    def write_snapshot(self, directory):
+        """Write metrics.prom and metrics.json to directory, each replaced atomically"""
+        try:
+            for file_name, content in ((PROMETHEUS_FILE, self.to_prometheus()),
+                                       (JSON_FILE, json.dumps(self.to_dict(), indent=2))):
+                path = os.path.join(directory, file_name)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                os.replace(temp_path, path)
+            return True
+        except Exception as e:
+            logging.error(f"Error writing metrics snapshot: {e}")
+            return False
+
+
+# Registry shared by DatabaseManager, FirebaseManager and the sync engine
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,224 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock
+from metrics import REGISTRY
+
+# HTTP statuses that mean the server wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+# Times the items of a throttled batch are sent again within one run
+# before they are handed back as failed
+MAX_THROTTLE_RETRIES = 5
+
+SYNC_BATCH_SECONDS = REGISTRY.histogram('sync_batch_seconds', 'Round-trip time of sync batches')
+SYNC_BATCHES = REGISTRY.counter('sync_batches_total', 'Sync batches sent, by outcome')
+SYNC_ROWS = REGISTRY.counter('sync_rows_total', 'Rows sent in sync batches, by outcome')
+SYNC_RETRIES = REGISTRY.counter('sync_retries_total', 'Work that will be sent again, by reason')
+SYNC_ROWS_PER_SECOND = REGISTRY.gauge('sync_rows_per_second', 'Rows synced per second by the latest run')
+SYNC_CONCURRENCY = REGISTRY.gauge('sync_concurrency', 'Batches the rate controller allows in flight')
+SYNC_BATCH_SIZE = REGISTRY.gauge('sync_batch_size', 'Rows per batch the rate controller allows')
+
+class AdaptiveRateController:
+    """AIMD control of sync concurrency and batch size.
+
+    Every batch that comes back quickly adds one slot of concurrency and
+    batch_step rows per round of batches (additive increase). A batch
+    slower than target_latency halves both (multiplicative decrease). A
+    throttled batch (429/503) cuts both and pauses new batches in
+    proportion to the share of its writes the server rejected: a whole
+    batch refused halves them and pauses for throttle_pause seconds, while
+    one write in twenty refused trims them by 2.5% and pauses for a
+    twentieth of that.
+    """
+
+    def __init__(self, max_concurrency=4, min_batch_size=25, max_batch_size=500,
+                 initial_batch_size=100, batch_step=50, target_latency=3.0, throttle_pause=1.0):
+        self.max_concurrency = max_concurrency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.target_latency = target_latency
+        self.throttle_pause = throttle_pause
+
+        self._lock = Lock()
+        self._concurrency = 1.0
+        self._batch_size = float(initial_batch_size)
+        self._paused_until = 0.0
+
+    @property
+    def concurrency(self):
+        with self._lock:
+            return int(self._concurrency)
+
+    @property
+    def batch_size(self):
+        with self._lock:
+            return int(self._batch_size)
+
+    def pause_remaining(self):
+        """Seconds left before new batches may be sent"""
+        with self._lock:
+            return max(self._paused_until - time.monotonic(), 0.0)
+
+    def record(self, latency, status_code, rejected_share=1.0):
+        """Adjust the limits after a batch finished.
+
+        rejected_share is the share of a throttled batch's writes the
+        server refused.
+        """
+        with self._lock:
+            throttled = status_code in THROTTLE_STATUSES
+            if throttled or latency > self.target_latency:
+                rejected_share = min(max(rejected_share, 0.0), 1.0)
+                factor = 0.5 if latency > self.target_latency else 1 - rejected_share / 2
+                self._concurrency = max(self._concurrency * factor, 1.0)
+                self._batch_size = max(self._batch_size * factor, self.min_batch_size)
+                if throttled:
+                    self._paused_until = max(self._paused_until,
+                                             time.monotonic() + self.throttle_pause * rejected_share)
+            elif status_code is not None:
+                # Spread the increase over a round so it is +1 per round trip
+                self._concurrency = min(self._concurrency + 1 / self._concurrency, self.max_concurrency)
+                self._batch_size = min(self._batch_size + self.batch_step / self._concurrency,
+                                       self.max_batch_size)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'concurrency': int(self._concurrency),
+                'batch_size': int(self._batch_size),
+                'paused_for': max(self._paused_until - time.monotonic(), 0.0)
+            }
+
+
+class SyncExecutor:
+    """Runs sync batches on a bounded thread pool sized by an AdaptiveRateController"""
+
+    def __init__(self, max_workers=4, controller=None):
+        self.max_workers = max_workers
+        self.controller = controller or AdaptiveRateController(max_concurrency=max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync')
+
+        # Outcome of the latest run: batches sent, how many failed outright
+        # and the status of the last one that did (None = no response)
+        self.last_run = {'batches': 0, 'failed_batches': 0, 'failure_status': None}
+
+    def run(self, next_batch, send_batch, on_result):
+        """Send batches until there is no more work or a batch fails outright.
+
+        next_batch(size) returns the next batch of at most size items, or an
+        empty batch when there is nothing left. send_batch(batch) runs on a
+        worker thread and returns (status_code, results). on_result(batch,
+        results) runs on the calling thread and returns how many items of
+        the batch succeeded. The items a throttled batch failed are sent
+        again, ahead of new work, up to MAX_THROTTLE_RETRIES times; on_result
+        only sees them once they succeed or run out of retries. Returns the
+        total number of successes.
+        """
+        in_flight = {}
+        retries = deque()
+        exhausted = False
+        stopped = False
+        succeeded = 0
+        outcome = {'batches': 0, 'failed_batches': 0, 'failure_status': None}
+        self.last_run = outcome
+        start = time.monotonic()
+
+        while True:
+            # Top up to the current concurrency limit
+            while (not stopped and (retries or not exhausted)
+                   and len(in_flight) < self.controller.concurrency):
+                pause = self.controller.pause_remaining()
+                if pause and in_flight:
+                    break
+                if pause:
+                    time.sleep(pause)
+
+                if retries:
+                    batch, attempt = retries.popleft()
+                else:
+                    batch, attempt = next_batch(self.controller.batch_size), 0
+                    if not batch:
+                        exhausted = True
+                        break
+                in_flight[self._pool.submit(self._timed_send, send_batch, batch)] = (batch, attempt)
+
+            if not in_flight:
+                # Retries left over when the run stopped are handed back as failed
+                while retries:
+                    batch, _ = retries.popleft()
+                    on_result(batch, [(False, "Throttled")] * len(batch))
+                if outcome['batches']:
+                    elapsed = time.monotonic() - start
+                    SYNC_ROWS_PER_SECOND.set(succeeded / elapsed if elapsed > 0 else 0.0)
+                return succeeded
+
+            done, _ = wait(in_flight, timeout=self.controller.pause_remaining() or None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, attempt = in_flight.pop(future)
+                try:
+                    latency, status_code, results = future.result()
+                except Exception as e:
+                    logging.error(f"Error sending sync batch: {e}")
+                    latency, status_code, results = 0.0, None, [(False, str(e))] * len(batch)
+
+                failed = [index for index, (success, _) in enumerate(results) if not success]
+                self.controller.record(latency, status_code, len(failed) / len(batch) if batch else 0.0)
+
+                retried = []
+                if failed and status_code in THROTTLE_STATUSES and attempt < MAX_THROTTLE_RETRIES:
+                    retried = [batch[index] for index in failed]
+                    retries.append((retried, attempt + 1))
+                    kept = [index for index, (success, _) in enumerate(results) if success]
+                    batch = [batch[index] for index in kept]
+                    results = [results[index] for index in kept]
+
+                batch_succeeded = on_result(batch, results) if batch else 0
+                succeeded += batch_succeeded
+                self._record_metrics(latency, status_code, len(batch) + len(retried), batch_succeeded,
+                                     len(retried))
+
+                outcome['batches'] += 1
+                if not batch_succeeded:
+                    outcome['failed_batches'] += 1
+                    outcome['failure_status'] = status_code
+
+                # A batch with no successes that was not merely throttled
+                # means the link or the auth is down; let what is in flight
+                # finish but send nothing new
+                if not batch_succeeded and status_code not in THROTTLE_STATUSES:
+                    stopped = True
+
+    def _record_metrics(self, latency, status_code, size, succeeded, retried=0):
+        """Update the sync metrics after a batch; retried items are sent again in this run"""
+        if status_code is None:
+            result = 'error'
+        elif status_code in THROTTLE_STATUSES:
+            result = 'throttled'
+        else:
+            result = 'ok' if succeeded == size else 'partial' if succeeded else 'failed'
+        SYNC_BATCH_SECONDS.observe(latency, result=result)
+        SYNC_BATCHES.inc(result=result)
+        SYNC_ROWS.inc(succeeded, result='synced')
+        if retried:
+            SYNC_RETRIES.inc(retried, reason='throttled')
+        failed = size - succeeded - retried
+        if failed:
+            SYNC_ROWS.inc(failed, result='failed')
+            SYNC_RETRIES.inc(failed, reason='throttled' if result == 'throttled' else 'failed')
+        snapshot = self.controller.snapshot()
+        SYNC_CONCURRENCY.set(snapshot['concurrency'])
+        SYNC_BATCH_SIZE.set(snapshot['batch_size'])
+
+    @staticmethod
+    def _timed_send(send_batch, batch):
+        start = time.monotonic()
+        status_code, results = send_batch(batch)
+        return time.monotonic() - start, status_code, results
+
+    def shutdown(self):
+        """Stop the worker threads"""
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,141 @@
+import logging
+import time
+from threading import Condition, Thread
+
+# Seconds of quiet after the last write before a sync starts
+DEBOUNCE_SECONDS = 2.0
+
+# Writes waiting for a sync that trigger one without waiting for quiet
+PENDING_THRESHOLD = 50
+
+# Idle polling starts at IDLE_INTERVAL and doubles after every run that
+# found nothing to do, up to MAX_IDLE_INTERVAL
+IDLE_INTERVAL = 30.0
+MAX_IDLE_INTERVAL = 300.0
+
+
+class SyncScheduler:
+    """Decides when to sync and runs the syncs on its own thread, one at a time.
+
+    Writes are debounced: a sync starts DEBOUNCE_SECONDS after the last
+    write, or right away once PENDING_THRESHOLD writes are waiting. Without
+    writes it polls at an interval that backs off while runs find nothing
+    to do. Coming back online triggers a sync; while offline only the idle
+    poll runs. Requests that arrive during a run are folded into the next
+    one. Nothing here depends on Kivy, so it also runs headless.
+
+    sync_func(force) performs one sync and returns how many changes it
+    moved in either direction, or None if it did not run (e.g. backing off).
+    """
+
+    def __init__(self, sync_func, debounce=DEBOUNCE_SECONDS, pending_threshold=PENDING_THRESHOLD,
+                 idle_interval=IDLE_INTERVAL, max_idle_interval=MAX_IDLE_INTERVAL):
+        self.sync_func = sync_func
+        self.debounce = debounce
+        self.pending_threshold = pending_threshold
+        self.min_idle_interval = idle_interval
+        self.max_idle_interval = max_idle_interval
+
+        self._condition = Condition()
+        self._pending_writes = 0
+        self._write_deadline = None
+        self._requested = False
+        self._force = False
+        self._online = True
+        self._idle_interval = idle_interval
+        self._next_idle_run = time.monotonic() + idle_interval
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            self._stopped = False
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='sync-scheduler', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop scheduling; a sync in progress is allowed to finish"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def notify_write(self, count=1):
+        """Record that count rows were written locally and need syncing"""
+        with self._condition:
+            self._pending_writes += count
+            self._write_deadline = time.monotonic() + self.debounce
+            self._condition.notify_all()
+
+    def request_sync(self, force=False):
+        """Sync as soon as possible; force bypasses the supervisor's backoff"""
+        with self._condition:
+            self._requested = True
+            self._force = self._force or force
+            self._condition.notify_all()
+
+    def notify_network_change(self, online):
+        """Tell the scheduler the device went online or offline"""
+        with self._condition:
+            was_online = self._online
+            self._online = online
+            if online and not was_online:
+                logging.info("Network is back, scheduling sync")
+                self._requested = True
+                self._idle_interval = self.min_idle_interval
+            self._condition.notify_all()
+
+    def _due_in(self, now):
+        """Seconds until the next sync is due (0 = now)"""
+        if self._requested:
+            return 0.0
+        if self._online and self._pending_writes:
+            if self._pending_writes >= self.pending_threshold:
+                return 0.0
+            return max(self._write_deadline - now, 0.0)
+        return max(self._next_idle_run - now, 0.0)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    due_in = self._due_in(time.monotonic())
+                    if due_in <= 0:
+                        break
+                    self._condition.wait(due_in)
+                if self._stopped:
+                    return
+
+                force = self._force
+                self._requested = False
+                self._force = False
+                writes = self._pending_writes
+                self._pending_writes = 0
+                self._write_deadline = None
+
+            try:
+                moved = self.sync_func(force)
+            except Exception as e:
+                logging.error(f"Error in scheduled sync: {e}")
+                moved = None
+
+            with self._condition:
+                # Unsynced writes keep the poll short; the supervisor's
+                # backoff already limits how often failing runs go out
+                if moved or writes:
+                    self._idle_interval = self.min_idle_interval
+                else:
+                    self._idle_interval = min(self._idle_interval * 2, self.max_idle_interval)
+                self._next_idle_run = time.monotonic() + self._idle_interval
+
+    def status(self):
+        """Snapshot of the scheduler state"""
+        with self._condition:
+            now = time.monotonic()
+            return {
+                'pending_writes': self._pending_writes,
+                'online': self._online,
+                'idle_interval': self._idle_interval,
+                'next_sync_in': self._due_in(now)
+            }
@@ -0,0 +1,213 @@
+import logging
+import random
+import time
+from threading import Lock
+from metrics import REGISTRY
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+SYNC_FAILURES = REGISTRY.counter('sync_failures_total', 'Sync runs that failed outright, by failure class')
+
+# (base, cap) in seconds of the exponential backoff for each failure class
+BACKOFF = {
+    'network': (5.0, 300.0),
+    'throttled': (2.0, 120.0),
+    'auth': (30.0, 600.0),
+    'server': (5.0, 300.0),
+    'client': (60.0, 900.0),
+}
+
+# Consecutive failed runs that open the circuit
+FAILURE_THRESHOLD = 3
+
+# Seconds a connectivity observation is trusted before probing again
+CONNECTIVITY_TTL = 60.0
+
+def classify_failure(status_code):
+    """Map the status of a failed sync request to a failure class"""
+    if status_code is None:
+        return 'network'
+    if status_code in (429, 503):
+        return 'throttled'
+    if status_code in (401, 403):
+        return 'auth'
+    if status_code >= 500:
+        return 'server'
+    return 'client'
+
+
+class SyncSupervisor:
+    """Decides when the sync loop may run and tracks connectivity.
+
+    Failed runs back off exponentially with full jitter, per failure class.
+    After FAILURE_THRESHOLD consecutive failures the circuit opens and no
+    sync is attempted until the backoff expires; then a single half-open
+    trial decides whether it closes again. Sync outcomes double as
+    connectivity observations, so is_online() only probes the network when
+    nothing has been observed for CONNECTIVITY_TTL seconds.
+    """
+
+    def __init__(self, firebase_manager, failure_threshold=FAILURE_THRESHOLD, on_connectivity_change=None):
+        self.firebase_manager = firebase_manager
+        self.failure_threshold = failure_threshold
+        # Called with the new state whenever connectivity flips
+        self.on_connectivity_change = on_connectivity_change
+
+        self._lock = Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.failure_class = None
+        self._attempts = {}
+        self._retry_at = 0.0
+        self._trial_running = False
+        # Whether the last run's push failed, for callers deciding what follows it
+        self.last_push_failed = False
+
+        self._online = None
+        self._online_checked_at = 0.0
+
+    def _backoff_delay(self, failure_class):
+        """Full-jitter exponential delay for the next retry of a failure class"""
+        base, cap = BACKOFF[failure_class]
+        attempt = self._attempts.get(failure_class, 0)
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    def _set_online(self, online):
+        changed = self._online is not None and self._online != online
+        self._online = online
+        self._online_checked_at = time.monotonic()
+        if changed and self.on_connectivity_change is not None:
+            try:
+                self.on_connectivity_change(online)
+            except Exception as e:
+                logging.error(f"Error notifying connectivity change: {e}")
+
+    def allow_attempt(self):
+        """Whether a sync run may start now"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._retry_at:
+                return False
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+                self._trial_running = False
+                logging.info("Sync circuit half-open, trying one run")
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+            return True
+
+    def record_success(self):
+        """A run reached the server and made progress"""
+        with self._lock:
+            if self.state != CLOSED:
+                logging.info("Sync circuit closed")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.failure_class = None
+            self._attempts.clear()
+            self._retry_at = 0.0
+            self._trial_running = False
+            self._set_online(True)
+
+    def record_failure(self, status_code):
+        """A run failed outright with the given status (None = no response)"""
+        with self._lock:
+            failure_class = classify_failure(status_code)
+            delay = self._backoff_delay(failure_class)
+            self._attempts[failure_class] = self._attempts.get(failure_class, 0) + 1
+            self.consecutive_failures += 1
+            self.failure_class = failure_class
+            SYNC_FAILURES.inc(failure_class=failure_class)
+            self._retry_at = time.monotonic() + delay
+            self._trial_running = False
+
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logging.warning(f"Sync circuit open after {self.consecutive_failures} failures ({failure_class})")
+                self.state = OPEN
+
+            # Any HTTP response proves the network is up
+            self._set_online(status_code is not None)
+            logging.info(f"Sync {failure_class} failure, next attempt in {delay:.0f}s")
+
+    def record_idle(self):
+        """A run found nothing to send, so it tells nothing about the link"""
+        with self._lock:
+            self._trial_running = False
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def _recovering(self):
+        """Whether failures are still on record, so an idle run must not be taken as neutral"""
+        with self._lock:
+            return self.state != CLOSED or self.consecutive_failures > 0
+
+    def run(self, sync_func, force=False):
+        """Run sync_func if allowed and record its outcome.
+
+        sync_func must sync through the firebase manager's SyncExecutor and
+        return the number of synced records. force skips the backoff, for
+        syncs the user asked for. Returns the number of synced records, or
+        None when the run was skipped. last_push_failed tells afterwards
+        whether any batch of the run failed.
+
+        A run with nothing to send proves nothing about the link. While
+        failures are on record it probes the network instead, so a device
+        with an empty outbox still closes the circuit once it is back
+        online.
+        """
+        if not force and not self.allow_attempt():
+            return None
+
+        executor = self.firebase_manager.sync_executor
+        previous_run = executor.last_run
+        try:
+            synced = sync_func()
+        except Exception as e:
+            logging.error(f"Error in supervised sync: {e}")
+            self.last_push_failed = True
+            self.record_failure(None)
+            return 0
+
+        outcome = executor.last_run
+        sent = outcome is not previous_run
+        self.last_push_failed = sent and outcome['failed_batches'] > 0
+        if synced:
+            self.record_success()
+        elif self.last_push_failed:
+            self.record_failure(outcome['failure_status'])
+        elif not self._recovering():
+            self.record_idle()
+        elif self.firebase_manager.is_online():
+            self.record_success()
+        else:
+            self.record_failure(None)
+        return synced
+
+    def is_online(self):
+        """Connectivity from recent sync outcomes, probing only when stale"""
+        with self._lock:
+            if self._online is not None and time.monotonic() - self._online_checked_at < CONNECTIVITY_TTL:
+                return self._online
+
+        online = self.firebase_manager.is_online()
+        with self._lock:
+            self._set_online(online)
+        return online
+
+    def status(self):
+        """Snapshot of the supervisor state for display"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'online': self._online,
+                'failure_class': self.failure_class,
+                'consecutive_failures': self.consecutive_failures,
+                'retry_in': max(self._retry_at - time.monotonic(), 0.0)
+            }
+
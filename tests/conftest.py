@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_manager import DatabaseManager
+from firebase_emulator import FirebaseEmulator
+from firebase_manager import FirebaseManager
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """Keep the app's data directory out of the real home"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def emulator():
+    emulator = FirebaseEmulator(seed=1).start()
+    yield emulator
+    emulator.stop()
+
+
+def _firebase_manager(emulator, create):
+    manager = FirebaseManager(emulator.config())
+    if create:
+        success, message = manager.create_user('auditor', 'auditor-password')
+    else:
+        success, message = manager.authenticate_user('auditor', 'auditor-password')
+    assert success, message
+    # Throttle pauses sized for tests, not for a real server
+    manager.sync_executor.controller.throttle_pause = 0.01
+    return manager
+
+
+@pytest.fixture
+def firebase(emulator):
+    manager = _firebase_manager(emulator, create=True)
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def other_firebase(emulator, firebase):
+    """A second device signed in as the same user"""
+    manager = _firebase_manager(emulator, create=False)
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    managers = []
+
+    def make_db(name='inventory.db'):
+        manager = DatabaseManager(str(tmp_path / name))
+        managers.append(manager)
+        return manager
+
+    yield make_db
+    for manager in managers:
+        manager.close()
+
+
+@pytest.fixture
+def db(make_db):
+    return make_db()
+
+
+def add_records(db, count, prefix='750'):
+    return db.add_records_bulk([
+        {'codigo_barras': f'{prefix}{i:010d}', 'descripcion': f'Articulo {i}', 'cantidad': 1,
+         'auditor': 'auditor', 'locacion': 'A-01', 'created_by': 'auditor'}
+        for i in range(count)])
+
+
+def execute(db, sql, params=()):
+    """Run a statement on its own connection, bypassing the manager"""
+    conn = sqlite3.connect(db.db_path)
+    try:
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def inventory_documents(emulator, collection='inventory'):
+    return {name.rsplit('/', 1)[-1]: document for name, document in emulator.documents.items()
+            if name.rsplit('/', 2)[-2] == collection}
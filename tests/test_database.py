@@ -0,0 +1,145 @@
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import add_records, execute
+from database_manager import OUTBOX_DEPTH
+
+
+def test_failed_commit_rolls_back_the_writer(db):
+    writer = db._get_writer()
+    # A deferred foreign key violation makes COMMIT itself fail
+    writer.execute('PRAGMA foreign_keys = ON')
+    writer.execute('CREATE TEMP TABLE parent (id INTEGER PRIMARY KEY)')
+    writer.execute('''
+        CREATE TEMP TABLE child (parent_id INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)
+    ''')
+
+    with pytest.raises(sqlite3.IntegrityError):
+        with db._transaction() as cursor:
+            cursor.execute('INSERT INTO child VALUES (1)')
+
+    assert not writer.in_transaction
+    assert add_records(db, 1)
+    assert db.get_statistics()['total_records'] == 1
+
+
+def test_close_releases_every_thread_and_the_metrics(make_db):
+    db = make_db()
+    thread = threading.Thread(target=db.get_pending_sync_count)
+    thread.start()
+    thread.join()
+    assert len(db._readers) == 1
+
+    db.get_pending_sync_count()
+    db.close()
+
+    assert db._readers == []
+    assert db._writer is None
+    # The gauge no longer holds the closed manager
+    other = make_db('other.db')
+    add_records(other, 3)
+    db.close()
+    assert OUTBOX_DEPTH.snapshot()[0]['value'] == 3
+
+
+def test_newer_records_are_those_above_the_top_row(db):
+    add_records(db, 5)
+    (top, *_), _ = db.get_records_page(page_size=2)
+    assert db.get_newer_records(top[0]) == []
+
+    add_records(db, 3, prefix='760')
+    newer = db.get_newer_records(top[0])
+    assert [record[1] for record in newer] == [f'760{i:010d}' for i in (2, 1, 0)]
+    assert newer == db.get_records_page(page_size=3)[0]
+    assert [record[1] for record in db.get_newer_records(top[0], search_text='7600000000001')] == ['7600000000001']
+    # Too many to add in place
+    assert db.get_newer_records(top[0], limit=2) is None
+
+
+def test_records_by_ids_reflect_sync_status(db):
+    add_records(db, 3)
+    records, _ = db.get_records_page()
+    ids = [record[0] for record in records]
+    execute(db, 'UPDATE inventory SET sync_status = 1 WHERE id = ?', (ids[0],))
+
+    by_id = db.get_records_by_ids(ids + [10 ** 6])
+    assert set(by_id) == set(ids)
+    assert by_id[ids[0]] == records[0][:6] + (1,)
+    assert by_id[ids[1]] == records[1]
+
+
+def record_id(db, codigo_barras):
+    return execute(db, 'SELECT id FROM inventory WHERE codigo_barras = ?', (codigo_barras,))[0][0]
+
+
+def test_statistics_triggers_match_a_full_recount(db):
+    add_records(db, 3)
+    db.add_record_with_sync('7500000000000', 'Repetido', 4, 'auditor', 'B-02', 'auditor')
+    assert db.rebuild_statistics(repair=False) == {}
+
+    # Quantity edit, then a barcode change that merges into an existing barcode
+    db.update_record(record_id(db, '7500000000001'), '7500000000001', 'Articulo 1', 7, 'auditor', 'A-01')
+    assert db.rebuild_statistics(repair=False) == {}
+    db.update_record(record_id(db, '7500000000002'), '7500000000000', 'Articulo 2', 2, 'auditor', 'C-03')
+    assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_statistics()['unique_products'] == 2
+
+    # Deleting one of a barcode's records keeps it counted, deleting the last drops it
+    db.delete_record(record_id(db, '7500000000001'))
+    assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_statistics()['unique_products'] == 1
+    for (remaining,) in execute(db, 'SELECT id FROM inventory'):
+        db.delete_record(remaining)
+        assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_statistics() == {'total_records': 0, 'total_quantity': 0, 'unique_products': 0,
+                                   'last_record_date': None}
+
+
+def test_rollup_follows_edits_across_locations(db):
+    db.add_record_with_sync('111', 'Uno', 2, 'auditor', 'A-01', 'auditor')
+    db.add_record_with_sync('111', 'Uno', 3, 'auditor', 'B-02', 'auditor')
+    db.add_record_with_sync('222', 'Dos', 5, 'auditor', None, 'auditor')
+    assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_sku_counts('111', 'A-01') == {'total_quantity': 5, 'total_records': 2,
+                                                 'location_quantity': 2, 'location_records': 1}
+
+    # Moved to another location, then to another barcode with no location
+    moved = execute(db, "SELECT id FROM inventory WHERE locacion = 'A-01'")[0][0]
+    db.update_record(moved, '111', 'Uno', 4, 'auditor', 'B-02')
+    assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_sku_counts('111', 'A-01')['location_records'] == 0
+    assert db.get_sku_counts('111', 'B-02')['location_quantity'] == 7
+    db.update_record(moved, '222', 'Dos', 1, 'auditor', '')
+    assert db.rebuild_statistics(repair=False) == {}
+    assert db.get_sku_counts('222') == {'total_quantity': 6, 'total_records': 2,
+                                        'location_quantity': 6, 'location_records': 2}
+
+    db.delete_record(moved)
+    assert db.rebuild_statistics(repair=False) == {}
+    assert execute(db, 'SELECT codigo_barras, locacion, total_quantity, record_count FROM inventory_rollup '
+                       'ORDER BY codigo_barras') == [('111', 'B-02', 3, 1), ('222', '', 5, 1)]
+
+
+def test_full_text_search_matches_the_like_scan(db):
+    assert db.has_fts
+    add_records(db, 20)
+    db.add_record_with_sync('7800000000001', 'Caja grande', 1, 'maria', 'B-02', 'maria')
+    db.add_record_with_sync('7800000000002', 'Cinta "doble" caja', 2, 'jose', None, 'jose')
+    db.add_record_with_sync('7800000000003', None, 3, 'jose', 'Bodega', 'jose')
+    # The index follows edits and deletes
+    db.update_record(record_id(db, '7500000000003'), '7500000000003', 'Tapa de caja', 1, 'maria', 'A-01')
+    db.delete_record(record_id(db, '7800000000001'))
+
+    def search(term, fts):
+        db.has_fts = fts
+        try:
+            return db.search_records(term)
+        finally:
+            db.has_fts = True
+
+    for term in ['caja', 'CAJA', '"doble"', 'Articulo 1', '780', 'maria', 'B-02', 'bod', 'grande', 'nada',
+                 'ca', 'A-', '1', 'é']:
+        assert search(term, True) == search(term, False), term
+    assert len(search('caja', True)) == 2
@@ -0,0 +1,145 @@
+import os
+from threading import Event, Thread
+
+import pytest
+
+from conftest import add_records
+from file_manager import CSV_SAMPLE_BYTES, FileManager
+
+
+def write_master(path, items):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('codigo;descripcion\r\n')
+        for codigo, descripcion in items:
+            f.write(f'{codigo};{descripcion}\r\n')
+    return str(path)
+
+
+def import_master(db, path, **kwargs):
+    success, pairs = FileManager().load_master_file(path, **kwargs)
+    assert success, pairs
+    return db.apply_master_delta(pairs, FileManager().hash_file(path))
+
+
+def test_delta_import_writes_only_differences(db, tmp_path):
+    first = write_master(tmp_path / 'first.csv', [(f'{i}', f'Articulo {i}') for i in range(100)])
+    assert import_master(db, first) == {'added': 100, 'changed': 0, 'removed': 0, 'total': 100}
+
+    items = [(f'{i}', f'Articulo {i}') for i in range(10, 105)]
+    items[0] = ('10', 'Articulo diez')
+    second = write_master(tmp_path / 'second.csv', items)
+    assert import_master(db, second) == {'added': 5, 'changed': 1, 'removed': 10, 'total': 95}
+
+    assert db.get_master_count() == 95
+    assert db.get_sync_state('master_file_hash') == FileManager().hash_file(second)
+    db.open_master_index()
+    assert db.get_master_description('10') == 'Articulo diez'
+    assert db.get_master_description('104') == 'Articulo 104'
+    assert db.get_master_description('5') is None
+
+
+def test_later_rows_of_a_code_win(db, tmp_path):
+    path = write_master(tmp_path / 'master.csv', [('1', 'Primero'), ('2', 'Dos'), ('1', 'Segundo')])
+
+    assert import_master(db, path)['total'] == 2
+    assert db.get_master_description('1') == 'Segundo'
+
+
+def test_cancelled_import_leaves_previous_master(db, tmp_path):
+    import_master(db, write_master(tmp_path / 'first.csv', [('1', 'Uno')]))
+    cancel_event = Event()
+
+    def progress(rows, total, rows_per_second):
+        cancel_event.set()
+
+    large = write_master(tmp_path / 'large.csv', [(f'{i}', f'Articulo {i}') for i in range(20000)])
+    assert import_master(db, large, progress_callback=progress, cancel_event=cancel_event) is None
+
+    assert db.get_master_count() == 1
+    assert db.get_master_description('1') == 'Uno'
+    assert not list(tmp_path.glob('master_import-*'))
+
+
+def test_scans_commit_while_the_master_is_parsed(db):
+    committed = []
+
+    def parse():
+        for i in range(100):
+            if i == 50:
+                # A scan arriving mid-import must not wait for the parse to end
+                scan = Thread(target=lambda: committed.append(add_records(db, 1)))
+                scan.start()
+                scan.join(timeout=5)
+            yield f'{i}', f'Articulo {i}'
+
+    assert db.apply_master_delta(parse())['total'] == 100
+    assert committed == [1]
+
+
+def test_parallel_csv_parse_matches_sequential(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr('file_manager.CSV_CHUNK_BYTES', 4096)
+    items = [(f'{i}', f'Artículo {i}') for i in range(2000)]
+    # Characters str.splitlines breaks on, but CSV does not
+    items[10] = ('10', 'Caja\x0cgrande')
+    items[500] = ('500', 'Uno\x85dos tres\x1cfin')
+    items[900] = ('900', '"Con; separador"')
+    path = write_master(tmp_path / 'master.csv', items)
+    file_manager = FileManager()
+
+    success, sequential = file_manager.load_csv_file(path, workers=1)
+    assert success
+    sequential = list(sequential)
+    success, parallel = file_manager.load_csv_file(path, workers=2)
+    assert success
+    parallel = list(parallel)
+
+    assert 'sequentially' not in caplog.text
+    assert parallel == sequential
+    assert dict(parallel)['10'] == 'Caja\x0cgrande'
+    assert dict(parallel)['500'] == 'Uno\x85dos tres\x1cfin'
+    assert dict(parallel)['900'] == 'Con; separador'
+    assert len(parallel) == 2000
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_csv_with_cp1252_past_the_sample_is_reparsed(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr('file_manager.CSV_CHUNK_BYTES', 4096)
+    path = tmp_path / 'master.csv'
+    items = [(f'{i}', f'Articulo {i}') for i in range(5000)]
+    with open(path, 'w', encoding='cp1252', newline='') as f:
+        f.write('codigo;descripcion\r\n')
+        for codigo, descripcion in items:
+            f.write(f'{codigo};{descripcion}\r\n')
+        f.write('9999;Caña\r\n')
+    assert os.path.getsize(path) > CSV_SAMPLE_BYTES
+    file_manager = FileManager()
+    assert file_manager.detect_csv_format(str(path))[0] == 'utf-8'
+
+    success, pairs = file_manager.load_csv_file(str(path), workers=workers)
+    assert success
+    master = dict(pairs)
+
+    assert master['9999'] == 'Caña'
+    assert len(master) == 5001
+
+
+def test_additions_past_the_limit_rebuild_the_index(db, tmp_path, monkeypatch):
+    monkeypatch.setattr('database_manager.MASTER_INDEX_MAX_UNINDEXED', 10)
+    import_master(db, write_master(tmp_path / 'first.csv', [(f'{i}', f'Articulo {i}') for i in range(20)]))
+    generation = db.get_sync_state('master_generation')
+
+    # A few additions are looked up in the table
+    assert db.upsert_master_item('100', 'Nuevo')
+    assert db.get_sync_state('master_generation') == generation
+    items = [(f'{i}', f'Articulo {i}') for i in range(25)] + [('100', 'Nuevo')]
+    assert import_master(db, write_master(tmp_path / 'second.csv', items))['added'] == 5
+    assert db.get_sync_state('master_generation') == generation
+
+    # Past the limit the index is rebuilt with them
+    items += [(f'{i}', f'Articulo {i}') for i in range(25, 30)]
+    assert import_master(db, write_master(tmp_path / 'third.csv', items))['added'] == 5
+    assert db.get_sync_state('master_generation') == generation + 1
+    db.open_master_index()
+    assert len(db._master_index) == 31
+    assert db.get_master_count() == 31
+    assert db.get_master_description('100') == 'Nuevo'
@@ -0,0 +1,184 @@
+import time
+import uuid
+
+from conftest import _firebase_manager, add_records, execute, inventory_documents
+from firebase_manager import FirebaseManager
+from firestore_codec import FIELD_KINDS, INVENTORY_CODEC, encode_inventory_fields
+from sync_executor import AdaptiveRateController, SYNC_RETRIES
+
+
+def retries(reason):
+    return sum(sample['value'] for sample in SYNC_RETRIES.snapshot() if sample['labels'] == {'reason': reason})
+
+
+def test_expired_token_is_refreshed_and_request_replayed(emulator, firebase, db):
+    add_records(db, 10)
+    emulator.expire_tokens()
+    auth_retries = retries('auth')
+
+    assert db.sync_pending_records(firebase) == 10
+
+    assert emulator.stats['unauthorized'] == 1
+    assert retries('auth') == auth_retries + 1
+    assert db.get_pending_sync_count() == 0
+    assert len(inventory_documents(emulator)) == 10
+
+
+def test_throttled_batches_are_retried_in_the_same_run(emulator, firebase, db):
+    add_records(db, 300)
+    emulator.throttle_rate = 0.3
+
+    assert db.sync_pending_records(firebase) == 300
+
+    assert emulator.stats['throttled'] > 0
+    assert db.get_pending_sync_count() == 0
+    assert len(inventory_documents(emulator)) == 300
+
+
+def test_rejected_writes_are_retried_in_the_same_run(emulator, firebase, db):
+    add_records(db, 500)
+    emulator.write_throttle_rate = 0.05
+    throttled_retries = retries('throttled')
+
+    assert db.sync_pending_records(firebase) == 500
+
+    assert retries('throttled') > throttled_retries
+    assert db.get_pending_sync_count() == 0
+    assert len(inventory_documents(emulator)) == 500
+
+
+def test_controller_backoff_scales_with_rejected_share():
+    controller = AdaptiveRateController(max_concurrency=4, min_batch_size=1, initial_batch_size=400,
+                                        throttle_pause=10.0)
+
+    controller.record(0.1, 429, rejected_share=0.05)
+    assert controller.batch_size == 390
+    assert 0 < controller.pause_remaining() <= 0.5
+
+    controller.record(0.1, 429)
+    assert controller.batch_size == 195
+    assert controller.pause_remaining() > 9
+
+
+def test_inventory_encoder_matches_the_codec_spec():
+    record = {'codigo_barras': '7500000000000', 'descripcion': 'Caja', 'cantidad': 3, 'auditor': 'auditor',
+              'locacion': 'A-01', 'timestamp': '2024-05-01 12:30:00', 'local_id': uuid.uuid4().hex}
+    fields = encode_inventory_fields(record, 'uid')
+
+    # The hand-written encoder writes every field the codec decodes, with its kind's tag
+    assert set(fields) == set(INVENTORY_CODEC.field_names)
+    for field, kind, _ in INVENTORY_CODEC.spec:
+        assert FIELD_KINDS[kind][0] in fields[field], field
+    assert INVENTORY_CODEC.decode(fields) == dict(record, user_id='uid', sync_status=True)
+
+
+def test_outbox_lease_hides_entries_from_other_runs(db):
+    add_records(db, 5)
+    owner, other = uuid.uuid4().hex, uuid.uuid4().hex
+
+    batch, stale, last_seq, more = db._read_outbox_batch(0, 10, owner)
+    assert len(batch) == 5 and not stale and not more
+    assert db._read_outbox_batch(0, 10, other)[0] == []
+
+    # Released entries, or ones whose lease ran out, go to the next run
+    db._release_outbox_leases(owner, [seq for (seq, _), _ in batch[:2]])
+    assert len(db._read_outbox_batch(0, 10, other)[0]) == 2
+    execute(db, 'UPDATE sync_outbox SET lease_expires = ? WHERE lease_owner = ?', (time.time() - 1, owner))
+    assert len(db._read_outbox_batch(0, 10, other)[0]) == 5
+    assert execute(db, 'SELECT COUNT(*) FROM sync_outbox WHERE lease_owner = ?', (owner,)) == [(0,)]
+
+
+def test_outbox_ack_keeps_changes_made_during_upload(db):
+    add_records(db, 2)
+    batch, _, _, _ = db._read_outbox_batch(0, 10, uuid.uuid4().hex)
+    (_, edited_id), _ = batch[0]
+    record_id = execute(db, 'SELECT id FROM inventory WHERE local_id = ?', (edited_id,))[0][0]
+
+    # Edited while the old state was in flight
+    db.update_record(record_id, '7500000000000', 'Editado', 3, 'auditor', 'A-01')
+    db._complete_outbox_entries([(seq, local_id, local_id) for (seq, local_id), _ in batch])
+
+    assert db.get_pending_sync_count() == 1
+    assert execute(db, 'SELECT local_id, sync_status FROM inventory ORDER BY id') == [
+        (edited_id, 0), (batch[1][0][1], 1)]
+
+
+def test_pull_receives_late_older_scans_edits_and_deletes(firebase, other_firebase, make_db):
+    device_a, device_b = make_db('a.db'), make_db('b.db')
+    device_a.add_record_with_sync('111', 'Uno', 1, 'auditor', 'A-01', 'auditor')
+    device_a.sync_pending_records(firebase)
+    assert device_b.pull_remote_updates(other_firebase) == 1
+
+    # Scanned long ago on a device that was offline, uploaded only now
+    device_a.add_record_with_sync('222', 'Dos', 2, 'auditor', 'A-01', 'auditor')
+    execute(device_a, "UPDATE inventory SET timestamp = '2020-01-01 00:00:00' WHERE codigo_barras = '222'")
+    device_a.sync_pending_records(firebase)
+    assert device_b.pull_remote_updates(other_firebase) == 1
+    assert execute(device_b, "SELECT timestamp FROM inventory WHERE codigo_barras = '222'") == [
+        ('2020-01-01 00:00:00',)]
+
+    record_id = execute(device_a, "SELECT id FROM inventory WHERE codigo_barras = '111'")[0][0]
+    device_a.update_record(record_id, '111', 'Uno editado', 5, 'auditor', 'A-01')
+    device_a.sync_pending_records(firebase)
+    assert device_b.pull_remote_updates(other_firebase) == 1
+    assert execute(device_b, "SELECT descripcion, cantidad FROM inventory WHERE codigo_barras = '111'") == [
+        ('Uno editado', 5)]
+
+    device_a.delete_record(record_id)
+    device_a.sync_pending_records(firebase)
+    assert device_b.pull_remote_updates(other_firebase) == 1
+    assert execute(device_b, 'SELECT codigo_barras FROM inventory') == [('222',)]
+    # A pulled delete is not queued for upload again
+    assert device_b.get_pending_sync_count() == 0
+
+    # Nothing changed since: pulling again applies nothing
+    assert device_b.pull_remote_updates(other_firebase) == 0
+    assert device_a.pull_remote_updates(firebase) == 0
+
+
+def test_deleting_never_uploaded_scans_queues_nothing(emulator, firebase, db):
+    add_records(db, 3)
+    record_ids = [row[0] for row in execute(db, 'SELECT id FROM inventory')]
+    # An insert leased by a run in flight may reach the server
+    db._read_outbox_batch(0, 1, 'in-flight')
+    for record_id in record_ids:
+        db.delete_record(record_id)
+
+    assert execute(db, 'SELECT op FROM sync_outbox') == [('delete',)]
+    # Only the leased record's delete is sent, with its tombstone
+    writes = emulator.stats['writes']
+    assert db.sync_pending_records(firebase) == 1
+    assert emulator.stats['writes'] - writes == 1
+    assert len(inventory_documents(emulator, 'inventory_tombstones')) == 1
+
+
+def test_pulled_rows_with_null_fields_are_not_rewritten(firebase, db):
+    db.add_records_bulk([{'codigo_barras': '333', 'cantidad': 1, 'created_by': 'auditor'}])
+    db.sync_pending_records(firebase)
+
+    assert db.pull_remote_updates(firebase) == 0
+
+
+def test_short_lived_tokens_are_not_refreshed_in_a_loop(emulator):
+    emulator.token_ttl = 60
+    manager = _firebase_manager(emulator, create=True)
+    try:
+        time.sleep(1)
+        # Refreshed at half its lifetime, not on every pass of the loop
+        assert len(emulator.tokens) == 1
+        assert manager.refresh_auth_token()
+        assert len(emulator.tokens) == 1
+    finally:
+        manager.close()
+
+
+def test_offline_probe_fails_without_retrying(emulator):
+    config = emulator.config()
+    emulator.stop()
+    manager = FirebaseManager(config)
+    try:
+        start = time.monotonic()
+        assert not manager.is_online()
+        assert time.monotonic() - start < 1
+    finally:
+        manager.close()
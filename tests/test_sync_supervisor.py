@@ -0,0 +1,55 @@
+from sync_supervisor import CLOSED, OPEN, SyncSupervisor
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.last_run = {'batches': 0, 'failed_batches': 0, 'failure_status': None}
+
+    def run(self, batches, failed_batches=0, failure_status=None):
+        self.last_run = {'batches': batches, 'failed_batches': failed_batches, 'failure_status': failure_status}
+
+
+class FakeFirebase:
+    def __init__(self):
+        self.sync_executor = FakeExecutor()
+        self.online = False
+        self.probes = 0
+
+    def is_online(self):
+        self.probes += 1
+        return self.online
+
+
+def failed_push(firebase):
+    firebase.sync_executor.run(1, failed_batches=1)
+    return 0
+
+
+def idle_push():
+    return 0
+
+
+def test_idle_runs_close_the_circuit_once_back_online():
+    firebase = FakeFirebase()
+    supervisor = SyncSupervisor(firebase)
+    for _ in range(3):
+        supervisor.run(lambda: failed_push(firebase), force=True)
+    assert supervisor.status()['state'] == OPEN
+    assert supervisor.last_push_failed
+
+    # Still offline: an idle run probes and keeps the circuit open
+    supervisor.run(idle_push, force=True)
+    assert supervisor.status()['state'] == OPEN
+    assert not supervisor.last_push_failed
+    assert firebase.probes == 1
+
+    firebase.online = True
+    supervisor.run(idle_push, force=True)
+    status = supervisor.status()
+    assert status['state'] == CLOSED
+    assert status['consecutive_failures'] == 0
+    assert status['retry_in'] == 0
+
+    # Healthy idle runs do not probe
+    supervisor.run(idle_push)
+    assert firebase.probes == 2